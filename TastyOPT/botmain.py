@@ -1,14 +1,46 @@
 # botmain.py
 import asyncio
+import base64
+import bisect
+import contextlib
+import gc
 import logging
+import math
 import os
 import json
-from datetime import datetime
-from typing import Any
-
-from dotenv import load_dotenv
-
-from aiogram import Bot, Dispatcher, F, types
+import re
+import hashlib
+import heapq
+import html
+import inspect
+import itertools
+import sqlite3
+import ssl
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from enum import IntEnum
+from types import FunctionType, MethodType, ModuleType
+from typing import Any, Awaitable, Callable
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows: блокировки WAL нет
+    fcntl = None
+
+import certifi
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from dotenv import dotenv_values, load_dotenv
+
+import aiogram
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     ReplyKeyboardMarkup,
@@ -18,22 +50,92 @@ from aiogram.types import (
     FSInputFile,
 )
 from aiogram.client.default import DefaultBotProperties
-from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import TelegramMethod
 
 # ============ ЛОГИ ============
 logging.basicConfig(level=logging.INFO)
 
+# настройки — config/.env рядом с ботом (в Docker этот каталог монтируется, см. docker-compose.yml);
+# его же бот перечитывает на лету. ENV_FILE= пусто — только переменные окружения.
+# Старое место (.env рядом с ботом) читается, пока файл не перенесён в config/.
+_BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+_DEFAULT_ENV_FILE = os.path.join(_BOT_DIR, "config", ".env")
+if not os.path.exists(_DEFAULT_ENV_FILE) and os.path.exists(os.path.join(_BOT_DIR, ".env")):
+    _DEFAULT_ENV_FILE = os.path.join(_BOT_DIR, ".env")
+ENV_FILE = os.getenv("ENV_FILE", _DEFAULT_ENV_FILE)
+
 # Загружаем .env
-load_dotenv()
+if ENV_FILE:
+    load_dotenv(ENV_FILE)
 
 # ============ НАСТРОЙКИ ИЗ ENV ============
 API_TOKEN = os.getenv("BOT_TOKEN")
-ADMINS_RAW = os.getenv("ADMIN_IDS", "")
-ARCHIVE_CHAT_ID_RAW = os.getenv("ARCHIVE_CHAT_ID", "").strip()
+
+if not API_TOKEN:
+    raise RuntimeError("Не найден токен бота. Укажи BOT_TOKEN в переменных окружения.")
+
+# ============ ГОРЯЧАЯ ПЕРЕЗАГРУЗКА НАСТРОЕК ============
+# ADMIN_IDS и ARCHIVE_CHAT_ID меняются без перезапуска: бот раз в CONFIG_WATCH_INTERVAL
+# проверяет .env (или админ шлёт /reload), разбирает и проверяет новые значения и целиком
+# подменяет объект settings. Черновики, трекинг сообщений и идущие рассылки не теряются.
+# Значение из .env важнее переменной окружения — иначе правка файла ничего бы не меняла.
+
+RELOADABLE_KEYS = ("ADMIN_IDS", "ARCHIVE_CHAT_ID")
+CONFIG_WATCH_INTERVAL = float(os.getenv("CONFIG_WATCH_INTERVAL", "5"))
+
+
+class Settings:
+    """
+    Разобранные настройки, которые можно менять на лету. Объект не меняется —
+    при перезагрузке создаётся новый и подменяется целиком.
+    """
+
+    __slots__ = ("admin_ids", "archive_chat_id")
+
+    def __init__(self, admin_ids: frozenset[int], archive_chat_id: int | None):
+        self.admin_ids = admin_ids
+        self.archive_chat_id = archive_chat_id
+
+    def diff(self, new: "Settings") -> list[str]:
+        changes: list[str] = []
+        added = sorted(new.admin_ids - self.admin_ids)
+        removed = sorted(self.admin_ids - new.admin_ids)
+        if added:
+            changes.append("ADMIN_IDS +" + ", +".join(map(str, added)))
+        if removed:
+            changes.append("ADMIN_IDS -" + ", -".join(map(str, removed)))
+        if new.archive_chat_id != self.archive_chat_id:
+            changes.append(f"ARCHIVE_CHAT_ID {self.archive_chat_id} → {new.archive_chat_id}")
+        return changes
 
 
-def parse_admin_ids(raw: str):
+def read_config_env() -> dict[str, str]:
+    env = {key: os.environ.get(key, "") for key in RELOADABLE_KEYS}
+    if ENV_FILE and os.path.exists(ENV_FILE):
+        for key, value in dotenv_values(ENV_FILE).items():
+            if key in env and value is not None:
+                env[key] = value
+    return env
+
+
+def parse_admin_ids(raw: str) -> tuple[frozenset[int], list[str]]:
     ids = set()
+    errors: list[str] = []
     raw = raw.replace(" ", "")
     for part in raw.split(","):
         if not part:
@@ -41,1011 +143,4345 @@ def parse_admin_ids(raw: str):
         try:
             ids.add(int(part))
         except ValueError:
-            logging.warning(f"Не удалось распарсить ADMIN_ID: {part}")
-    return ids
+            errors.append(f"Не удалось распарсить ADMIN_ID: {part}")
+    return frozenset(ids), errors
 
 
-ADMIN_IDS = parse_admin_ids(ADMINS_RAW)
+def parse_settings(env: dict[str, str]) -> tuple[Settings, list[str]]:
+    """
+    Возвращает настройки и список ошибок. Неверные значения пропускаются
+    (при старте — с предупреждением, при перезагрузке ошибки отменяют её целиком).
+    """
+    admin_ids, errors = parse_admin_ids(env.get("ADMIN_IDS", ""))
 
-ARCHIVE_CHAT_ID: int | None = None
-if ARCHIVE_CHAT_ID_RAW:
-    try:
-        ARCHIVE_CHAT_ID = int(ARCHIVE_CHAT_ID_RAW)
-    except ValueError:
-        logging.warning("ARCHIVE_CHAT_ID указан неверно. Должен быть числом (например -100...).")
-        ARCHIVE_CHAT_ID = None
-else:
-    logging.warning("ARCHIVE_CHAT_ID не задан. Умная рассылка/архив работать не будут.")
+    archive_chat_id: int | None = None
+    archive_raw = env.get("ARCHIVE_CHAT_ID", "").strip()
+    if archive_raw:
+        try:
+            archive_chat_id = int(archive_raw)
+        except ValueError:
+            errors.append("ARCHIVE_CHAT_ID указан неверно. Должен быть числом (например -100...).")
 
-if not API_TOKEN:
-    raise RuntimeError("Не найден токен бота. Укажи BOT_TOKEN в переменных окружения.")
+    return Settings(admin_ids, archive_chat_id), errors
+
+
+settings, _settings_errors = parse_settings(read_config_env())
+for _err in _settings_errors:
+    logging.warning(_err)
+
+if settings.archive_chat_id is None and not _settings_errors:
+    logging.warning("ARCHIVE_CHAT_ID не задан. Умная рассылка/архив работать не будут.")
 
-if not ADMIN_IDS:
+if not settings.admin_ids:
     logging.warning("ADMIN_IDS пуст — в боте не будет админов. Задай ADMIN_IDS в env.")
 
+
+def apply_settings(new: Settings, source: str) -> list[str]:
+    """
+    Атомарно подменяет settings и пишет в лог, что изменилось. Возвращает список изменений.
+    """
+    global settings
+    changes = settings.diff(new)
+    settings = new
+    if changes:
+        logging.warning("Настройки обновлены (%s): %s", source, "; ".join(changes))
+    return changes
+
+
+# антиспам: токенов в секунду на пользователя, размер «ведра», сколько ведер держим в памяти
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "10"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "10000"))
+
+# HTTP-клиент Bot API (см. make_bot_session)
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip()  # свой Bot API сервер, пусто = api.telegram.org
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "0"))  # 0 = без отдельного лимита
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "3600"))  # 0 = не кэшировать DNS
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+# отдельная сессия (и пул соединений) для массовых рассылок
+HTTP_BULK_SESSION = os.getenv("HTTP_BULK_SESSION", "0").strip().lower() in ("1", "true", "yes")
+HTTP_BULK_POOL_SIZE = int(os.getenv("HTTP_BULK_POOL_SIZE", "50"))
+HTTP_BULK_TIMEOUT = float(os.getenv("HTTP_BULK_TIMEOUT", "60"))
+
+# обработка апдейтов: сколько хендлеров одновременно и сколько апдейтов может ждать в очередях
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "128"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))
+# сколько апдейтов одного чата может стоять в его полосе; лишние отбрасываются сразу,
+# чтобы флудящий чат не занял все UPDATE_MAX_PENDING слотов polling (0 — без ограничения)
+UPDATE_LANE_MAX_DEPTH = int(os.getenv("UPDATE_LANE_MAX_DEPTH", "20"))
+
+# общий планировщик запросов к Bot API (сообщений в секунду)
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))   # на весь бот
+API_BULK_RATE = float(os.getenv("API_BULK_RATE", "25"))       # из них максимум на рассылки / догоняющие
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", "1"))        # в один личный чат
+API_CHAT_BURST = float(os.getenv("API_CHAT_BURST", "5"))      # короткий всплеск в один чат (меню = несколько сообщений)
+API_GROUP_RATE = float(os.getenv("API_GROUP_RATE", "0.33"))   # в группу/канал (~20 в минуту)
+API_SERVICE_RATE = float(os.getenv("API_SERVICE_RATE", "30"))  # удаления, правки и прочие не-отправки — свой бюджет
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "2"))      # повторов после 429
+
+# где хранится FSM-состояние (черновики рассылок, трекинг сообщений):
+# memory — в процессе, sqlite — файл рядом с data/, kv — KV-хранилище (REDIS_URL).
+# Это про сохранность черновиков и трекинга между рестартами, а не про масштабирование:
+# бот работает ОДНИМ процессом на каталог data/ (см. DataStore._lock_wal).
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+
+# формат файлов хранилища: auto (orjson, если установлен, иначе json) | json | orjson | msgpack
+STORE_SERIALIZER = os.getenv("STORE_SERIALIZER", "auto").strip().lower()
+# msgpack — двоичный формат, у таких файлов своё расширение; остальные варианты пишут JSON
+STORE_EXT = ".msgpack" if STORE_SERIALIZER == "msgpack" else ".json"
+STORE_EXTS = (".json", ".msgpack")
+
 # ============ ПУТИ К ФАЙЛАМ "БД" ============
 DATA_DIR = "data"
 USERS_FILE = os.path.join(DATA_DIR, "users.txt")
 STATS_FILE = os.path.join(DATA_DIR, "stats.txt")
 
-BROADCASTS_FILE = os.path.join(DATA_DIR, "broadcasts.json")   # список рассылок (архив)
-DELIVERIES_FILE = os.path.join(DATA_DIR, "deliveries.json")   # кто что получил + message_id в личке
+BROADCASTS_FILE = os.path.join(DATA_DIR, "broadcasts" + STORE_EXT)  # список рассылок (архив)
+DELIVERIES_FILE = os.path.join(DATA_DIR, "deliveries" + STORE_EXT)  # кто что получил + message_id в личке
+SCHEDULES_FILE = os.path.join(DATA_DIR, "schedules" + STORE_EXT)    # отложенные рассылки
+RETRIES_FILE = os.path.join(DATA_DIR, "retries" + STORE_EXT)        # недоставленные: когда повторить; кто недоступен
+HLL_FILE = os.path.join(DATA_DIR, "uniques" + STORE_EXT)            # HyperLogLog уникальных пользователей по дням
+MEDIA_FILE = os.path.join(DATA_DIR, "media" + STORE_EXT)            # file_id загруженных картинок
+MEM_DUMP_DIR = os.path.join(DATA_DIR, "mem")                        # снимки памяти (/mem)
+WAL_FILE = os.path.join(DATA_DIR, "store.wal")                      # журнал изменений файлов выше
+FSM_SQLITE_FILE = os.getenv("FSM_SQLITE_PATH", os.path.join(DATA_DIR, "fsm.sqlite3"))
+
+# компактная запись без отступов (0 — с отступами, удобно читать глазами)
+STORE_COMPACT = os.getenv("STORE_COMPACT", "1").strip().lower() in ("1", "true", "yes")
+
+# WAL: максимум операций в одной пачке (один fsync), после скольких записей / секунд делать снапшот
+WAL_BATCH_MAX = int(os.getenv("WAL_BATCH_MAX", "500"))
+WAL_COMPACT_EVERY = int(os.getenv("WAL_COMPACT_EVERY", "5000"))
+WAL_COMPACT_INTERVAL = float(os.getenv("WAL_COMPACT_INTERVAL", "300"))
+
+# список рассылок в меню удаления/изменения: сколько на странице
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "8"))
+
+# изменение отправленной рассылки: сколько правок параллельно (темп задаёт ApiRateScheduler)
+BROADCAST_EDIT_CONCURRENCY = int(os.getenv("BROADCAST_EDIT_CONCURRENCY", "8"))
+
+# живой прогресс рассылки: обновлять раз в N секунд или каждые N процентов
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "2"))
+BROADCAST_PROGRESS_STEP = int(os.getenv("BROADCAST_PROGRESS_STEP", "5"))
+
+# сколько дней рассылка догоняет новых пользователей (0 — всегда), можно поменять при отправке
+BROADCAST_TTL_DAYS = int(os.getenv("BROADCAST_TTL_DAYS", "30"))
+# не больше скольких последних рассылок догонять на /start (0 — без ограничения)
+CATCHUP_MAX = int(os.getenv("CATCHUP_MAX", "10"))
+# как часто (сек) убирать истёкшие рассылки из архива (те, что ни у кого не лежат в чате)
+BROADCAST_PRUNE_INTERVAL = float(os.getenv("BROADCAST_PRUNE_INTERVAL", "3600"))
+
+# повтор недоставленных: задержка 1-й попытки (сек), потолок задержки, максимум попыток, как часто проверять
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "60"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "21600"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_POLL_INTERVAL = float(os.getenv("RETRY_POLL_INTERVAL", "30"))
+
+# уникальные пользователи (HyperLogLog): сколько дней хранить, как часто сбрасывать на диск (сек)
+HLL_KEEP_DAYS = int(os.getenv("HLL_KEEP_DAYS", "90"))
+HLL_FLUSH_INTERVAL = float(os.getenv("HLL_FLUSH_INTERVAL", "60"))
+
+# тяжёлые операции (разбор stats.txt, users.txt, обход deliveries) — в отдельном пуле потоков
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", "2"))
+# монитор задержки цикла: как часто проверять (сек) и с какой задержки писать в лог (сек)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN = float(os.getenv("LOOP_LAG_WARN", "0.5"))
+
+# /mem: включить tracemalloc при старте (иначе — /mem start), глубина стека, сколько строк топа,
+# сколько снимков хранить в data/mem, по скольким элементам оценивать размер больших структур
+MEM_TRACE = os.getenv("MEM_TRACE", "0").strip().lower() in ("1", "true", "yes")
+MEM_TRACE_FRAMES = int(os.getenv("MEM_TRACE_FRAMES", "1"))
+MEM_TOP = int(os.getenv("MEM_TOP", "10"))
+MEM_KEEP_DUMPS = int(os.getenv("MEM_KEEP_DUMPS", "5"))
+MEM_SAMPLE = int(os.getenv("MEM_SAMPLE", "200"))
+
+# лимит copyMessages за один вызов
+COPY_BATCH_SIZE = 100
 
 # ============ ИНИЦИАЛИЗАЦИЯ БОТА ============
+
+class TunedAiohttpSession(AiohttpSession):
+    """
+    AiohttpSession со своим TCPConnector. Конструктор AiohttpSession принимает только limit,
+    поэтому переопределяем публичные create_session / close и собираем ClientSession сами —
+    без правки приватных полей aiogram. Проверено на aiogram 3.22 (см. requirements.txt).
+    """
+
+    def __init__(self, connector_options: dict[str, Any], **kwargs: Any):
+        super().__init__(limit=connector_options.get("limit", 100), **kwargs)
+        self.connector_options = connector_options
+        self._client: ClientSession | None = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client is None or self._client.closed:
+            self._client = ClientSession(
+                connector=TCPConnector(
+                    ssl=ssl.create_default_context(cafile=certifi.where()), **self.connector_options
+                ),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram.__version__}"},
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+            # как в aiogram: даём SSL-соединениям закрыться
+            await asyncio.sleep(0.25)
+
+
+def make_bot_session(pool_size: int, timeout: float) -> AiohttpSession:
+    """
+    aiohttp-сессия с настраиваемым пулом соединений: keep-alive, кэш DNS,
+    лимит на хост и таймаут запроса берутся из env (HTTP_*).
+    """
+    kwargs: dict[str, Any] = {"timeout": timeout}
+    if BOT_API_URL:
+        kwargs["api"] = TelegramAPIServer.from_base(BOT_API_URL)
+
+    connector_options = {
+        "limit": pool_size,
+        "limit_per_host": HTTP_POOL_PER_HOST,
+        "keepalive_timeout": HTTP_KEEPALIVE,
+        "use_dns_cache": HTTP_DNS_TTL > 0,
+        "ttl_dns_cache": HTTP_DNS_TTL or None,
+    }
+    return TunedAiohttpSession(connector_options, **kwargs)
+
+
 bot = Bot(
     token=API_TOKEN,
+    session=make_bot_session(HTTP_POOL_SIZE, HTTP_TIMEOUT),
     default=DefaultBotProperties(parse_mode="HTML"),
 )
-dp = Dispatcher()
 
-# message_id приветствия для каждого пользователя (чтобы не удалять)
-greeting_messages: dict[int, int] = {}  # user_id -> message_id
+# рассылки идут через свой пул, чтобы не занимать соединения интерактивных ответов
+if HTTP_BULK_SESSION:
+    bulk_bot = Bot(
+        token=API_TOKEN,
+        session=make_bot_session(HTTP_BULK_POOL_SIZE, HTTP_BULK_TIMEOUT),
+        default=DefaultBotProperties(parse_mode="HTML"),
+    )
+else:
+    bulk_bot = bot
 
-# message_id последних ответов бота (для автоудаления)
-user_messages: dict[int, set[int]] = {}  # user_id -> set(message_id)
+# ============ FSM-ХРАНИЛИЩЕ ============
+# Всё «живое» состояние бота лежит в FSM-хранилище, а не в глобальных dict'ах:
+# так его переживает рестарт.
+#
+# Бот — один экземпляр на каталог data/: активные рассылки, очередь отложенных
+# и DataStore живут в памяти процесса, второй запуск на тех же data/ не стартует
+# (эксклюзивная блокировка WAL). sqlite/kv здесь — долговечность, не горизонтальное масштабирование.
+#
+# destiny="default" — сценарии админа (BroadcastStates + черновик в data);
+# destiny="messages" — трекинг сообщений бота у пользователя:
+#   {"greeting_id": int, "bot_messages": [message_id], "renders": {message_id: hash}}
 
-# админы, которые сейчас в режиме "жду сообщение для рассылки"
-pending_broadcast_admins: set[int] = set()
 
-# черновики рассылок: admin_id -> {"archive_message_id": int}
-broadcast_drafts: dict[int, dict[str, int]] = {}
+class BroadcastStates(StatesGroup):
+    waiting_message = State()        # жду сообщение для рассылки
+    waiting_schedule_time = State()  # жду время для отложенной рассылки (черновик в data)
+    waiting_edit = State()           # жду исправленный текст для уже отправленной рассылки
+    waiting_browse_date = State()    # жду дату, к которой перейти в списке рассылок
 
-# ============ JSON HELPERS ============
 
-def _load_json(path: str, default: Any) -> Any:
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return default
-    except json.JSONDecodeError:
-        logging.warning(f"JSON повреждён: {path}. Создаю заново.")
-        return default
+class LocalKV:
+    """
+    Локальная замена сетевому KV (интерфейс как у redis.asyncio: get/set/delete).
+    Нужна, чтобы гонять KVStorage без Redis — в тестах и локально.
+    """
 
+    def __init__(self):
+        self._data: dict[str, str] = {}
 
-def _save_json(path: str, data: Any) -> None:
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
+    async def get(self, key: str) -> str | None:
+        return self._data.get(key)
 
+    async def set(self, key: str, value: str) -> None:
+        self._data[key] = value
 
-def ensure_files():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    for path in (USERS_FILE, STATS_FILE):
-        if not os.path.exists(path):
-            open(path, "w", encoding="utf-8").close()
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
 
-    if not os.path.exists(BROADCASTS_FILE):
-        _save_json(BROADCASTS_FILE, {"broadcasts": []})
+    async def update(self, key: str, fn: Callable[[str | None], str | None]) -> str | None:
+        # между чтением и записью нет await — атомарно в пределах процесса
+        value = fn(self._data.get(key))
+        if value is None:
+            self._data.pop(key, None)
+        else:
+            self._data[key] = value
+        return value
 
-    if not os.path.exists(DELIVERIES_FILE):
-        _save_json(DELIVERIES_FILE, {"deliveries": {}})
 
+class SQLiteKV:
+    """
+    KV поверх одного SQLite-файла (WAL + busy_timeout): состояние переживает рестарт,
+    а сторонний читатель файла (бэкап, sqlite3 в консоли) не ломает запись.
+    Все запросы идут в своём потоке: ожидание чужой блокировки (до timeout)
+    не останавливает цикл событий.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+        # один поток на соединение: sqlite3.Connection нельзя дёргать из нескольких потоков сразу
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _get(self, key: str) -> str | None:
+        row = self._conn.execute("SELECT v FROM kv WHERE k = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _put(self, key: str, value: str | None) -> None:
+        if value is None:
+            self._conn.execute("DELETE FROM kv WHERE k = ?", (key,))
+        else:
+            self._conn.execute(
+                "INSERT INTO kv (k, v) VALUES (?, ?) ON CONFLICT(k) DO UPDATE SET v = excluded.v", (key, value)
+            )
 
-ensure_files()
+    def _update(self, key: str, fn: Callable[[str | None], str | None]) -> str | None:
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: между чтением и записью никто не вклинится
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            value = fn(self._get(key))
+            self._put(key, value)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return value
 
+    async def get(self, key: str) -> str | None:
+        return await self._run(self._get, key)
 
-def load_broadcasts() -> list[dict[str, Any]]:
-    ensure_files()
-    data = _load_json(BROADCASTS_FILE, {"broadcasts": []})
-    items = data.get("broadcasts", [])
-    if not isinstance(items, list):
-        return []
-    return items
+    async def set(self, key: str, value: str) -> None:
+        await self._run(self._put, key, value)
 
+    async def delete(self, key: str) -> None:
+        await self._run(self._put, key, None)
 
-def save_broadcasts(items: list[dict[str, Any]]) -> None:
-    _save_json(BROADCASTS_FILE, {"broadcasts": items})
+    async def update(self, key: str, fn: Callable[[str | None], str | None]) -> str | None:
+        """
+        Чтение-изменение-запись одной транзакцией; fn получает старое значение, None — удалить.
+        """
+        return await self._run(self._update, key, fn)
 
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=False)
 
-def load_deliveries() -> dict[str, dict[str, int]]:
+    def quick_check(self) -> str:
+        return self._executor.submit(lambda: self._conn.execute("PRAGMA quick_check").fetchone()[0]).result()
+
+
+class KVStorage(BaseStorage):
     """
-    deliveries[user_id_str][broadcast_id_str] = chat_message_id_int
+    FSM-хранилище aiogram поверх любого KV с get/set/delete
+    (SQLiteKV, LocalKV или redis.asyncio.Redis).
     """
-    ensure_files()
-    data = _load_json(DELIVERIES_FILE, {"deliveries": {}})
-    d = data.get("deliveries", {})
-    if not isinstance(d, dict):
-        return {}
-    cleaned: dict[str, dict[str, int]] = {}
-    for uid, mp in d.items():
-        if not isinstance(mp, dict):
-            continue
-        cleaned[uid] = {}
-        for bid, mid in mp.items():
-            try:
-                cleaned[uid][str(bid)] = int(mid)
-            except Exception:
-                continue
-    return cleaned
 
+    def __init__(self, kv: Any):
+        self.kv = kv
+        self.key_builder = DefaultKeyBuilder(prefix="tasty", with_destiny=True)
 
-def save_deliveries(deliveries: dict[str, dict[str, int]]) -> None:
-    _save_json(DELIVERIES_FILE, {"deliveries": deliveries})
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key, "state")
+        if state is None:
+            await self.kv.delete(k)
+        else:
+            await self.kv.set(k, state.state if isinstance(state, State) else str(state))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        value = await self.kv.get(self.key_builder.build(key, "state"))
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return value
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        k = self.key_builder.build(key, "data")
+        if not data:
+            await self.kv.delete(k)
+        else:
+            await self.kv.set(k, dumps_json(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        value = await self.kv.get(self.key_builder.build(key, "data"))
+        if not value:
+            return {}
+        return loads_json(value)
+
+    async def update_data_atomic(self, key: StorageKey, mutate: Callable[[dict[str, Any]], Any]) -> dict[str, Any]:
+        """
+        Атомарно меняет data: mutate правит dict на месте. Для SQLite — одна транзакция,
+        для Redis — WATCH/MULTI с повтором, если ключ поменяли между чтением и записью
+        (параллельные апдейты одного пользователя в этом же процессе).
+        """
+        k = self.key_builder.build(key, "data")
+        result: dict[str, Any] = {}
+
+        def apply(raw: str | bytes | None) -> str | None:
+            nonlocal result
+            result = loads_json(raw) if raw else {}
+            mutate(result)
+            return dumps_json(result) if result else None
+
+        update = getattr(self.kv, "update", None)
+        if update is not None:
+            await update(k, apply)
+            return result
+
+        from redis.exceptions import WatchError  # сюда попадает только redis.asyncio.Redis
+
+        async with self.kv.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(k)
+                    value = apply(await pipe.get(k))
+                    pipe.multi()
+                    if value is None:
+                        pipe.delete(k)
+                    else:
+                        pipe.set(k, value)
+                    await pipe.execute()
+                    return result
+                except WatchError:
+                    continue
 
+    async def close(self) -> None:
+        close = getattr(self.kv, "aclose", None) or getattr(self.kv, "close", None)
+        if close is not None:
+            await close()
 
-def was_delivered(user_id: int, broadcast_id: str) -> bool:
-    deliveries = load_deliveries()
-    return broadcast_id in deliveries.get(str(user_id), {})
 
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "sqlite":
+        return KVStorage(SQLiteKV(FSM_SQLITE_FILE))
 
-def mark_delivered(user_id: int, broadcast_id: str, chat_message_id: int) -> None:
-    deliveries = load_deliveries()
-    uid = str(user_id)
-    deliveries.setdefault(uid, {})
-    deliveries[uid][broadcast_id] = int(chat_message_id)
-    save_deliveries(deliveries)
+    if FSM_STORAGE == "kv":
+        if not REDIS_URL:
+            logging.warning("FSM_STORAGE=kv без REDIS_URL — использую локальный KV (без общего доступа).")
+            return KVStorage(LocalKV())
+        try:
+            from redis.asyncio import Redis
+        except ImportError:
+            raise RuntimeError("Для FSM_STORAGE=kv с REDIS_URL нужен пакет redis (pip install redis).")
+        return KVStorage(Redis.from_url(REDIS_URL))
 
+    if FSM_STORAGE != "memory":
+        logging.warning(f"Неизвестный FSM_STORAGE={FSM_STORAGE}, использую memory.")
+    return MemoryStorage()
 
-def unmark_broadcast_everywhere(broadcast_id: str) -> None:
-    deliveries = load_deliveries()
-    changed = False
-    for uid in list(deliveries.keys()):
-        if broadcast_id in deliveries[uid]:
-            deliveries[uid].pop(broadcast_id, None)
-            changed = True
-        if not deliveries[uid]:
-            deliveries.pop(uid, None)
-            changed = True
-    if changed:
-        save_deliveries(deliveries)
 
+dp = Dispatcher(storage=make_fsm_storage())
 
-def get_user_ids() -> list[int]:
-    user_ids: list[int] = []
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            for idx, line in enumerate(f):
-                line = line.strip()
-                if not line:
-                    continue
-                if idx == 0 and line.lower().startswith("user_id"):
-                    continue
-                parts = [p.strip() for p in line.split("|")]
-                if not parts:
-                    continue
-                uid_str = parts[0]
-                if uid_str.isdigit():
-                    user_ids.append(int(uid_str))
-    except FileNotFoundError:
-        pass
-    return user_ids
 
+def _messages_key(user_id: int) -> StorageKey:
+    # трекинг ведём в личке пользователя: chat_id == user_id
+    return StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id, destiny="messages")
 
-# =======================================================
-# ✅ ВАЖНОЕ: "СОХРАНИТЬ В ОТКАТЫ БЕЗ ПЕРЕСЛАНО"
-# =======================================================
-async def copy_to_archive(src: types.Message) -> types.Message:
-    """
-    Копируем сообщение в архив (Откаты) через copy_message.
-    Тогда в Откатах и у пользователей НЕ будет строки "Переслано ...".
-    Premium/кастом эмодзи при этом НЕ сохраняются (и это ок по твоему ТЗ сейчас).
-    """
-    if ARCHIVE_CHAT_ID is None:
-        raise RuntimeError("ARCHIVE_CHAT_ID не задан")
 
-    res = await bot.copy_message(
-        chat_id=ARCHIVE_CHAT_ID,
-        from_chat_id=src.chat.id,
-        message_id=src.message_id,
-    )
+async def get_tracked_messages(user_id: int) -> dict[str, Any]:
+    return await dp.storage.get_data(_messages_key(user_id))
 
-    mid = getattr(res, "message_id", None)
-    if mid is None:
-        # на всякий случай
-        mid = int(res)
 
-    # Возвращаем "фейковый Message" не надо — нам достаточно message_id,
-    # но типом пусть будет Message для совместимости — сделаем простой объект-обёртку
-    # (в aiogram copy_message возвращает MessageId).
-    dummy = types.Message(message_id=int(mid), date=datetime.now(), chat=types.Chat(id=ARCHIVE_CHAT_ID, type="supergroup"))
-    return dummy
+async def set_tracked_messages(user_id: int, data: dict[str, Any]) -> None:
+    await dp.storage.set_data(_messages_key(user_id), data)
 
 
-async def copy_from_archive_to_chat(chat_id: int, archive_message_id: int) -> int:
+async def update_tracked_messages(user_id: int, mutate: Callable[[dict[str, Any]], Any]) -> dict[str, Any]:
     """
-    Копия из архива в нужный чат (без "Переслано").
-    Возвращает message_id в целевом чате.
+    Чтение-изменение-запись трекинга без потерянных обновлений между параллельными апдейтами.
     """
-    if ARCHIVE_CHAT_ID is None:
-        raise RuntimeError("ARCHIVE_CHAT_ID не задан")
-
-    res = await bot.copy_message(
-        chat_id=chat_id,
-        from_chat_id=ARCHIVE_CHAT_ID,
-        message_id=archive_message_id,
-    )
-    mid = getattr(res, "message_id", None)
-    if mid is None:
-        mid = int(res)
-    return int(mid)
-
-
-async def send_missing_broadcasts_to_user(user_id: int) -> None:
+    key = _messages_key(user_id)
+    if isinstance(dp.storage, KVStorage):
+        return await dp.storage.update_data_atomic(key, mutate)
+    # MemoryStorage: один процесс, между чтением и записью цикл не переключается
+    data = await dp.storage.get_data(key)
+    mutate(data)
+    await dp.storage.set_data(key, data)
+    return data
+
+# ============ МЕТРИКИ ============
+
+class Metrics:
     """
-    На /start отправляет пользователю все рассылки из архива,
-    которых он ещё не получал.
-    Отправка идёт copy_message => нет "переслано".
+    Простые счётчики, «датчики» и замеры времени для мониторинга. Смотреть — командой /metrics.
     """
-    if ARCHIVE_CHAT_ID is None:
-        return
 
-    broadcasts = load_broadcasts()
-    if not broadcasts:
-        return
+    # сколько последних замеров времени держать для перцентилей
+    TIMING_WINDOW = 1000
+
+    def __init__(self):
+        self._counters: dict[str, int] = {}
+        self._gauges: dict[str, Callable[[], Any]] = {}
+        self._timings: dict[str, deque[float]] = {}
+
+    def inc(self, name: str, value: int = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name: str, fn: Callable[[], Any]) -> None:
+        self._gauges[name] = fn
+
+    def observe(self, name: str, seconds: float) -> None:
+        window = self._timings.get(name)
+        if window is None:
+            window = self._timings[name] = deque(maxlen=self.TIMING_WINDOW)
+        window.append(seconds)
+        self.inc(name + ".count")
+
+    def snapshot(self) -> dict[str, Any]:
+        snap: dict[str, Any] = dict(self._counters)
+        for name, window in self._timings.items():
+            values = sorted(window)
+            snap[name] = {
+                "p50_ms": round(values[len(values) // 2] * 1000, 1),
+                "p95_ms": round(values[min(len(values) - 1, len(values) * 95 // 100)] * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+            }
+        for name, fn in self._gauges.items():
+            try:
+                snap[name] = fn()
+            except Exception as e:
+                snap[name] = f"error: {e}"
+        return snap
 
-    def _key(b: dict[str, Any]):
-        return (b.get("created_at", ""), int(b.get("archive_message_id", 0)))
 
-    broadcasts_sorted = sorted(broadcasts, key=_key)
+metrics = Metrics()
 
-    for b in broadcasts_sorted:
-        archive_mid = b.get("archive_message_id")
-        if not isinstance(archive_mid, int):
-            continue
-        bid = str(archive_mid)
+# ============ ТЯЖЁЛЫЕ ОПЕРАЦИИ ВНЕ ЦИКЛА ============
+# Разбор файлов и обходы всего хранилища уходят в offload_executor, чтобы админский
+# экран статистики или старт рассылки не останавливал ответы остальным пользователям.
+# Функции в пуле только читают: все изменения хранилища — по-прежнему из цикла через store.submit.
 
-        if was_delivered(user_id, bid):
-            continue
+offload_executor = ThreadPoolExecutor(max_workers=OFFLOAD_WORKERS, thread_name_prefix="offload")
+_offload_running = 0
 
-        try:
-            new_mid = await copy_from_archive_to_chat(user_id, archive_mid)
-            mark_delivered(user_id, bid, new_mid)
-            await asyncio.sleep(0.05)
-        except Exception:
-            break
 
+async def offload(fn: Callable[..., Any], *args: Any) -> Any:
+    global _offload_running
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    _offload_running += 1
+    try:
+        return await loop.run_in_executor(offload_executor, fn, *args)
+    finally:
+        _offload_running -= 1
+        metrics.observe(f"offload.{fn.__name__}", time.perf_counter() - started)
 
-async def delete_broadcast_everywhere(broadcast_id: str) -> tuple[int, int]:
+
+async def loop_lag_monitor() -> None:
     """
-    Удаляет рассылку у всех пользователей и из архива.
-    Возвращает (успешно удалено, ошибок).
+    Спит LOOP_LAG_INTERVAL и меряет, насколько позже проснулся: это время,
+    на которое цикл был занят синхронным кодом и не отвечал никому.
     """
-    ok = 0
-    fail = 0
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        metrics.observe("loop.lag", lag)
+        if lag >= LOOP_LAG_WARN:
+            metrics.inc("loop.stalls")
+            logging.warning("Цикл событий был занят %.0f мс", lag * 1000)
 
-    if ARCHIVE_CHAT_ID is None:
-        return 0, 0
 
-    deliveries = load_deliveries()
+metrics.gauge("offload.running", lambda: _offload_running)
 
-    # 1) удалить у пользователей
-    ops = 0
-    for uid_str, mp in list(deliveries.items()):
-        if broadcast_id not in mp:
-            continue
-        try:
-            uid = int(uid_str)
-            mid = int(mp[broadcast_id])
-            await bot.delete_message(chat_id=uid, message_id=mid)
-            ok += 1
-        except Exception:
-            fail += 1
-        ops += 1
-        if ops % 25 == 0:
-            await asyncio.sleep(1)
+# ============ ЛИМИТЫ BOT API ============
+# Все исходящие запросы (оба Bot, все хендлеры и фоновые задачи) проходят через
+# один ApiRateScheduler, очередь по приоритетам. Отправки (send/copy/forward) —
+# общий лимит бота + лимит на чат; удаления, правки и прочее — отдельный бюджет,
+# чтобы автоочистка на /start не стояла в очереди за сообщениями.
+# Приоритет задаёт вызывающий код через api_priority_scope(...), по умолчанию — интерактив.
 
-    # 2) удалить из архива
-    try:
-        await bot.delete_message(chat_id=ARCHIVE_CHAT_ID, message_id=int(broadcast_id))
-    except Exception:
-        pass
 
-    # 3) убрать из deliveries.json
-    unmark_broadcast_everywhere(broadcast_id)
+class ApiPriority(IntEnum):
+    INTERACTIVE = 0  # ответы пользователю, меню, колбэки
+    CLEANUP = 1      # автоудаление старых сообщений
+    CATCHUP = 2      # догоняющая доставка на /start
+    BULK = 3         # рассылки, массовые правки и удаления
 
-    # 4) убрать из broadcasts.json
-    broadcasts = load_broadcasts()
-    broadcasts = [b for b in broadcasts if str(b.get("archive_message_id")) != broadcast_id]
-    save_broadcasts(broadcasts)
 
-    return ok, fail
+api_priority: ContextVar[ApiPriority] = ContextVar("api_priority", default=ApiPriority.INTERACTIVE)
 
 
-# ============ ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ============
+@contextlib.contextmanager
+def api_priority_scope(priority: ApiPriority):
+    token = api_priority.set(priority)
+    try:
+        yield
+    finally:
+        api_priority.reset(token)
 
-def save_user(user: types.User):
-    ensure_files()
 
-    STANDARD_HEADER = "user_id | Full_name | @username | first_seen_at"
+# методы, которые Telegram считает «сообщениями в чат» — общий лимит бота и лимит на чат
+_CHAT_LIMITED_PREFIXES = ("send", "copy", "forward")
+# служебные методы, которые не лимитируем вовсе (long polling, колбэки, getMe)
+_UNLIMITED_METHODS = {"getUpdates", "answerCallbackQuery", "getMe", "close", "logOut"}
 
-    need_reset = False
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            first_line = f.readline().strip()
-        if not first_line or not first_line.startswith("user_id |"):
-            need_reset = True
-    except FileNotFoundError:
-        need_reset = True
 
-    if need_reset:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            f.write(STANDARD_HEADER + "\n")
+class _Bucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
 
-    existing_ids = set()
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.lower().startswith("user_id"):
-                continue
-            parts = [p.strip() for p in line.split("|")]
-            if parts and parts[0].isdigit():
-                existing_ids.add(parts[0])
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
 
-    uid = str(user.id)
-    if uid not in existing_ids:
-        full_name = user.full_name or ""
-        username = f"@{user.username}" if user.username else ""
-        first_seen = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-        with open(USERS_FILE, "a", encoding="utf-8") as f:
-            f.write(f"{uid} | {full_name} | {username} | {first_seen}\n")
+    def wait_time(self) -> float:
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
 
 
-def log_action(user: types.User, action: str):
-    ensure_files()
-    with open(STATS_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{datetime.now().isoformat()};{user.id};{user.username or ''};{action}\n")
+class ApiRateScheduler:
+    """
+    Выдаёт «разрешение на запрос» в порядке приоритета. Ожидающий пропускается
+    (но не теряет место), если его чат ещё не готов — так рассылка не блокирует
+    чужие чаты. Массовый трафик дополнительно ограничен bulk_rate < global_rate,
+    чтобы у интерактива всегда оставался запас. Не-отправки (send=False) берут токены
+    из отдельного service-бюджета и не ждут ни отправок, ни лимитов чата.
+    """
+
+    def __init__(self, global_rate: float, bulk_rate: float, chat_rate: float, chat_burst: float,
+                 group_rate: float, service_rate: float, max_chats: int = 10000):
+        self._global = _Bucket(global_rate, global_rate)
+        self._bulk = _Bucket(bulk_rate, bulk_rate)
+        self._service = _Bucket(service_rate, service_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_chats = max_chats
+        self._chats: OrderedDict[Any, _Bucket] = OrderedDict()
+        self._waiters: list[tuple[int, int, asyncio.Future, bool, Any]] = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.wait_total: dict[str, float] = {p.name: 0.0 for p in ApiPriority}
+        self.wait_max: dict[str, float] = {p.name: 0.0 for p in ApiPriority}
+
+    def _chat_bucket(self, chat_id: Any) -> _Bucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+            bucket = _Bucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _main_bucket(self, send: bool) -> _Bucket:
+        return self._global if send else self._service
+
+    def _try_take(self, priority: ApiPriority, send: bool, chat_id: Any, now: float) -> bool:
+        if not send:
+            self._service.refill(now)
+            if self._service.tokens < 1:
+                return False
+            self._service.tokens -= 1
+            return True
+
+        self._global.refill(now)
+        if self._global.tokens < 1:
+            return False
+        if priority >= ApiPriority.CATCHUP:
+            self._bulk.refill(now)
+            if self._bulk.tokens < 1:
+                return False
+        chat = None
+        if chat_id is not None:
+            chat = self._chat_bucket(chat_id)
+            chat.refill(now)
+            if chat.tokens < 1:
+                return False
+
+        self._global.tokens -= 1
+        if priority >= ApiPriority.CATCHUP:
+            self._bulk.tokens -= 1
+        if chat is not None:
+            chat.tokens -= 1
+        return True
+
+    async def acquire(self, priority: ApiPriority, chat_id: Any = None, send: bool = True) -> None:
+        started = time.monotonic()
+        # быстрый путь: очереди нет и токены есть
+        if not self._waiters and self._try_take(priority, send, chat_id, started):
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (int(priority), self._seq, fut, send, chat_id))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._pump())
+        self._wakeup.set()
+        await fut
+
+        waited = time.monotonic() - started
+        self.wait_total[priority.name] += waited
+        self.wait_max[priority.name] = max(self.wait_max[priority.name], waited)
+
+    def _ready_in(self, priority: ApiPriority, send: bool, chat_id: Any, now: float) -> float:
+        """
+        Через сколько секунд ожидающий сможет взять токены: максимум по всем вёдрам, которые он списывает.
+        """
+        buckets = [self._main_bucket(send)]
+        if send:
+            if priority >= ApiPriority.CATCHUP:
+                buckets.append(self._bulk)
+            chat = self._chats.get(chat_id) if chat_id is not None else None
+            if chat is not None:
+                buckets.append(chat)
+        wait = 0.0
+        for bucket in buckets:
+            bucket.refill(now)
+            wait = max(wait, bucket.wait_time())
+        return wait
+
+    def penalize(self, retry_after: float, send: bool = True, chat_id: Any = None) -> None:
+        """
+        Telegram ответил 429 — замораживаем на retry_after секунд ведро, к которому он относится:
+        лимит конкретного чата, если запрос был в чат, иначе общий бюджет этого вида запросов.
+        Один «горячий» чат так не останавливает рассылку и ответы всем остальным.
+        """
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else self._main_bucket(send)
+        bucket.refill(time.monotonic())
+        bucket.tokens = min(bucket.tokens, -retry_after * bucket.rate)
+
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def _pump(self) -> None:
+        while self._waiters:
+            now = time.monotonic()
+            skipped: list[tuple[int, int, asyncio.Future, bool, Any]] = []
+            exhausted: set[bool] = set()  # виды запросов (send / не send), чей бюджет на этом шаге кончился
+            while self._waiters:
+                item = heapq.heappop(self._waiters)
+                priority, _, fut, send, chat_id = item
+                if fut.done():  # вызывающего отменили
+                    continue
+                if send not in exhausted and self._try_take(ApiPriority(priority), send, chat_id, now):
+                    fut.set_result(None)
+                    continue
+                skipped.append(item)
+                if self._main_bucket(send).tokens < 1:
+                    exhausted.add(send)
+                    if len(exhausted) == 2:
+                        break
+            for item in skipped:
+                heapq.heappush(self._waiters, item)
+            if not self._waiters:
+                break
+            # спим ровно до ближайшего пополнения, которое кого-то из ожидающих разблокирует;
+            # оставшиеся в куче после break ждут исчерпанный общий бюджет — он уже учтён в skipped
+            next_wait = min(
+                self._ready_in(ApiPriority(priority), send, chat_id, now)
+                for priority, _, _, send, chat_id in skipped
+            )
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_wait, 0.005))
+            except asyncio.TimeoutError:
+                pass
 
 
-async def cleanup_user_messages(chat_id: int, user_id: int):
+class ApiRateMiddleware(BaseRequestMiddleware):
     """
-    Удаляем все прошлые сообщения бота для этого пользователя,
-    кроме приветствия.
+    Ставит каждый запрос Bot API в очередь ApiRateScheduler; на 429 ждёт и повторяет.
     """
-    msgs = user_messages.get(user_id, set())
-    greet_id = greeting_messages.get(user_id)
 
-    for mid in list(msgs):
-        if greet_id is not None and mid == greet_id:
-            continue
-        try:
-            await bot.delete_message(chat_id, mid)
-        except Exception:
-            pass
+    def __init__(self, scheduler: ApiRateScheduler, max_retries: int):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
 
-    user_messages[user_id] = set()
-    if greet_id is not None:
-        user_messages[user_id].add(greet_id)
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        name = method.__api_method__
+        if name in _UNLIMITED_METHODS:
+            return await make_request(bot, method)
 
+        send = name.startswith(_CHAT_LIMITED_PREFIXES)
+        chat_id = getattr(method, "chat_id", None) if send else None
+        priority = api_priority.get()
 
-def remember_bot_message(user_id: int, message_id: int):
-    user_messages.setdefault(user_id, set()).add(message_id)
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(priority, chat_id, send)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                metrics.inc("api.retry_after")
+                self.scheduler.penalize(e.retry_after, send, chat_id)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+
+api_rate_scheduler = ApiRateScheduler(
+    API_GLOBAL_RATE, API_BULK_RATE, API_CHAT_RATE, API_CHAT_BURST, API_GROUP_RATE, API_SERVICE_RATE
+)
+api_rate_middleware = ApiRateMiddleware(api_rate_scheduler, API_MAX_RETRIES)
+bot.session.middleware(api_rate_middleware)
+if bulk_bot is not bot:
+    bulk_bot.session.middleware(api_rate_middleware)
 
+metrics.gauge("api.queue_depth", api_rate_scheduler.queue_depth)
+metrics.gauge("api.wait_max_sec", lambda: {k: round(v, 3) for k, v in api_rate_scheduler.wait_max.items()})
 
-def get_main_keyboard(is_admin: bool) -> ReplyKeyboardMarkup:
-    keyboard: list[list[KeyboardButton]] = []
+# ============ СЕРИАЛИЗАЦИЯ ============
+# Один сериализатор на все файлы хранилища. orjson и msgpack — необязательные
+# зависимости: auto берёт orjson, если он есть, иначе json; явно заказанный
+# формат без установленного пакета — ошибка запуска, а не тихая подмена.
+# Чтение определяет формат по первому байту, а файл в другом расширении
+# (после смены STORE_SERIALIZER) подхватывается, пока не перезапишется в новом.
 
-    keyboard.append([KeyboardButton(text="📦 НАЛИЧИЕ СТОКА")])
-    keyboard.append(
-        [
-            KeyboardButton(text="🔥 Отзывы"),
-            KeyboardButton(text="ℹ️ ИНФОРМАЦИЯ ДЛЯ ЗАКАЗА"),
-        ]
-    )
-    keyboard.append(
-        [
-            KeyboardButton(text="📣 ИНФОРМАЦИОННЫЙ КАНАЛ"),
-            KeyboardButton(text="👨‍💻Связь с менеджером"),
-        ]
-    )
+try:
+    import orjson
+except ImportError:  # pragma: no cover - зависит от окружения
+    orjson = None
 
-    if is_admin:
-        keyboard.append(
-            [
-                KeyboardButton(text="📨 Рассылка"),
-                KeyboardButton(text="📊 Статистика"),
-            ]
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - зависит от окружения
+    msgpack = None
+
+
+class JsonSerializer:
+    name = "json"
+
+    def dumps(self, data: Any, compact: bool) -> bytes:
+        if compact:
+            return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+    def loads(self, raw: bytes) -> Any:
+        return json.loads(raw)
+
+
+class OrjsonSerializer:
+    name = "orjson"
+
+    def dumps(self, data: Any, compact: bool) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        return orjson.dumps(data, option=option if compact else option | orjson.OPT_INDENT_2)
+
+    def loads(self, raw: bytes) -> Any:
+        return orjson.loads(raw)
+
+
+class MsgpackSerializer:
+    name = "msgpack"
+
+    def dumps(self, data: Any, compact: bool) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw: bytes) -> Any:
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def make_serializer(name: str):
+    if name == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("Для STORE_SERIALIZER=msgpack нужен пакет msgpack (pip install msgpack).")
+        return MsgpackSerializer()
+    if name == "orjson":
+        if orjson is None:
+            raise RuntimeError("Для STORE_SERIALIZER=orjson нужен пакет orjson (pip install orjson).")
+        return OrjsonSerializer()
+    if name == "auto":
+        return OrjsonSerializer() if orjson is not None else JsonSerializer()
+    if name == "json":
+        return JsonSerializer()
+    raise RuntimeError(f"Неизвестный STORE_SERIALIZER={name}: допустимо auto, json, orjson, msgpack.")
+
+
+serializer = make_serializer(STORE_SERIALIZER)
+# для JSON-строк (WAL, stats.txt, FSM) — всегда JSON, но через orjson, если он есть
+_json_lines = OrjsonSerializer() if orjson is not None else JsonSerializer()
+
+
+def dumps_json(data: Any) -> str:
+    """
+    Компактная JSON-строка (для построчных логов и KV).
+    """
+    return _json_lines.dumps(data, compact=True).decode("utf-8")
+
+
+def loads_json(raw: str | bytes) -> Any:
+    return _json_lines.loads(raw)
+
+
+def _decode_store_file(raw: bytes) -> Any:
+    head = raw.lstrip()[:1]
+    if head in (b"{", b"["):
+        return _json_lines.loads(raw)
+    if msgpack is None:
+        raise ValueError("файл в формате msgpack, а msgpack не установлен")
+    return MsgpackSerializer().loads(raw)
+
+
+# ============ JSON HELPERS ============
+
+class StoreCorruptedError(RuntimeError):
+    """
+    Файл данных не читается или не того формата — запускаться на нём нельзя.
+    """
+
+
+class StoreLockedError(RuntimeError):
+    """
+    WAL уже открыт другим процессом бота на тех же data/.
+    """
+
+
+def _other_format_paths(path: str) -> list[str]:
+    """
+    Тот же файл хранилища в других расширениях — остался от прежнего STORE_SERIALIZER.
+    """
+    stem, ext = os.path.splitext(path)
+    if ext not in STORE_EXTS:
+        return []
+    return [stem + e for e in STORE_EXTS if e != ext]
+
+
+def _load_json(path: str, default: Any, strict: bool = False) -> Any:
+    for candidate in [path, *_other_format_paths(path)]:
+        try:
+            with open(candidate, "rb") as f:
+                raw = f.read()
+            break
+        except FileNotFoundError:
+            continue
+    else:
+        return default
+    path = candidate
+    if not raw.strip():
+        return default
+    try:
+        return _decode_store_file(raw)
+    except ValueError as e:
+        if strict:
+            raise StoreCorruptedError(f"{path}: {e}") from e
+        logging.warning(f"Файл повреждён: {path}. Создаю заново.")
+        return default
+
+
+def _fsync_dir(path: str) -> None:
+    """
+    fsync каталога — чтобы переименование файла в нём пережило падение питания.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # pragma: no cover - Windows не открывает каталоги
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _save_json(path: str, data: Any, durable: bool = False) -> None:
+    """
+    Атомарная запись через .tmp + rename. durable — ещё и fsync файла и каталога
+    (снапшоты хранилища: после них обнуляется WAL).
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(serializer.dumps(data, compact=STORE_COMPACT))
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # файл прежнего формата больше не нужен: иначе после отката STORE_SERIALIZER прочитался бы он
+    for old in _other_format_paths(path):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(old)
+    if durable:
+        _fsync_dir(directory)
+
+
+def ensure_files():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for path in (USERS_FILE, STATS_FILE):
+        if not os.path.exists(path):
+            open(path, "w", encoding="utf-8").close()
+
+    if not _store_file_exists(BROADCASTS_FILE):
+        _save_json(BROADCASTS_FILE, {"broadcasts": []})
+
+    if not _store_file_exists(DELIVERIES_FILE):
+        _save_json(DELIVERIES_FILE, {"deliveries": {}})
+
+    if not _store_file_exists(SCHEDULES_FILE):
+        _save_json(SCHEDULES_FILE, {"schedules": []})
+
+    if not _store_file_exists(RETRIES_FILE):
+        _save_json(RETRIES_FILE, {"retries": {}})
+
+
+def _store_file_exists(path: str) -> bool:
+    # файл в старом расширении тоже считается: пустой новый затёр бы его при чтении
+    return any(os.path.exists(p) for p in [path, *_other_format_paths(path)])
+
+
+# файлы хранилища: чем считать отсутствующий файл и какой ключ верхнего уровня какого типа в нём
+STORE_DEFAULTS: dict[str, Any] = {
+    BROADCASTS_FILE: {"broadcasts": []},
+    DELIVERIES_FILE: {"deliveries": {}},
+    SCHEDULES_FILE: {"schedules": []},
+    RETRIES_FILE: {"retries": {}},
+}
+STORE_SCHEMA: dict[str, tuple[str, type]] = {
+    BROADCASTS_FILE: ("broadcasts", list),
+    DELIVERIES_FILE: ("deliveries", dict),
+    SCHEDULES_FILE: ("schedules", list),
+    RETRIES_FILE: ("retries", dict),
+}
+
+
+def validate_store_file(path: str, data: Any) -> None:
+    """
+    Битые отдельные записи ридеры пропускают сами; здесь — то, после чего
+    ридер вернул бы пустоту и следующий снапшот затёр бы файл.
+    """
+    key, kind = STORE_SCHEMA[path]
+    if not isinstance(data, dict):
+        raise StoreCorruptedError(f"{path}: ожидался объект, а там {type(data).__name__}")
+    if not isinstance(data.get(key, kind()), kind):
+        raise StoreCorruptedError(f"{path}: «{key}» должно быть {kind.__name__}, а там {type(data[key]).__name__}")
+
+
+def _read_broadcasts_file(data: dict[str, Any] | None = None) -> list[dict[str, Any]]:
+    """
+    broadcasts = [{"seq", "archive_message_id", "created_at", "created_by", "expires_at", "expired"}], по возрастанию seq.
+    Старым записям без seq номер присваивается по (created_at, archive_message_id).
+    """
+    if data is None:
+        data = _load_json(BROADCASTS_FILE, {"broadcasts": []})
+    items = data.get("broadcasts", [])
+    if not isinstance(items, list):
+        return []
+    items = [b for b in items if isinstance(b, dict)]
+
+    numbered = [b for b in items if isinstance(b.get("seq"), int)]
+    legacy = sorted(
+        (b for b in items if not isinstance(b.get("seq"), int)),
+        key=lambda b: (b.get("created_at", ""), int(b.get("archive_message_id", 0))),
+    )
+    next_seq = max((b["seq"] for b in numbered), default=0) + 1
+    for b in legacy:
+        b["seq"] = next_seq
+        next_seq += 1
+    return sorted(numbered + legacy, key=lambda b: b["seq"])
+
+
+def _read_next_seq(data: dict[str, Any] | None = None) -> int:
+    """
+    Следующий seq хранится отдельно: после удаления последней рассылки номер не должен повториться,
+    иначе курсоры тех, кто её получил, «покроют» новую.
+    """
+    if data is None:
+        data = _load_json(BROADCASTS_FILE, {"broadcasts": []})
+    try:
+        return int(data.get("next_seq", 1))
+    except Exception:
+        return 1
+
+
+def _read_schedules_file(data: dict[str, Any] | None = None) -> list[dict[str, Any]]:
+    """
+    schedules = [{"job_id", "archive_message_id", "run_at", "created_by", "chat_id", "ttl_days", "status"}]
+    """
+    if data is None:
+        data = _load_json(SCHEDULES_FILE, {"schedules": []})
+    items = data.get("schedules", [])
+    if not isinstance(items, list):
+        return []
+    return [j for j in items if isinstance(j, dict) and isinstance(j.get("archive_message_id"), int)]
+
+
+def _read_retries_file(data: dict[str, Any] | None = None) -> dict[str, dict[str, dict[str, Any]]]:
+    """
+    retries[broadcast_id_str][user_id_str] = {"err", "attempts", "next_at"}
+    next_at — unix-время следующей попытки. Старые записи с next_at=None (больше не повторяем)
+    сюда не попадают — их разбирает _read_unreachable_file.
+    """
+    if data is None:
+        data = _load_json(RETRIES_FILE, {"retries": {}})
+    r = data.get("retries", {})
+    if not isinstance(r, dict):
+        return {}
+    out: dict[str, dict[str, dict[str, Any]]] = {}
+    for bid, users in r.items():
+        if not isinstance(users, dict):
+            continue
+        waiting = {uid: e for uid, e in users.items() if isinstance(e, dict) and e.get("next_at") is not None}
+        if waiting:
+            out[str(bid)] = waiting
+    return out
+
+
+def _read_unreachable_file(data: dict[str, Any] | None = None) -> dict[str, dict[str, Any]]:
+    """
+    unreachable[user_id_str] = {"err", "at"} — пользователи с постоянной ошибкой доставки
+    (заблокировали бота, чата нет). Миграция: из старых записей retries с next_at=None.
+    """
+    if data is None:
+        data = _load_json(RETRIES_FILE, {"retries": {}})
+    raw = data.get("unreachable", {})
+    out = {str(uid): e for uid, e in raw.items() if isinstance(e, dict)} if isinstance(raw, dict) else {}
+    legacy = data.get("retries", {})
+    if isinstance(legacy, dict):
+        for users in legacy.values():
+            if not isinstance(users, dict):
+                continue
+            for uid, e in users.items():
+                if isinstance(e, dict) and e.get("next_at") is None and e.get("err") in PERMANENT_ERRORS:
+                    out.setdefault(str(uid), {"err": e["err"], "at": None})
+    return out
+
+
+def _read_deliveries_file(data: dict[str, Any] | None = None) -> dict[str, dict[str, int]]:
+    """
+    deliveries[user_id_str][broadcast_id_str] = chat_message_id_int
+    """
+    if data is None:
+        data = _load_json(DELIVERIES_FILE, {"deliveries": {}})
+    d = data.get("deliveries", {})
+    if not isinstance(d, dict):
+        return {}
+    cleaned: dict[str, dict[str, int]] = {}
+    for uid, mp in d.items():
+        if not isinstance(mp, dict):
+            continue
+        try:
+            # обычный случай — всё уже нужных типов, одним проходом
+            cleaned[uid] = {str(bid): int(mid) for bid, mid in mp.items()}
+        except (TypeError, ValueError):
+            cleaned[uid] = {}
+            for bid, mid in mp.items():
+                try:
+                    cleaned[uid][str(bid)] = int(mid)
+                except Exception:
+                    continue
+    return cleaned
+
+
+def _read_cursors_file(data: dict[str, Any] | None = None) -> dict[str, dict[str, Any]] | None:
+    """
+    cursors[user_id_str] = {"upto": seq, "extra": [seq, ...]}
+    None — файл ещё без курсоров (старый формат), их надо построить из deliveries.
+    """
+    if data is None:
+        data = _load_json(DELIVERIES_FILE, {"deliveries": {}})
+    c = data.get("cursors")
+    if not isinstance(c, dict):
+        return None
+    cleaned: dict[str, dict[str, Any]] = {}
+    for uid, cur in c.items():
+        if not isinstance(cur, dict):
+            continue
+        try:
+            cleaned[str(uid)] = {"upto": int(cur.get("upto", 0)), "extra": sorted(int(x) for x in cur.get("extra", []))}
+        except Exception:
+            continue
+    return cleaned
+
+
+# ============ ХРАНИЛИЩЕ: WAL + GROUP COMMIT ============
+# Все изменения broadcasts/deliveries/schedules идут через один DataStore:
+# очередь -> WAL (строка JSON) -> один fsync на пачку -> мутация в памяти -> ответ вызывающему.
+# В память попадает только то, что уже лежит на диске. JSON-файлы — это снапшот,
+# их переписываем только при компакции. WAL держит один процесс (эксклюзивный .lock).
+#
+# Рассылки — упорядоченный лог: у каждой монотонный seq. Для догоняющей доставки
+# у пользователя хранится курсор {"upto": N, "extra": [...]}: получил всё до seq N
+# включительно плюс отдельные seq из extra. Что ему не хватает — срез лога после N.
+
+# операции над состоянием: имя -> функция(store, **args); ими же проигрывается WAL
+STORE_OPS: dict[str, Callable[..., Any]] = {}
+
+
+_STORE_OP_SIGNATURES: dict[str, inspect.Signature] = {}
+
+
+def store_op(name: str):
+    def decorator(fn: Callable[..., Any]) -> Callable[..., Any]:
+        STORE_OPS[name] = fn
+        _STORE_OP_SIGNATURES[name] = inspect.signature(fn)
+        return fn
+    return decorator
+
+
+class DataStore:
+    def __init__(self, wal_path: str, batch_max: int, compact_every: int, compact_interval: float):
+        self.wal_path = wal_path
+        self.batch_max = batch_max
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+
+        self.broadcasts: list[dict[str, Any]] = []
+        self.deliveries: dict[str, dict[str, int]] = {}
+        self.cursors: dict[str, dict[str, Any]] = {}
+        self.schedules: dict[str, dict[str, Any]] = {}
+        self.retries: dict[str, dict[str, dict[str, Any]]] = {}
+        self.unreachable: dict[str, dict[str, Any]] = {}
+
+        # сколько пользователей получили рассылку: broadcast_id -> count
+        self.delivery_counts: dict[str, int] = {}
+
+        # индекс лога: отсортированные seq, broadcast_id -> seq, created_at (seq растёт вместе со временем)
+        # и то же по авторам — для постраничного списка без сортировки
+        self.next_seq = 1
+        self._seqs: list[int] = []
+        self._seq_by_id: dict[str, int] = {}
+        self._created: list[str] = []
+        self._by_author: dict[int, list[dict[str, Any]]] = {}
+        self._author_seqs: dict[int, list[int]] = {}
+
+        self._loaded = False
+        self._wal_records = 0
+        self._lock_file = None
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    # ---------- чтение ----------
+
+    def ensure_loaded(self, files: dict[str, Any] | None = None) -> None:
+        """
+        files — уже прочитанные файлы (путь -> данные) из прогрева при старте;
+        без них читаем сами, по одному разу.
+        """
+        if self._loaded:
+            return
+        ensure_files()
+        self._lock_wal()
+        if files is None:
+            files = {path: _load_json(path, default) for path, default in STORE_DEFAULTS.items()}
+        broadcasts_data = files[BROADCASTS_FILE]
+        self.broadcasts = _read_broadcasts_file(broadcasts_data)
+        self.next_seq = _read_next_seq(broadcasts_data)
+        self.reindex()
+        deliveries_data = files[DELIVERIES_FILE]
+        self.deliveries = _read_deliveries_file(deliveries_data)
+        self.delivery_counts = {}
+        for mp in self.deliveries.values():
+            for bid in mp:
+                self.delivery_counts[bid] = self.delivery_counts.get(bid, 0) + 1
+        cursors = _read_cursors_file(deliveries_data)
+        self.cursors = cursors if cursors is not None else self._cursors_from_deliveries()
+        self.schedules = {str(j.get("job_id", j["archive_message_id"])): j for j in _read_schedules_file(files[SCHEDULES_FILE])}
+        self.retries = _read_retries_file(files[RETRIES_FILE])
+        self.unreachable = _read_unreachable_file(files[RETRIES_FILE])
+        self._wal_records = self._replay_wal()
+        self._loaded = True
+
+    def reindex(self) -> None:
+        self._seqs = [b["seq"] for b in self.broadcasts]
+        self._seq_by_id = {str(b.get("archive_message_id")): b["seq"] for b in self.broadcasts}
+        self._created = [str(b.get("created_at", "")) for b in self.broadcasts]
+        self._by_author = {}
+        self._author_seqs = {}
+        for b in self.broadcasts:
+            self._index_author(b)
+        self.next_seq = max(self.next_seq, (self._seqs[-1] + 1) if self._seqs else 1)
+
+    def _index_author(self, b: dict[str, Any]) -> None:
+        author = b.get("created_by")
+        if isinstance(author, int):
+            self._by_author.setdefault(author, []).append(b)
+            self._author_seqs.setdefault(author, []).append(b["seq"])
+
+    def page(
+        self, before: int | None, after: int | None, author: int | None, size: int
+    ) -> tuple[list[dict[str, Any]], bool, bool]:
+        """
+        Страница лога: size рассылок с seq < before (или > after), от новых к старым.
+        O(log n + size). Возвращает (рассылки, есть новее, есть старее).
+        """
+        if author is None:
+            seqs, records = self._seqs, self.broadcasts
+        else:
+            seqs, records = self._author_seqs.get(author, []), self._by_author.get(author, [])
+        if after is not None:
+            lo = bisect.bisect_right(seqs, after)
+            hi = min(len(seqs), lo + size)
+        else:
+            hi = len(seqs) if before is None else bisect.bisect_left(seqs, before)
+            lo = max(0, hi - size)
+        return records[lo:hi][::-1], hi < len(seqs), lo > 0
+
+    def seq_cursor_for_day(self, day: str) -> int:
+        """
+        Курсор «до конца дня day (YYYY-MM-DD) включительно» для page(before=...).
+        """
+        i = bisect.bisect_right(self._created, day + "T23:59:59")
+        return self._seqs[i] if i < len(self._seqs) else self.next_seq
+
+    def _cursors_from_deliveries(self) -> dict[str, dict[str, Any]]:
+        """
+        Миграция со старого формата: курсоры по тому, что уже записано в deliveries.
+        """
+        cursors: dict[str, dict[str, Any]] = {}
+        for uid, mp in self.deliveries.items():
+            cur = {"upto": 0, "extra": sorted(self._seq_by_id[b] for b in mp if b in self._seq_by_id)}
+            self.normalize_cursor(cur)
+            cursors[uid] = cur
+        return cursors
+
+    def seq_of(self, broadcast_id: str) -> int | None:
+        return self._seq_by_id.get(broadcast_id)
+
+    def normalize_cursor(self, cur: dict[str, Any]) -> None:
+        """
+        Сдвигает upto вперёд, пока следующая по логу рассылка уже есть в extra.
+        Удалённые рассылки в логе отсутствуют, поэтому «дыры» в seq не мешают.
+        """
+        extra = set(cur["extra"])
+        upto = cur["upto"]
+        i = bisect.bisect_right(self._seqs, upto)
+        while i < len(self._seqs) and self._seqs[i] in extra:
+            upto = self._seqs[i]
+            i += 1
+        cur["upto"] = upto
+        cur["extra"] = sorted(x for x in extra if x > upto)
+
+    def has_seq(self, user_id: str, seq: int) -> bool:
+        cur = self.cursors.get(user_id)
+        if cur is None:
+            return False
+        return seq <= cur["upto"] or seq in cur["extra"]
+
+    def missing_for(self, user_id: str) -> list[dict[str, Any]]:
+        """
+        Рассылки, которых у пользователя нет, в порядке лога: O(log n + пропущенные).
+        """
+        cur = self.cursors.get(user_id) or {"upto": 0, "extra": []}
+        extra = set(cur["extra"])
+        start = bisect.bisect_right(self._seqs, cur["upto"])
+        return [b for b in self.broadcasts[start:] if b["seq"] not in extra]
+
+    def _lock_wal(self) -> None:
+        """
+        Эксклюзивная блокировка рядом с WAL на всё время жизни процесса.
+        Бот рассчитан на один экземпляр на data/: кроме WAL и снапшотов, в памяти
+        процесса живут активные рассылки и очередь отложенных — вторая копия
+        разослала бы их ещё раз. Поэтому второй запуск не «масштабирует», а отказывается стартовать.
+        """
+        if self._lock_file is not None or fcntl is None:
+            return
+        f = open(self.wal_path + ".lock", "a")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise StoreLockedError(f"{self.wal_path} занят другим процессом бота")
+        self._lock_file = f
+
+    def _replay_wal(self) -> int:
+        """
+        Проигрывает WAL поверх снапшота. Допустима только оборванная последняя строка
+        (упали посреди write — её никто не подтверждал); битая строка в середине
+        или операция, которая не применяется, — StoreCorruptedError: иначе все
+        записи после неё молча пропали бы, а следующая компакция закрепила бы потерю.
+        """
+        try:
+            with open(self.wal_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        raw_lines = data.split(b"\n")
+        # после последнего "\n" — либо пусто, либо недописанная запись
+        torn = raw_lines.pop()
+        applied = 0
+        for lineno, raw in enumerate(raw_lines, 1):
+            line = raw.strip()
+            if not line:
+                continue
+            try:
+                rec = loads_json(line)
+            except ValueError as e:
+                raise StoreCorruptedError(f"{self.wal_path}:{lineno}: битая запись ({e})") from e
+            op = rec.get("op") if isinstance(rec, dict) else None
+            fn = STORE_OPS.get(op)
+            if fn is None:
+                raise StoreCorruptedError(f"{self.wal_path}:{lineno}: неизвестная операция {op!r}")
+            try:
+                fn(self, **rec.get("args", {}))
+            except Exception as e:
+                raise StoreCorruptedError(f"{self.wal_path}:{lineno}: {op} не применяется ({e!r})") from e
+            applied += 1
+        if torn:
+            # обрезаем хвост, иначе следующая пачка допишется в ту же строку и испортит её
+            logging.warning(f"WAL: отбрасываю оборванную последнюю запись в {self.wal_path}")
+            with open(self.wal_path, "r+b") as f:
+                f.truncate(len(data) - len(torn))
+                os.fsync(f.fileno())
+        if applied:
+            logging.info(f"WAL: восстановлено {applied} операций")
+        return applied
+
+    # ---------- запись ----------
+
+    def start(self) -> None:
+        self.ensure_loaded()
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._writer())
+
+    async def submit(self, op: str, **args: Any) -> Any:
+        if op not in STORE_OPS:
+            raise ValueError(f"Неизвестная операция хранилища: {op}")
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, args, fut))
+        return await fut
+
+    async def close(self) -> None:
+        """
+        Дописывает очередь и сбрасывает снапшот (при остановке бота).
+        """
+        if self._task is not None:
+            await self._queue.join()
+            self._task.cancel()
+            self._task = None
+        if self._loaded and self._wal_records:
+            await asyncio.to_thread(self.compact)
+
+    async def _writer(self) -> None:
+        while True:
+            try:
+                first = await asyncio.wait_for(self._queue.get(), timeout=self.compact_interval)
+            except asyncio.TimeoutError:
+                if self._wal_records:
+                    await asyncio.to_thread(self.compact)
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_max and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                force_compact = await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if force_compact or self._wal_records >= self.compact_every:
+                await asyncio.to_thread(self.compact)
+
+    async def _commit(self, batch: list[tuple[str, dict[str, Any], asyncio.Future]]) -> bool:
+        """
+        Пачка: сначала WAL + fsync, потом мутации в памяти в том же порядке, что и при проигрывании.
+        Возвращает True, если нужен внеочередной снапшот.
+        """
+        lines: list[str] = []
+        ready: list[tuple[str, dict[str, Any], asyncio.Future]] = []
+        for op, args, fut in batch:
+            try:
+                _STORE_OP_SIGNATURES[op].bind(self, **args)
+                lines.append(dumps_json({"op": op, "args": args}) + "\n")
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            ready.append((op, args, fut))
+        if not lines:
+            return False
+
+        try:
+            await asyncio.to_thread(self._append_wal, "".join(lines))
+        except Exception as e:
+            logging.exception("WAL: не удалось записать пачку — в памяти ничего не меняю")
+            for _, _, fut in ready:
+                if not fut.done():
+                    fut.set_exception(e)
+            return False
+        self._wal_records += len(lines)
+        metrics.inc("store.batches")
+        metrics.inc("store.ops", len(lines))
+
+        force_compact = False
+        for op, args, fut in ready:
+            try:
+                result = STORE_OPS[op](self, **args)
+            except Exception as e:
+                # запись уже в WAL, но не применилась: снапшот сразу, иначе при запуске
+                # проигрывание WAL споткнётся о неё же
+                logging.exception(f"WAL: операция {op} записана, но не применилась")
+                force_compact = True
+                if not fut.done():
+                    fut.set_exception(e)
+                continue
+            if not fut.done():
+                fut.set_result(result)
+        return force_compact
+
+    def _append_wal(self, data: str) -> None:
+        with open(self.wal_path, "ab") as f:
+            size = f.tell()
+            try:
+                f.write(data.encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError:
+                # недописанный кусок посреди WAL при запуске сочли бы повреждением
+                with contextlib.suppress(OSError):
+                    f.truncate(size)
+                raise
+
+    def compact(self) -> None:
+        """
+        Снапшот состояния в JSON-файлы и обнуление WAL.
+        Вызывается только из писателя (или когда он остановлен), так что состояние не меняется под ногами.
+        """
+        # снапшоты — с fsync файла и каталога: WAL обнуляем, только когда они точно на диске
+        _save_json(BROADCASTS_FILE, {"broadcasts": self.broadcasts, "next_seq": self.next_seq}, durable=True)
+        _save_json(DELIVERIES_FILE, {"deliveries": self.deliveries, "cursors": self.cursors}, durable=True)
+        _save_json(SCHEDULES_FILE, {"schedules": list(self.schedules.values())}, durable=True)
+        _save_json(RETRIES_FILE, {"retries": self.retries, "unreachable": self.unreachable}, durable=True)
+        with open(self.wal_path, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._wal_records = 0
+        metrics.inc("store.compactions")
+
+
+@store_op("add_broadcast")
+def _op_add_broadcast(st: DataStore, record: dict[str, Any]) -> bool:
+    bid = str(record.get("archive_message_id"))
+    if bid in st._seq_by_id:
+        return False
+    # seq выдаётся здесь, в писателе, — при проигрывании WAL получится тот же номер
+    seq = st.next_seq
+    b = {**record, "seq": seq}
+    st.broadcasts.append(b)
+    st._seqs.append(seq)
+    st._seq_by_id[bid] = seq
+    st._created.append(str(b.get("created_at", "")))
+    st._index_author(b)
+    st.next_seq = seq + 1
+    return True
+
+
+def _drop_broadcasts(st: DataStore, broadcast_ids: set[str]) -> None:
+    seqs = {st.seq_of(bid) for bid in broadcast_ids} - {None}
+    st.broadcasts = [b for b in st.broadcasts if str(b.get("archive_message_id")) not in broadcast_ids]
+    st.reindex()
+    if seqs:
+        for cur in st.cursors.values():
+            if any(x in seqs for x in cur["extra"]):
+                cur["extra"] = [x for x in cur["extra"] if x not in seqs]
+    for uid in list(st.deliveries.keys()):
+        mp = st.deliveries[uid]
+        for bid in broadcast_ids:
+            mp.pop(bid, None)
+        if not mp:
+            st.deliveries.pop(uid, None)
+    for bid in broadcast_ids:
+        st.retries.pop(bid, None)
+        st.delivery_counts.pop(bid, None)
+
+
+@store_op("remove_broadcast")
+def _op_remove_broadcast(st: DataStore, broadcast_id: str) -> None:
+    _drop_broadcasts(st, {broadcast_id})
+
+
+@store_op("expire_broadcasts")
+def _op_expire_broadcasts(st: DataStore, broadcast_ids: list[str]) -> list[str]:
+    """
+    Истёкшие рассылки больше не догоняют и не повторяются. Запись и deliveries остаются,
+    пока сообщение лежит хоть у кого-то в чате, — иначе его нельзя будет удалить или изменить.
+    Совсем убираются только рассылки, которых ни у кого нет. Возвращает убранные.
+    """
+    ids = set(broadcast_ids)
+    dropped = {bid for bid in ids if not st.delivery_counts.get(bid)}
+    for b in st.broadcasts:
+        if str(b.get("archive_message_id")) in ids:
+            b["expired"] = True
+    for bid in ids:
+        st.retries.pop(bid, None)
+    if dropped:
+        _drop_broadcasts(st, dropped)
+    return sorted(dropped)
+
+
+@store_op("skip_catchup")
+def _op_skip_catchup(st: DataStore, user_id: str, seqs: list[int]) -> None:
+    """
+    Рассылки, которые пользователю уже не отправим (истекли или сверх CATCHUP_MAX):
+    двигаем курсор, чтобы не перебирать их на каждом /start.
+    """
+    cur = st.cursors.setdefault(user_id, {"upto": 0, "extra": []})
+    cur["extra"].extend(x for x in seqs if x > cur["upto"])
+    st.normalize_cursor(cur)
+
+
+@store_op("mark_delivered")
+def _op_mark_delivered(st: DataStore, user_id: str, items: dict[str, int]) -> None:
+    mp = st.deliveries.setdefault(user_id, {})
+    cur = st.cursors.setdefault(user_id, {"upto": 0, "extra": []})
+    for broadcast_id, chat_message_id in items.items():
+        if broadcast_id not in mp:
+            st.delivery_counts[broadcast_id] = st.delivery_counts.get(broadcast_id, 0) + 1
+        mp[broadcast_id] = int(chat_message_id)
+        _drop_retry(st, broadcast_id, user_id)
+        seq = st.seq_of(broadcast_id)
+        if seq is not None and seq > cur["upto"]:
+            cur["extra"].append(seq)
+    st.normalize_cursor(cur)
+
+
+def _drop_retry(st: DataStore, broadcast_id: str, user_id: str) -> None:
+    failed = st.retries.get(broadcast_id)
+    if failed and failed.pop(user_id, None) is not None and not failed:
+        del st.retries[broadcast_id]
+
+
+@store_op("retry_put")
+def _op_retry_put(st: DataStore, broadcast_id: str, user_id: str, entry: dict[str, Any]) -> None:
+    st.retries.setdefault(broadcast_id, {})[user_id] = entry
+
+
+@store_op("retry_drop")
+def _op_retry_drop(st: DataStore, broadcast_id: str, user_id: str) -> None:
+    _drop_retry(st, broadcast_id, user_id)
+
+
+@store_op("mark_unreachable")
+def _op_mark_unreachable(st: DataStore, user_id: str, err: str, at: str) -> None:
+    """
+    Одна запись на пользователя вместо записи на каждую рассылку; его повторы снимаются.
+    """
+    st.unreachable[user_id] = {"err": err, "at": at}
+    for bid in [bid for bid, users in st.retries.items() if user_id in users]:
+        _drop_retry(st, bid, user_id)
+
+
+@store_op("mark_reachable")
+def _op_mark_reachable(st: DataStore, user_id: str) -> None:
+    st.unreachable.pop(user_id, None)
+
+
+@store_op("schedule_put")
+def _op_schedule_put(st: DataStore, job: dict[str, Any]) -> None:
+    st.schedules[str(job["job_id"])] = job
+
+
+@store_op("schedule_remove")
+def _op_schedule_remove(st: DataStore, job_id: str) -> dict[str, Any] | None:
+    return st.schedules.pop(job_id, None)
+
+
+store = DataStore(WAL_FILE, WAL_BATCH_MAX, WAL_COMPACT_EVERY, WAL_COMPACT_INTERVAL)
+metrics.gauge("store.wal_records", lambda: store._wal_records)
+
+
+def load_broadcasts() -> list[dict[str, Any]]:
+    store.ensure_loaded()
+    return list(store.broadcasts)
+
+
+def load_schedules() -> list[dict[str, Any]]:
+    store.ensure_loaded()
+    return list(store.schedules.values())
+
+
+def load_deliveries() -> dict[str, dict[str, int]]:
+    """
+    deliveries[user_id_str][broadcast_id_str] = chat_message_id_int
+    Живое состояние хранилища — только читать, менять через mark_delivered / remove_broadcast.
+    """
+    store.ensure_loaded()
+    return store.deliveries
+
+
+def was_delivered(user_id: int, broadcast_id: str) -> bool:
+    store.ensure_loaded()
+    seq = store.seq_of(broadcast_id)
+    if seq is None:
+        return broadcast_id in store.deliveries.get(str(user_id), {})
+    return store.has_seq(str(user_id), seq)
+
+
+def broadcast_expires_at(b: dict[str, Any]) -> datetime | None:
+    """
+    Когда рассылка перестаёт догонять новых пользователей. None — никогда.
+    Старые записи без expires_at (до появления TTL) не истекают: их отправляли как бессрочные.
+    """
+    raw = b.get("expires_at")
+    try:
+        return datetime.fromisoformat(raw) if raw else None
+    except ValueError:
+        return None
+
+
+def broadcast_expired(b: dict[str, Any], now: datetime) -> bool:
+    expires = broadcast_expires_at(b)
+    return expires is not None and expires <= now
+
+
+def plan_catchup(user_id: int) -> tuple[list[int], list[int]]:
+    """
+    Что отправить пользователю на /start: (archive_message_id в порядке отправки, seq пропускаемых).
+    Пропускаются истёкшие рассылки и всё, что старше последних CATCHUP_MAX.
+    """
+    store.ensure_loaded()
+    now = datetime.now()
+    to_send: list[dict[str, Any]] = []
+    skipped: list[int] = []
+    for b in store.missing_for(str(user_id)):
+        if broadcast_expired(b, now) or not isinstance(b.get("archive_message_id"), int):
+            skipped.append(b["seq"])
+        else:
+            to_send.append(b)
+
+    if CATCHUP_MAX > 0 and len(to_send) > CATCHUP_MAX:
+        skipped.extend(b["seq"] for b in to_send[:-CATCHUP_MAX])
+        to_send = to_send[-CATCHUP_MAX:]
+
+    return [b["archive_message_id"] for b in to_send], skipped
+
+
+async def skip_catchup(user_id: int, seqs: list[int]) -> None:
+    if seqs:
+        await store.submit("skip_catchup", user_id=str(user_id), seqs=seqs)
+
+
+async def prune_expired_broadcasts() -> int:
+    """
+    Помечает истёкшие рассылки (больше не догоняют, не повторяются) и убирает из архива
+    те, что ни у кого не лежат в чате. Доставленные остаются в deliveries —
+    их по-прежнему можно удалить или изменить у всех.
+    """
+    now = datetime.now()
+    expired = [
+        str(b["archive_message_id"])
+        for b in load_broadcasts()
+        if not b.get("expired") and broadcast_expired(b, now)
+    ]
+    if expired:
+        dropped = await store.submit("expire_broadcasts", broadcast_ids=expired)
+        metrics.inc("broadcasts.expired", len(expired))
+        logging.info(
+            f"Истекли рассылки: {', '.join(expired)}"
+            + (f" (убраны из архива, ни у кого нет: {', '.join(dropped)})" if dropped else "")
+        )
+    return len(expired)
+
+
+async def broadcast_pruner() -> None:
+    while True:
+        try:
+            await prune_expired_broadcasts()
+        except Exception:
+            logging.exception("Не удалось убрать истёкшие рассылки")
+        await asyncio.sleep(BROADCAST_PRUNE_INTERVAL)
+
+
+async def add_broadcast(record: dict[str, Any]) -> bool:
+    return await store.submit("add_broadcast", record=record)
+
+
+async def remove_broadcast(broadcast_id: str) -> None:
+    """
+    Убирает рассылку из архива и все её доставки.
+    """
+    await store.submit("remove_broadcast", broadcast_id=broadcast_id)
+
+
+async def mark_delivered(user_id: int, broadcast_id: str, chat_message_id: int) -> None:
+    await store.submit("mark_delivered", user_id=str(user_id), items={broadcast_id: int(chat_message_id)})
+
+
+async def mark_delivered_many(user_id: int, mapping: dict[str, int]) -> None:
+    """
+    Одна запись в хранилище на пачку доставок (broadcast_id -> message_id).
+    """
+    if not mapping:
+        return
+    await store.submit("mark_delivered", user_id=str(user_id), items={k: int(v) for k, v in mapping.items()})
+
+
+def pending_recipients(broadcast_id: str) -> list[int]:
+    """
+    Пользователи из users.txt, которым рассылка ещё не доставлена, кроме недоступных
+    (заблокировали бота, чата нет — до их следующего /start). Вызывать через offload.
+    """
+    unreachable = store.unreachable
+    return [
+        uid for uid in get_user_ids()
+        if str(uid) not in unreachable and not was_delivered(uid, broadcast_id)
+    ]
+
+
+def delivery_targets(broadcast_id: str) -> list[tuple[int, int]]:
+    """
+    (user_id, message_id) всех получателей рассылки. Вызывать через offload:
+    обход всего deliveries, пока цикл может дописывать новые доставки.
+    """
+    targets: list[tuple[int, int]] = []
+    for uid, mp in list(load_deliveries().items()):
+        mid = mp.get(broadcast_id)
+        if mid is not None:
+            targets.append((int(uid), int(mid)))
+    return targets
+
+
+def get_user_ids() -> list[int]:
+    user_ids: list[int] = []
+    try:
+        with open(USERS_FILE, "r", encoding="utf-8") as f:
+            for idx, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                if idx == 0 and line.lower().startswith("user_id"):
+                    continue
+                parts = [p.strip() for p in line.split("|")]
+                if not parts:
+                    continue
+                uid_str = parts[0]
+                if uid_str.isdigit():
+                    user_ids.append(int(uid_str))
+    except FileNotFoundError:
+        pass
+    return user_ids
+
+
+# =======================================================
+# ✅ ВАЖНОЕ: "СОХРАНИТЬ В ОТКАТЫ БЕЗ ПЕРЕСЛАНО"
+# =======================================================
+async def copy_to_archive(src: types.Message) -> types.Message:
+    """
+    Копируем сообщение в архив (Откаты) через copy_message.
+    Тогда в Откатах и у пользователей НЕ будет строки "Переслано ...".
+    Premium/кастом эмодзи при этом НЕ сохраняются (и это ок по твоему ТЗ сейчас).
+    """
+    if settings.archive_chat_id is None:
+        raise RuntimeError("ARCHIVE_CHAT_ID не задан")
+
+    res = await bot.copy_message(
+        chat_id=settings.archive_chat_id,
+        from_chat_id=src.chat.id,
+        message_id=src.message_id,
+    )
+
+    mid = getattr(res, "message_id", None)
+    if mid is None:
+        # на всякий случай
+        mid = int(res)
+
+    # Возвращаем "фейковый Message" не надо — нам достаточно message_id,
+    # но типом пусть будет Message для совместимости — сделаем простой объект-обёртку
+    # (в aiogram copy_message возвращает MessageId).
+    dummy = types.Message(message_id=int(mid), date=datetime.now(), chat=types.Chat(id=settings.archive_chat_id, type="supergroup"))
+    return dummy
+
+
+async def copy_from_archive_to_chat(chat_id: int, archive_message_id: int, via: Bot | None = None) -> int:
+    """
+    Копия из архива в нужный чат (без "Переслано").
+    Возвращает message_id в целевом чате.
+    via — через какой Bot слать (для рассылок — bulk_bot).
+    """
+    if settings.archive_chat_id is None:
+        raise RuntimeError("ARCHIVE_CHAT_ID не задан")
+
+    res = await (via or bot).copy_message(
+        chat_id=chat_id,
+        from_chat_id=settings.archive_chat_id,
+        message_id=archive_message_id,
+    )
+    mid = getattr(res, "message_id", None)
+    if mid is None:
+        mid = int(res)
+    return int(mid)
+
+
+async def copy_many_from_archive_to_chat(chat_id: int, archive_message_ids: list[int]) -> list[int]:
+    """
+    Пачка копий из архива одним вызовом copyMessages (до 100 штук, id строго по возрастанию).
+    Возвращает message_id в целевом чате в том же порядке.
+    """
+    if settings.archive_chat_id is None:
+        raise RuntimeError("ARCHIVE_CHAT_ID не задан")
+
+    res = await bot.copy_messages(
+        chat_id=chat_id,
+        from_chat_id=settings.archive_chat_id,
+        message_ids=archive_message_ids,
+    )
+    return [int(r.message_id) for r in res]
+
+
+def _split_copy_batches(archive_mids: list[int]) -> list[list[int]]:
+    """
+    Режет список на пачки для copyMessages, не меняя порядок доставки:
+    внутри пачки id должны строго возрастать и их не больше COPY_BATCH_SIZE.
+    """
+    batches: list[list[int]] = []
+    for mid in archive_mids:
+        if batches and len(batches[-1]) < COPY_BATCH_SIZE and mid > batches[-1][-1]:
+            batches[-1].append(mid)
+        else:
+            batches.append([mid])
+    return batches
+
+
+async def send_missing_broadcasts_to_user(user_id: int) -> None:
+    """
+    На /start отправляет пользователю рассылки из архива, которых он ещё не получал
+    (не истёкшие и не больше CATCHUP_MAX последних).
+    Отправка идёт пачками через copyMessages => нет "переслано" и меньше запросов.
+    Поштучный copy_message — только если пачка не прошла.
+    """
+    if settings.archive_chat_id is None:
+        return
+
+    # срез лога после курсора пользователя — без перебора всего архива
+    missing, skipped = plan_catchup(user_id)
+    await skip_catchup(user_id, skipped)
+    if not missing:
+        return
+
+    delivered: dict[str, int] = {}
+    with api_priority_scope(ApiPriority.CATCHUP):
+        for batch in _split_copy_batches(missing):
+            new_mids: list[int] = []
+            try:
+                new_mids = await copy_many_from_archive_to_chat(user_id, batch)
+            except Exception:
+                pass
+
+            if len(new_mids) == len(batch):
+                delivered.update({str(mid): new_mid for mid, new_mid in zip(batch, new_mids)})
+                continue
+
+            # Telegram пропускает сообщения, которые нельзя скопировать, и по ответу
+            # не понять, какие именно. Убираем частичную копию и идём поштучно.
+            if new_mids:
+                try:
+                    await bot.delete_messages(chat_id=user_id, message_ids=new_mids)
+                except Exception:
+                    pass
+
+            stopped = False
+            for archive_mid in batch:
+                try:
+                    delivered[str(archive_mid)] = await copy_from_archive_to_chat(user_id, archive_mid)
+                except Exception:
+                    stopped = True
+                    break
+            if stopped:
+                break
+
+    await mark_delivered_many(user_id, delivered)
+
+
+async def delete_broadcast_everywhere(broadcast_id: str) -> tuple[int, int]:
+    """
+    Удаляет рассылку у всех пользователей и из архива.
+    Возвращает (успешно удалено, ошибок).
+    """
+    ok = 0
+    fail = 0
+
+    if settings.archive_chat_id is None:
+        return 0, 0
+
+    store.ensure_loaded()
+    targets = await offload(delivery_targets, broadcast_id)
+
+    # 1) удалить у пользователей (темп задаёт ApiRateScheduler)
+    with api_priority_scope(ApiPriority.BULK):
+        for uid, mid in targets:
+            try:
+                await bulk_bot.delete_message(chat_id=uid, message_id=mid)
+                ok += 1
+            except Exception:
+                fail += 1
+
+    # 2) удалить из архива
+    try:
+        await bot.delete_message(chat_id=settings.archive_chat_id, message_id=int(broadcast_id))
+    except Exception:
+        pass
+
+    # 3) убрать из архива рассылок и доставок
+    await remove_broadcast(broadcast_id)
+
+    return ok, fail
+
+
+async def edit_archive_message(archive_mid: int, text: str) -> str:
+    """
+    Меняет текст сообщения в Откатах. Возвращает "text" или "caption" —
+    в зависимости от того, что было у сообщения (так же будем править у получателей).
+    """
+    try:
+        await bot.edit_message_text(chat_id=settings.archive_chat_id, message_id=archive_mid, text=text)
+        return "text"
+    except TelegramBadRequest as e:
+        err = str(e).lower()
+        if "not modified" in err:
+            return "text"
+        if "no text" not in err:
+            raise
+
+    try:
+        await bot.edit_message_caption(chat_id=settings.archive_chat_id, message_id=archive_mid, caption=text)
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return "caption"
+
+
+async def edit_broadcast_everywhere(broadcast_id: str, text: str, kind: str) -> tuple[int, int]:
+    """
+    Правит уже доставленную рассылку у всех получателей из deliveries:
+    один editMessageText / editMessageCaption на получателя, без повторных уведомлений.
+    Параллельно не больше BROADCAST_EDIT_CONCURRENCY, темп — по бюджету BULK в ApiRateScheduler.
+    Возвращает (успешно, ошибок).
+    """
+    store.ensure_loaded()
+    targets = await offload(delivery_targets, broadcast_id)
+
+    sem = asyncio.Semaphore(BROADCAST_EDIT_CONCURRENCY)
+    ok = 0
+    fail = 0
+
+    async def _edit(uid: int, mid: int) -> None:
+        nonlocal ok, fail
+        async with sem:
+            try:
+                if kind == "caption":
+                    await bulk_bot.edit_message_caption(chat_id=uid, message_id=mid, caption=text)
+                else:
+                    await bulk_bot.edit_message_text(chat_id=uid, message_id=mid, text=text)
+                ok += 1
+            except TelegramBadRequest as e:
+                if "not modified" in str(e).lower():
+                    ok += 1
+                else:
+                    fail += 1
+            except Exception:
+                fail += 1
+
+    with api_priority_scope(ApiPriority.BULK):
+        await asyncio.gather(*(_edit(uid, mid) for uid, mid in targets))
+    return ok, fail
+
+
+class BroadcastProgress:
+    """
+    Идущая рассылка: счётчики для живого прогресса и флаг «⏹ Стоп».
+    """
+
+    def __init__(self, broadcast_id: str, total: int, chat_id: int | None):
+        self.broadcast_id = broadcast_id
+        self.total = total
+        self.chat_id = chat_id
+        self.sent = 0
+        self.failed = 0
+        self.retrying = 0  # из failed: временные ошибки, ушли в очередь повтора
+        self.skipped = 0   # уже получили (догоняющая на /start) или стали недоступны по ходу рассылки
+        self.stopped = False
+        self.started = time.monotonic()
+        self.message_id: int | None = None
+        self._last_render = 0.0
+        self._last_pct = 0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.skipped
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def render(self, final: bool = False) -> str:
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        rate = self.processed / elapsed
+        remaining = max(self.total - self.processed, 0)
+        eta = int(remaining / rate) if rate > 0 else 0
+
+        if final:
+            title = "⏹ <b>Рассылка остановлена</b>" if self.stopped else "✅ <b>Рассылка отправлена</b>"
+        else:
+            title = "📤 <b>Рассылка идёт...</b>"
+        return (
+            f"{title}\n\n"
+            f"🗂 ID: <code>{self.broadcast_id}</code>\n"
+            f"📬 Отправлено: <b>{self.sent}</b>\n"
+            f"⚠️ Ошибок: <b>{self.failed}</b>\n"
+            + (f"⏭ Пропущено (уже получили): <b>{self.skipped}</b>\n" if self.skipped else "")
+            + f"⏳ Осталось: <b>{remaining}</b> из {self.total}\n"
+            f"⚡ Скорость: <b>{rate:.1f}</b> сообщ./сек\n"
+            + ("" if final else f"🕒 Осталось примерно: <b>{eta // 60}:{eta % 60:02d}</b>")
+        )
+
+    def stop_kb(self) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="⏹ Стоп", callback_data=f"broadcast_stop:{self.broadcast_id}")]
+            ]
+        )
+
+    async def start(self, admin_id: int) -> None:
+        if self.chat_id is None:
+            return
+        try:
+            msg = await bot.send_message(chat_id=self.chat_id, text=self.render(), reply_markup=self.stop_kb())
+            self.message_id = msg.message_id
+            await remember_bot_message(admin_id, msg.message_id)
+        except Exception:
+            pass
+        self._last_render = time.monotonic()
+
+    async def tick(self) -> None:
+        """
+        Обновляет сообщение не чаще раза в BROADCAST_PROGRESS_INTERVAL секунд
+        или при каждом новом шаге в BROADCAST_PROGRESS_STEP процентов.
+        """
+        if self.message_id is None or not self.total:
+            return
+        now = time.monotonic()
+        pct = self.processed * 100 // self.total
+        if now - self._last_render < BROADCAST_PROGRESS_INTERVAL and pct < self._last_pct + BROADCAST_PROGRESS_STEP:
+            return
+        # не чаще раза в секунду, даже если проценты бегут быстро
+        if now - self._last_render < 1:
+            return
+        self._last_render = now
+        self._last_pct = pct
+        try:
+            await bot.edit_message_text(
+                chat_id=self.chat_id, message_id=self.message_id, text=self.render(), reply_markup=self.stop_kb()
+            )
+        except Exception:
+            pass
+
+    async def finish(self) -> None:
+        if self.message_id is None:
+            return
+        try:
+            await bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=self.render(final=True))
+        except Exception:
+            pass
+
+
+# идущие рассылки: broadcast_id -> прогресс (для кнопки «⏹ Стоп»)
+active_broadcasts: dict[str, BroadcastProgress] = {}
+
+
+async def run_broadcast(
+    archive_mid: int,
+    created_by: int,
+    progress_chat_id: int | None = None,
+    ttl_days: int | None = None,
+) -> BroadcastProgress:
+    """
+    Общий конвейер рассылки (кнопка «Разослать» и планировщик):
+    регистрирует рассылку в архиве и копирует её всем, кто ещё не получал.
+    ttl_days — сколько дней догонять новых пользователей (None — BROADCAST_TTL_DAYS, 0 — всегда).
+    Если задан progress_chat_id — туда выводится живой прогресс с кнопкой «⏹ Стоп».
+    Остановка срабатывает между получателями, поэтому deliveries всегда согласован
+    с тем, что реально отправлено. Повторный вызов для той же рассылки продолжает
+    с оставшихся: так работают кнопка «▶️ Продолжить» в отчёте об остановке
+    и перезапуск отложенной рассылки после падения бота.
+    """
+    broadcast_id = str(archive_mid)
+
+    now = datetime.now()
+    if ttl_days is None:
+        ttl_days = BROADCAST_TTL_DAYS
+    expires_at = (now + timedelta(days=ttl_days)).isoformat(timespec="seconds") if ttl_days > 0 else None
+
+    # добавляем рассылку в список (архив) — чтобы новым юзерам приходила
+    await add_broadcast(
+        {
+            "archive_message_id": int(archive_mid),
+            "created_at": now.isoformat(timespec="seconds"),
+            "created_by": created_by,
+            "expires_at": expires_at,
+        }
+    )
+
+    # не шлём повторно тем, кто уже получал
+    user_ids = await offload(pending_recipients, broadcast_id)
+
+    progress = BroadcastProgress(broadcast_id, len(user_ids), progress_chat_id)
+    active_broadcasts[broadcast_id] = progress
+    await progress.start(created_by)
+
+    try:
+        for uid in user_ids:
+            if progress.stopped:
+                break
+            # список снят до начала: пока шла рассылка, пользователь мог получить её
+            # догоняющей доставкой на /start или заблокировать бота (проверки O(1))
+            if was_delivered(uid, broadcast_id) or str(uid) in store.unreachable:
+                progress.skipped += 1
+                continue
+            try:
+                with api_priority_scope(ApiPriority.BULK):
+                    new_mid = await copy_from_archive_to_chat(uid, archive_mid, via=bulk_bot)
+                await mark_delivered(uid, broadcast_id, new_mid)
+                progress.sent += 1
+            except Exception as e:
+                progress.failed += 1
+                if await record_delivery_failure(broadcast_id, uid, e):
+                    progress.retrying += 1
+
+            await progress.tick()
+    finally:
+        active_broadcasts.pop(broadcast_id, None)
+        await progress.finish()
+
+    return progress
+
+
+# ============ ПОВТОР НЕДОСТАВЛЕННЫХ ============
+# Каждая неудачная доставка рассылки записывается (retries.json + WAL) с классом ошибки
+# и числом попыток. Временные ошибки фоновая задача повторяет с экспоненциальной
+# задержкой, а когда попытки кончились — запись снимается. Постоянные (бот заблокирован,
+# чата нет) — одна запись на пользователя в unreachable: рассылки его пропускают,
+# пока он снова не нажмёт /start. Так retries.json не растёт с каждой рассылкой.
+
+# классы ошибок, которые имеет смысл повторять
+TRANSIENT_ERRORS = {"flood", "network", "server", "unknown"}
+# ошибки, после которых пользователю бесполезно слать что-либо ещё
+PERMANENT_ERRORS = {"blocked", "chat_not_found"}
+
+
+def classify_send_error(e: BaseException) -> str:
+    if isinstance(e, TelegramRetryAfter):
+        return "flood"
+    if isinstance(e, TelegramForbiddenError):
+        return "blocked"
+    if isinstance(e, TelegramBadRequest):
+        return "chat_not_found" if "chat not found" in str(e).lower() else "bad_request"
+    if isinstance(e, TelegramServerError):
+        return "server"
+    if isinstance(e, (TelegramNetworkError, asyncio.TimeoutError, OSError)):
+        return "network"
+    return "unknown"
+
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+
+
+async def record_delivery_failure(broadcast_id: str, user_id: int, e: BaseException) -> bool:
+    """
+    Записывает неудачную доставку. True — будет повтор, False — ошибка постоянная или попытки кончились.
+    """
+    uid = str(user_id)
+    prev = store.retries.get(broadcast_id, {}).get(uid, {})
+    attempts = int(prev.get("attempts", 0)) + 1
+    err = classify_send_error(e)
+    retry = err in TRANSIENT_ERRORS and attempts < RETRY_MAX_ATTEMPTS
+    metrics.inc(f"delivery_errors.{err}")
+    try:
+        if err in PERMANENT_ERRORS:
+            await store.submit(
+                "mark_unreachable", user_id=uid, err=err, at=datetime.now().isoformat(timespec="seconds")
+            )
+        elif retry:
+            entry = {"err": err, "attempts": attempts, "next_at": round(time.time() + retry_delay(attempts), 1)}
+            await store.submit("retry_put", broadcast_id=broadcast_id, user_id=uid, entry=entry)
+        elif prev:
+            await store.submit("retry_drop", broadcast_id=broadcast_id, user_id=uid)
+    except Exception:
+        logging.exception("Не удалось записать недоставленное")
+    return retry
+
+
+async def mark_reachable(user_id: int) -> None:
+    """
+    Пользователь снова пишет боту (/start) — рассылки ему опять отправляются.
+    """
+    if str(user_id) in store.unreachable:
+        await store.submit("mark_reachable", user_id=str(user_id))
+
+
+def pending_retries(include_waiting: bool = True) -> list[tuple[str, str, dict[str, Any]]]:
+    """
+    (broadcast_id, user_id, запись) для временных ошибок, которые ещё будем повторять.
+    include_waiting=False — только те, у кого подошло время.
+    """
+    store.ensure_loaded()
+    now = time.time()
+    out = []
+    for bid, users in store.retries.items():
+        for uid, entry in users.items():
+            next_at = entry.get("next_at")
+            if next_at is None:
+                continue
+            if include_waiting or next_at <= now:
+                out.append((bid, uid, entry))
+    return out
+
+
+def pending_retries_count() -> int:
+    return len(pending_retries())
+
+
+async def retry_deliveries(targets: list[tuple[str, str, dict[str, Any]]]) -> tuple[int, int]:
+    """
+    Повторная доставка только по списку неудачных. Возвращает (доставлено, снова ошибка).
+    """
+    ok = 0
+    fail = 0
+    with api_priority_scope(ApiPriority.BULK):
+        for bid, uid, _ in targets:
+            if bid not in store._seq_by_id:
+                # рассылку удалили или она истекла
+                await store.submit("retry_drop", broadcast_id=bid, user_id=uid)
+                continue
+            if was_delivered(int(uid), bid) or uid in store.unreachable:
+                await store.submit("retry_drop", broadcast_id=bid, user_id=uid)
+                continue
+            try:
+                new_mid = await copy_from_archive_to_chat(int(uid), int(bid), via=bulk_bot)
+                # mark_delivered сам снимает запись о повторе
+                await mark_delivered(int(uid), bid, new_mid)
+                ok += 1
+            except Exception as e:
+                await record_delivery_failure(bid, int(uid), e)
+                fail += 1
+    metrics.inc("retries.delivered", ok)
+    metrics.inc("retries.failed", fail)
+    return ok, fail
+
+
+async def retry_worker() -> None:
+    while True:
+        await asyncio.sleep(RETRY_POLL_INTERVAL)
+        if settings.archive_chat_id is None:
+            continue
+        try:
+            due = pending_retries(include_waiting=False)
+            if due:
+                ok, fail = await retry_deliveries(due)
+                logging.info(f"Повтор недоставленных: доставлено {ok}, ошибок {fail}")
+        except Exception:
+            logging.exception("Повтор недоставленных упал")
+
+
+metrics.gauge("retries.pending", pending_retries_count)
+metrics.gauge("users.unreachable", lambda: len(store.unreachable))
+
+
+# ============ ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ============
+
+# ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+background_tasks: set[asyncio.Task] = set()
+
+
+def spawn(coro: Awaitable[Any]) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def save_user(user: types.User):
+    ensure_files()
+
+    STANDARD_HEADER = "user_id | Full_name | @username | first_seen_at"
+
+    need_reset = False
+    try:
+        with open(USERS_FILE, "r", encoding="utf-8") as f:
+            first_line = f.readline().strip()
+        if not first_line or not first_line.startswith("user_id |"):
+            need_reset = True
+    except FileNotFoundError:
+        need_reset = True
+
+    if need_reset:
+        with open(USERS_FILE, "w", encoding="utf-8") as f:
+            f.write(STANDARD_HEADER + "\n")
+
+    existing_ids = set()
+    with open(USERS_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.lower().startswith("user_id"):
+                continue
+            parts = [p.strip() for p in line.split("|")]
+            if parts and parts[0].isdigit():
+                existing_ids.add(parts[0])
+
+    uid = str(user.id)
+    if uid not in existing_ids:
+        full_name = user.full_name or ""
+        username = f"@{user.username}" if user.username else ""
+        first_seen = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        with open(USERS_FILE, "a", encoding="utf-8") as f:
+            f.write(f"{uid} | {full_name} | {username} | {first_seen}\n")
+
+
+# ============ СОБЫТИЯ СТАТИСТИКИ ============
+# stats.txt — по одной JSON-строке на событие:
+#   {"ts": "...", "uid": 123, "un": "name", "a": <Action>, ...поля события}
+# Поля для итогов рассылок: success, failed, duration (сек), broadcast_id.
+# Старые строки "ts;user_id;username;action" читаются тем же ридером.
+
+class Action(IntEnum):
+    # коды не менять и не переиспользовать — они лежат в stats.txt
+    START = 1
+    BUTTON_STOCK = 2
+    BUTTON_REVIEWS = 3
+    BUTTON_INFO_MAIN = 4
+    BUTTON_CHANNEL = 5
+    BUTTON_MANAGER = 6
+    INFO_1 = 7
+    INFO_2 = 8
+    INFO_3 = 9
+    INFO_4 = 10
+    INFO_5 = 11
+    ADMIN_BROADCAST_BUTTON = 20
+    ADMIN_BROADCAST_PREPARE = 21
+    ADMIN_BROADCAST_START = 22
+    ADMIN_BROADCAST_CANCEL = 23
+    ADMIN_BROADCAST_STOP = 24
+    ADMIN_BROADCAST_DONE = 25
+    ADMIN_BROADCAST_EDIT = 26
+    ADMIN_BROADCAST_EDIT_DONE = 27
+    ADMIN_BROADCAST_SCHEDULE = 28
+    ADMIN_BROADCAST_SCHEDULE_CANCEL = 29
+    SCHEDULED_BROADCAST_START = 30
+    ADMIN_BROADCAST_RETRY = 31
+    ADMIN_BROADCAST_RETRY_DONE = 32
+    SCHEDULED_BROADCAST_FAILED = 33
+    ADMIN_STATS_BUTTON = 40
+
+
+# старый формат: итоги были зашиты в имя действия
+_LEGACY_DONE_RE = re.compile(r"^(admin_broadcast_done|admin_broadcast_edit_done)_success_(\d+)_failed_(\d+)$")
+
+
+def log_action(user: types.User, action: Action, **fields: Any):
+    log_action_by_id(user.id, user.username or "", action, **fields)
+
+
+def log_action_by_id(user_id: int, username: str, action: Action, **fields: Any):
+    """
+    То же, что log_action, но без объекта User (для фоновых задач, например планировщика).
+    """
+    ensure_files()
+    event = {"ts": datetime.now().isoformat(timespec="seconds"), "uid": user_id, "un": username, "a": int(action), **fields}
+    with open(STATS_FILE, "a", encoding="utf-8") as f:
+        f.write(dumps_json(event) + "\n")
+    uniques.add(action, user_id)
+
+
+def parse_stats_line(line: str) -> dict[str, Any] | None:
+    """
+    Одна строка stats.txt -> событие {"ts", "uid", "un", "a", ...}.
+    "a" — Action, либо None для неизвестного старого действия (тогда его имя в "raw").
+    """
+    line = line.strip()
+    if not line:
+        return None
+
+    if line.startswith("{"):
+        try:
+            event = loads_json(line)
+            event["a"] = Action(event["a"])
+        except (ValueError, KeyError, TypeError):
+            return None
+        return event
+
+    parts = line.split(";", 3)
+    if len(parts) < 4:
+        return None
+    ts, uid, username, raw = parts
+    event: dict[str, Any] = {"ts": ts, "uid": int(uid) if uid.isdigit() else uid, "un": username, "a": None}
+
+    m = _LEGACY_DONE_RE.match(raw)
+    if m:
+        event["a"] = Action[m.group(1).upper()]
+        event["success"] = int(m.group(2))
+        event["failed"] = int(m.group(3))
+    elif raw.upper() in Action.__members__:
+        event["a"] = Action[raw.upper()]
+    else:
+        event["raw"] = raw
+    return event
+
+
+def iter_stats_events():
+    try:
+        with open(STATS_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                event = parse_stats_line(line)
+                if event is not None:
+                    yield event
+    except FileNotFoundError:
+        return
+
+
+# ============ УНИКАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ (HLL) ============
+# На каждый день и действие — HyperLogLog-скетч: фиксированные 2^HLL_PRECISION байт,
+# ошибка ~1.04/sqrt(2^p) (≈3% при p=10). Скетчи объединяются (max по регистрам),
+# поэтому «уникальных за неделю» — это merge семи дневных, без пересчёта stats.txt.
+
+HLL_PRECISION = 10  # не менять без сброса uniques.json: скетчи с разным p не объединяются
+HLL_ANY = "*"       # ключ скетча «любое действие за день»
+
+
+class HyperLogLog:
+    def __init__(self, p: int = HLL_PRECISION, registers: bytes | None = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, value: int | str) -> None:
+        x = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+        idx = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # малые значения — линейный подсчёт точнее
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def dumps(self) -> str:
+        return base64.b64encode(bytes(self.registers)).decode("ascii")
+
+    @classmethod
+    def loads(cls, raw: str, p: int = HLL_PRECISION) -> "HyperLogLog":
+        return cls(p, base64.b64decode(raw))
+
+
+class UniqueCounters:
+    """
+    day ("YYYY-MM-DD") -> {код Action или HLL_ANY -> HyperLogLog}.
+    Пишется в uniques.json раз в HLL_FLUSH_INTERVAL и при остановке; если файла нет —
+    один раз строится из stats.txt.
+    """
+
+    def __init__(self, path: str, keep_days: int):
+        self.path = path
+        self.keep_days = keep_days
+        self.days: dict[str, dict[str, HyperLogLog]] = {}
+        self._loaded = False
+        self._dirty = False
+
+    def ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        data = _load_json(self.path, None)
+        if isinstance(data, dict) and data.get("p") == HLL_PRECISION:
+            for day, sketches in data.get("days", {}).items():
+                self.days[day] = {k: HyperLogLog.loads(v) for k, v in sketches.items()}
+            return
+
+        # первый запуск (или сменился p) — восстанавливаем из лога
+        for event in iter_stats_events():
+            if event["a"] is not None:
+                self._add(str(event["ts"])[:10], event["a"], event["uid"])
+        self._dirty = True
+        self.flush()
+
+    def _add(self, day: str, action: Action, user_id: int | str) -> None:
+        sketches = self.days.setdefault(day, {})
+        for key in (str(int(action)), HLL_ANY):
+            hll = sketches.get(key)
+            if hll is None:
+                hll = sketches[key] = HyperLogLog()
+            hll.add(user_id)
+
+    def add(self, action: Action, user_id: int) -> None:
+        self.ensure_loaded()
+        self._add(datetime.now().strftime("%Y-%m-%d"), action, user_id)
+        self._dirty = True
+
+    def unique(self, days: int, key: str = HLL_ANY) -> int:
+        """
+        ≈ уникальных пользователей за последние days дней (включая сегодня).
+        """
+        self.ensure_loaded()
+        today = datetime.now().date()
+        total = HyperLogLog()
+        for i in range(days):
+            hll = self.days.get((today - timedelta(days=i)).isoformat(), {}).get(key)
+            if hll is not None:
+                total.merge(hll)
+        return total.count()
+
+    def _snapshot(self) -> dict[str, dict[str, bytes]]:
+        """
+        Копия регистров (memcpy, без кодирования) — дальше её можно писать в другом потоке,
+        пока add() меняет живые скетчи.
+        """
+        if self.keep_days > 0:
+            cutoff = (datetime.now().date() - timedelta(days=self.keep_days)).isoformat()
+            for day in [d for d in self.days if d < cutoff]:
+                del self.days[day]
+        return {day: {k: bytes(h.registers) for k, h in sk.items()} for day, sk in self.days.items()}
+
+    def _write(self, snapshot: dict[str, dict[str, bytes]]) -> None:
+        data = {
+            "p": HLL_PRECISION,
+            "days": {
+                day: {k: base64.b64encode(regs).decode("ascii") for k, regs in sk.items()}
+                for day, sk in snapshot.items()
+            },
+        }
+        _save_json(self.path, data)
+
+    def flush(self) -> None:
+        if not self._dirty:
+            return
+        self._write(self._snapshot())
+        self._dirty = False
+
+    async def flush_async(self) -> None:
+        """
+        Снимок регистров в цикле, кодирование и запись — в пуле потоков.
+        """
+        if not self._dirty:
+            return
+        snapshot = self._snapshot()
+        self._dirty = False
+        try:
+            await offload(self._write, snapshot)
+        except BaseException:
+            self._dirty = True
+            raise
+
+
+uniques = UniqueCounters(HLL_FILE, HLL_KEEP_DAYS)
+
+
+async def uniques_flusher() -> None:
+    while True:
+        await asyncio.sleep(HLL_FLUSH_INTERVAL)
+        try:
+            await uniques.flush_async()
+        except Exception:
+            logging.exception(f"Не удалось сохранить {HLL_FILE}")
+
+
+async def cleanup_user_messages(chat_id: int, user_id: int):
+    """
+    Удаляем все прошлые сообщения бота для этого пользователя,
+    кроме приветствия.
+    """
+    tracked = await get_tracked_messages(user_id)
+    greet_id = tracked.get("greeting_id")
+
+    to_delete = [mid for mid in tracked.get("bot_messages", []) if greet_id is None or mid != greet_id]
+    deleted: set[int] = set(to_delete)
+    with api_priority_scope(ApiPriority.CLEANUP):
+        # deleteMessages — до 100 id за запрос, недоступные сообщения Telegram просто пропускает
+        for i in range(0, len(to_delete), 100):
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=to_delete[i:i + 100])
+            except Exception:
+                pass
+
+    # убираем удалённые атомарно: пока удаляли, могли добавиться новые сообщения
+    def forget(tracked: dict[str, Any]) -> None:
+        tracked["bot_messages"] = [m for m in tracked.get("bot_messages", []) if m not in deleted]
+        renders = tracked.get("renders", {})
+        tracked["renders"] = {k: v for k, v in renders.items() if int(k) not in deleted}
+
+    await update_tracked_messages(user_id, forget)
+
+
+async def remember_bot_message(user_id: int, message_id: int):
+    def add(tracked: dict[str, Any]) -> None:
+        msgs = tracked.setdefault("bot_messages", [])
+        if message_id not in msgs:
+            msgs.append(message_id)
+
+    await update_tracked_messages(user_id, add)
+
+
+async def remember_greeting(user_id: int, message_id: int):
+    def add(tracked: dict[str, Any]) -> None:
+        tracked["greeting_id"] = message_id
+        msgs = tracked.setdefault("bot_messages", [])
+        if message_id not in msgs:
+            msgs.append(message_id)
+
+    await update_tracked_messages(user_id, add)
+
+
+def render_hash(text: str, markup: InlineKeyboardMarkup | None) -> str:
+    payload = text + "\0" + (markup.model_dump_json(exclude_none=True) if markup else "")
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def remember_render(user_id: int, message_id: int, text: str, markup: InlineKeyboardMarkup | None) -> None:
+    digest = render_hash(text, markup)
+
+    def put(tracked: dict[str, Any]) -> None:
+        tracked.setdefault("renders", {})[str(message_id)] = digest
+
+    await update_tracked_messages(user_id, put)
+
+
+async def is_rendered(user_id: int, message_id: int, text: str, markup: InlineKeyboardMarkup | None) -> bool:
+    """
+    True, если в сообщении уже ровно этот текст и клавиатура — тогда edit_text не нужен.
+    """
+    tracked = await get_tracked_messages(user_id)
+    cached = tracked.get("renders", {}).get(str(message_id))
+    return cached is not None and cached == render_hash(text, markup)
+
+
+def get_main_keyboard(is_admin: bool) -> ReplyKeyboardMarkup:
+    keyboard: list[list[KeyboardButton]] = []
+
+    keyboard.append([KeyboardButton(text="📦 НАЛИЧИЕ СТОКА")])
+    keyboard.append(
+        [
+            KeyboardButton(text="🔥 Отзывы"),
+            KeyboardButton(text="ℹ️ ИНФОРМАЦИЯ ДЛЯ ЗАКАЗА"),
+        ]
+    )
+    keyboard.append(
+        [
+            KeyboardButton(text="📣 ИНФОРМАЦИОННЫЙ КАНАЛ"),
+            KeyboardButton(text="👨‍💻Связь с менеджером"),
+        ]
+    )
+
+    if is_admin:
+        keyboard.append(
+            [
+                KeyboardButton(text="📨 Рассылка"),
+                KeyboardButton(text="📊 Статистика"),
+            ]
         )
 
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+
+
+ACTION_LABELS = {
+    Action.START: "▶️ Старт бота (/start)",
+    Action.BUTTON_STOCK: "📦 Наличие стока (кнопка)",
+    Action.BUTTON_REVIEWS: "🔥 Отзывы (кнопка)",
+    Action.BUTTON_INFO_MAIN: "ℹ️ Инфо для заказа (меню)",
+    Action.BUTTON_CHANNEL: "📣 Информационный канал (кнопка)",
+    Action.BUTTON_MANAGER: "👨‍💻 Связь с менеджером (кнопка)",
+    Action.INFO_1: "ℹ️ Инфо: формирование заказа",
+    Action.INFO_2: "ℹ️ Инфо: сбор заказа",
+    Action.INFO_3: "ℹ️ Инфо: способы оплаты",
+    Action.INFO_4: "ℹ️ Инфо: самовывоз",
+    Action.INFO_5: "ℹ️ Инфо: сроки доставки",
+    Action.ADMIN_BROADCAST_BUTTON: "👑 Админ: рассылка (меню)",
+    Action.ADMIN_BROADCAST_PREPARE: "👑 Админ: сообщение для рассылки получено",
+    Action.ADMIN_BROADCAST_START: "👑 Админ: запуск рассылки",
+    Action.ADMIN_BROADCAST_CANCEL: "👑 Админ: отмена рассылки",
+    Action.ADMIN_BROADCAST_STOP: "👑 Админ: остановка рассылки",
+    Action.ADMIN_BROADCAST_DONE: "👑 Админ: рассылка завершена",
+    Action.ADMIN_BROADCAST_EDIT: "👑 Админ: изменение рассылки",
+    Action.ADMIN_BROADCAST_EDIT_DONE: "👑 Админ: изменение рассылки завершено",
+    Action.ADMIN_BROADCAST_SCHEDULE: "👑 Админ: рассылка запланирована",
+    Action.ADMIN_BROADCAST_SCHEDULE_CANCEL: "👑 Админ: отмена отложенной рассылки",
+    Action.SCHEDULED_BROADCAST_START: "⏰ Запуск отложенной рассылки",
+    Action.ADMIN_BROADCAST_RETRY: "👑 Админ: повтор недоставленных",
+    Action.ADMIN_BROADCAST_RETRY_DONE: "👑 Админ: повтор недоставленных завершён",
+    Action.SCHEDULED_BROADCAST_FAILED: "⏰ Отложенная рассылка не удалась",
+    Action.ADMIN_STATS_BUTTON: "👑 Админ: просмотр статистики",
+}
+
+
+def load_stats_summary():
+    total_users = 0
+    total_start = 0
+    button_counts: dict[Action | str, int] = {}
+
+    try:
+        with open(USERS_FILE, "r", encoding="utf-8") as f:
+            lines = [l for l in f if l.strip()]
+            if lines and lines[0].lower().startswith("user_id"):
+                total_users = len(lines) - 1
+            else:
+                total_users = len(lines)
+    except FileNotFoundError:
+        total_users = 0
+
+    # итоги рассылок и правок: Action -> {"runs", "success", "failed", "duration"}
+    outcomes: dict[Action, dict[str, float]] = {}
+
+    for event in iter_stats_events():
+        key = event["a"] if event["a"] is not None else event.get("raw", "?")
+        button_counts[key] = button_counts.get(key, 0) + 1
+        if key in (Action.ADMIN_BROADCAST_DONE, Action.ADMIN_BROADCAST_EDIT_DONE, Action.ADMIN_BROADCAST_RETRY_DONE):
+            agg = outcomes.setdefault(key, {"runs": 0, "success": 0, "failed": 0, "duration": 0.0})
+            agg["runs"] += 1
+            agg["success"] += int(event.get("success", 0))
+            agg["failed"] += int(event.get("failed", 0))
+            agg["duration"] += float(event.get("duration", 0))
+
+    total_start = button_counts.get(Action.START, 0)
+    return total_users, total_start, button_counts, outcomes
+
+
+def load_uniques_summary() -> tuple[dict[int, int], dict[Action, int]]:
+    """
+    ≈ уникальных за 1/7/30 дней и по пользовательским кнопкам за 30 дней (ненулевые).
+    """
+    totals = {days: uniques.unique(days) for days in (1, 7, 30)}
+    by_action: dict[Action, int] = {}
+    for action in Action:
+        if action >= Action.ADMIN_BROADCAST_BUTTON:
+            continue
+        n = uniques.unique(30, str(int(action)))
+        if n:
+            by_action[action] = n
+    return totals, by_action
+
+
+# ============ ТЕКСТЫ ДЛЯ ℹ️ ИНФОРМАЦИЯ ДЛЯ ЗАКАЗА ============
+INFO_1_TEXT = (
+    "<b>Формирование заказа</b> 🧾\n\n"
+    "Вы отправляете список нужных вкусов и позиций из актуального наличия Tasty Shop.\n\n"
+    "<b>Минимальный заказ:</b> от 20 единиц\n"
+    "<b>Максимальный заказ:</b> до 1000 единиц (больше — по согласованию)\n\n"
+    "<b>Стоимость</b> зависит от объёма.\n"
+    "Постоянным и крупным клиентам предоставляются <b>индивидуальные скидки</b>\n\n"
+    "Вы можете свободно комбинировать любые позиции и вкусы — список формируется полностью под ваши задачи."
+)
+
+INFO_2_TEXT = (
+    "<b>Сбор заказа</b> 📦\n\n"
+    "<b>Порядок оформления заказа в Tasty Shop:</b>\n\n"
+    "1️⃣ <b>Составление списка.</b>\n"
+    "   Вы выбираете нужные вкусы и товары по нашей таблице и отправляете нам готовый список.\n\n"
+    "2️⃣ <b>Сборка заказа.</b>\n"
+    "   Мы формируем ваш заказ и отправляем вам <b>видеоотчёт</b> с полностью собранным заказом.\n\n"
+    "3️⃣ <b>Оплата.</b>\n"
+    "   Вы выбираете удобный способ оплаты и подтверждаете заказ.\n\n"
+    "4️⃣ <b>Доставка.</b>\n"
+    "   Сообщаете предпочитаемую службу доставки и данные для отправки."
+)
+
+INFO_3_TEXT = (
+    "<b>Способы оплаты</b> 💳\n\n"
+    "Мы принимаем следующие варианты оплаты:\n\n"
+    "<b>• USDT TRC-20</b>\n"
+    "<b>• Revolut</b>\n"
+    "<b>• Monese</b>\n"
+    "<b>• Zen</b>\n"
+    "<b>• Wise</b>\n"
+    "<b>• Monobank</b>\n"
+    "<b>• Наличные (на точках самовывоза)</b>\n"
+    "<b>• Евро-счёт</b>\n"
+    "<b>• PayPal</b>\n\n"
+    "📦 По Польше первый заказ можем отправить <b>наложенным платежом InPost</b>."
+)
+
+INFO_4_TEXT = (
+    "<b>Самовывоз</b> 📍\n\n"
+    "Доступны точки самовывоза в Европе:\n\n"
+    "<b>• Варшава</b>\n"
+    "<b>• Краков</b>\n"
+    "<b>• Познань</b>\n"
+    "<b>• Кельце</b>\n"
+    "<b>• Берлин</b>\n"
+    "<b>• Рига</b>\n\n"
+    "На точках самовывоза вы можете <b>проверить заказ на месте</b> и оплатить его наличными."
+)
+
+INFO_5_TEXT = (
+    "<b>Сроки и варианты доставки</b> 🚚\n\n"
+    "Мы осуществляем доставку по всей Европе. Доступные курьерские службы:\n\n"
+    "• <b>DPD</b> — ~3–5 рабочих дней\n"
+    "• <b>GLS</b> — ~3–5 рабочих дней\n"
+    "• <b>InPost</b> — ~2 рабочих дня\n\n"
+    "Сроки могут незначительно отличаться в зависимости от региона и загрузки служб доставки."
+)
+
 
+def get_info_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🧾 Формирование заказа", callback_data="info_1")],
+            [InlineKeyboardButton(text="📦 Сбор заказа", callback_data="info_2")],
+            [InlineKeyboardButton(text="💳 Способы оплаты", callback_data="info_3")],
+            [InlineKeyboardButton(text="📍 Самовывоз", callback_data="info_4")],
+            [InlineKeyboardButton(text="🚚 Сроки доставки", callback_data="info_5")],
+        ]
+    )
 
-ACTION_LABELS = {
-    "start": "▶️ Старт бота (/start)",
-    "button_stock": "📦 Наличие стока (кнопка)",
-    "button_reviews": "🔥 Отзывы (кнопка)",
-    "button_info_main": "ℹ️ Инфо для заказа (меню)",
-    "button_channel": "📣 Информационный канал (кнопка)",
-    "button_manager": "👨‍💻 Связь с менеджером (кнопка)",
-    "info_1": "ℹ️ Инфо: формирование заказа",
-    "info_2": "ℹ️ Инфо: сбор заказа",
-    "info_3": "ℹ️ Инфо: способы оплаты",
-    "info_4": "ℹ️ Инфо: самовывоз",
-    "info_5": "ℹ️ Инфо: сроки доставки",
-    "admin_broadcast_button": "👑 Админ: рассылка (меню)",
-    "admin_broadcast_prepare": "👑 Админ: сообщение для рассылки получено",
-    "admin_broadcast_start": "👑 Админ: запуск рассылки",
-    "admin_broadcast_cancel": "👑 Админ: отмена рассылки",
-    "admin_stats_button": "👑 Админ: просмотр статистики",
-}
 
+# ============ АНТИСПАМ ============
 
-def load_stats_summary():
-    total_users = 0
-    total_start = 0
-    button_counts: dict[str, int] = {}
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Token bucket на пользователя. Стоимость хендлера задаётся флагом
+    throttle_cost (по умолчанию 1, 0 — не тарифицируется).
+    Если токенов не хватает — апдейт отбрасывается; на колбэк всё равно отвечаем,
+    иначе у пользователя так и крутились бы часики на кнопке.
+    Ввод админа в сценариях рассылки идёт с throttle_cost=0: вставить текст,
+    время или дату подряд — не спам.
+    Вёдра хранятся в LRU, поэтому память ограничена max_users.
+    """
+
+    def __init__(self, rate: float, burst: float, max_users: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets: OrderedDict[int, list[float]] = OrderedDict()  # user_id -> [токены, время]
+
+    def _consume(self, user_id: int, cost: float) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self._buckets[user_id] = bucket
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        cost = get_flag(data, "throttle_cost", default=1)
+        if user is None or not cost:
+            return await handler(event, data)
+
+        if self._consume(user.id, cost):
+            return await handler(event, data)
+
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        metrics.inc("throttled.total")
+        metrics.inc(f"throttled.{name}")
+
+        if isinstance(event, types.CallbackQuery):
+            try:
+                await event.answer("⏳ Слишком часто, подожди пару секунд.")
+            except Exception:
+                pass
+        return None
+
+
+throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_USERS)
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
+metrics.gauge("throttle.buckets", lambda: len(throttling._buckets))
+
+
+# ============ ОЧЕРЕДЬ АПДЕЙТОВ ============
+
+class UpdateExecutor(BaseMiddleware):
+    """
+    Внешний middleware на апдейты: у каждого чата своя FIFO-полоса, апдейты одного
+    пользователя обрабатываются строго по очереди (нет гонок в cleanup / трекинге сообщений),
+    разные чаты — параллельно, но не больше concurrency хендлеров одновременно.
+    Слот берётся только головой полосы, поэтому «зафлудивший» чат не занимает чужие слоты.
+    Полоса не глубже max_depth: апдейты сверх этого отбрасываются до ожидания,
+    иначе один чат забил бы общий лимит polling (tasks_concurrency_limit) своей очередью.
+    """
+
+    def __init__(self, concurrency: int, max_depth: int = 0):
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self._slots = asyncio.Semaphore(concurrency)
+        self._lanes: dict[int, list[Any]] = {}  # chat_id -> [Lock, апдейтов в полосе]
+        self.running = 0
+
+    @staticmethod
+    def _lane_key(data: dict[str, Any]) -> int | None:
+        chat = data.get("event_chat")
+        if chat is not None:
+            return chat.id
+        user = data.get("event_from_user")
+        return user.id if user is not None else None
+
+    def lane_depth_max(self) -> int:
+        return max((lane[1] for lane in self._lanes.values()), default=0)
+
+    def waiting(self) -> int:
+        return sum(lane[1] for lane in self._lanes.values()) - self.running
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        key = self._lane_key(data)
+        arrived = time.perf_counter()
+
+        lane = None
+        if key is not None:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = [asyncio.Lock(), 0]
+            elif self.max_depth and lane[1] >= self.max_depth:
+                metrics.inc("updates.lane_dropped")
+                if isinstance(event, types.Update) and event.callback_query is not None:
+                    # отброшенный колбэк всё равно закрываем, чтобы кнопка не «висела»
+                    try:
+                        await event.callback_query.answer("⏳ Слишком часто, подожди пару секунд.")
+                    except Exception:
+                        pass
+                return None
+            lane[1] += 1
 
+        try:
+            if lane is not None:
+                # asyncio.Lock отдаёт владение строго в порядке ожидания => FIFO внутри чата
+                await lane[0].acquire()
+            try:
+                lane_ready = time.perf_counter()
+                metrics.observe("updates.lane_wait", lane_ready - arrived)
+                async with self._slots:
+                    metrics.observe("updates.slot_wait", time.perf_counter() - lane_ready)
+                    self.running += 1
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self.running -= 1
+            finally:
+                if lane is not None:
+                    lane[0].release()
+        finally:
+            if lane is not None:
+                lane[1] -= 1
+                if lane[1] == 0 and self._lanes.get(key) is lane:
+                    del self._lanes[key]
+
+
+update_executor = UpdateExecutor(UPDATE_CONCURRENCY, UPDATE_LANE_MAX_DEPTH)
+# полоса должна встать раньше FSM-middleware: оно может уступать управление (await хранилища),
+# и тогда апдейты одного чата поменялись бы местами ещё до входа в очередь
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(update_executor)
+dp.update.outer_middleware(dp.fsm)
+metrics.gauge("updates.running", lambda: update_executor.running)
+metrics.gauge("updates.waiting", update_executor.waiting)
+metrics.gauge("updates.lanes", lambda: len(update_executor._lanes))
+metrics.gauge("updates.lane_depth_max", update_executor.lane_depth_max)
+
+
+# ============ КОМАНДЫ ============
+
+# file_id приветственной картинки после первой загрузки — дальше шлём без повторного upload.
+# Хранится в media.json (ключ — бот + размер/время файла), так что переживает перезапуск.
+GREETING_PHOTO = "assets/tastyshop.jpg"
+_greeting_photo_id: str | None = None
+
+
+def _media_key(path: str) -> str | None:
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            lines = [l for l in f if l.strip()]
-            if lines and lines[0].lower().startswith("user_id"):
-                total_users = len(lines) - 1
-            else:
-                total_users = len(lines)
-    except FileNotFoundError:
-        total_users = 0
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{bot.id}:{path}:{st.st_size}:{st.st_mtime_ns}"
 
+
+def remember_greeting_photo(file_id: str) -> None:
+    global _greeting_photo_id
+    _greeting_photo_id = file_id
+    key = _media_key(GREETING_PHOTO)
+    if key is not None:
+        _save_json(MEDIA_FILE, {"file_ids": {key: file_id}})
+
+
+async def warm_media_cache() -> None:
+    """
+    Берёт file_id из media.json; если картинка новая — загружает её в архив (без звука)
+    и сразу удаляет, чтобы первый /start не ждал upload.
+    """
+    global _greeting_photo_id
+    key = _media_key(GREETING_PHOTO)
+    if key is None:
+        return
+    cached = _load_json(MEDIA_FILE, {})
+    file_ids = cached.get("file_ids") if isinstance(cached, dict) else None
+    if isinstance(file_ids, dict) and isinstance(file_ids.get(key), str):
+        _greeting_photo_id = file_ids[key]
+        return
+
+    archive = settings.archive_chat_id
+    if archive is None:
+        return
     try:
-        with open(STATS_FILE, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                parts = line.split(";")
-                if len(parts) < 4:
-                    continue
-                action = parts[3]
-                button_counts[action] = button_counts.get(action, 0) + 1
-    except FileNotFoundError:
+        msg = await bot.send_photo(chat_id=archive, photo=FSInputFile(GREETING_PHOTO), disable_notification=True)
+    except Exception as e:
+        logging.warning(f"Не удалось заранее загрузить приветствие: {e}")
+        return
+    if msg.photo:
+        remember_greeting_photo(msg.photo[-1].file_id)
+    try:
+        await bot.delete_message(chat_id=archive, message_id=msg.message_id)
+    except Exception:
+        pass
+
+
+async def send_greeting(message: types.Message, kb: ReplyKeyboardMarkup) -> types.Message:
+    global _greeting_photo_id
+
+    caption = (
+        "<b>🔥 TASTY SHOP</b> — надёжный поставщик электронных девайсов и жидкостей по всей Европе.\n\n"
+        "Выберите нужный раздел на клавиатуре ниже 👇"
+    )
+
+    if _greeting_photo_id is not None:
+        try:
+            return await message.answer_photo(photo=_greeting_photo_id, caption=caption, reply_markup=kb)
+        except TelegramBadRequest:
+            # file_id протух (например, сменили токен) — загрузим заново
+            _greeting_photo_id = None
+
+    msg = await message.answer_photo(photo=FSInputFile(GREETING_PHOTO), caption=caption, reply_markup=kb)
+    if msg.photo:
+        remember_greeting_photo(msg.photo[-1].file_id)
+    return msg
+
+
+async def _delete_quietly(message: types.Message) -> None:
+    try:
+        with api_priority_scope(ApiPriority.CLEANUP):
+            await message.delete()
+    except Exception:
+        pass
+
+
+@dp.message(CommandStart(), flags={"throttle_cost": 5})
+async def cmd_start(message: types.Message):
+    user = message.from_user
+    if user is None:
+        return
+
+    started = time.perf_counter()
+    kb = get_main_keyboard(is_admin=user.id in settings.admin_ids)
+
+    async def _greet() -> types.Message:
+        msg = await send_greeting(message, kb)
+        metrics.observe("start.time_to_greeting", time.perf_counter() - started)
+        return msg
+
+    # приветствие не ждёт ни файлов, ни удалений: всё стартует одновременно,
+    # а удаления идут с приоритетом CLEANUP и не обгоняют картинку в очереди API.
+    # cleanup успевает прочитать список сообщений до того, как в нём появится новое приветствие.
+    greeting, _, cleanup_error = await asyncio.gather(
+        _greet(),
+        _delete_quietly(message),
+        cleanup_user_messages(chat_id=message.chat.id, user_id=user.id),
+        return_exceptions=True,
+    )
+    if isinstance(cleanup_error, Exception):
+        logging.warning(f"/start: не удалось почистить сообщения {user.id}: {cleanup_error}")
+    if isinstance(greeting, BaseException):
+        raise greeting
+
+    await remember_greeting(user.id, greeting.message_id)
+
+    # учёт — уже после того, как пользователь увидел приветствие
+    save_user(user)
+    log_action(user, Action.START)
+    await mark_reachable(user.id)
+
+    # ✅ Умная рассылка новым: отправляем прошлые, которых ещё не получал
+    await send_missing_broadcasts_to_user(user.id)
+    metrics.observe("start.total", time.perf_counter() - started)
+
+
+@dp.message(Command("myid"))
+async def cmd_myid(message: types.Message):
+    user = message.from_user
+    if user is None:
+        return
+
+    await message.answer(
+        f"Твой Telegram ID: <code>{user.id}</code>\n\n"
+        "Добавь его в <code>ADMIN_IDS</code> в .env (через запятую, если админов несколько) — "
+        "бот подхватит изменение сам, перезапуск не нужен. Потом нажми /start."
+    )
+
+
+@dp.message(Command("chatid"))
+async def cmd_chatid(message: types.Message):
+    await message.answer(f"chat_id: <code>{message.chat.id}</code>")
+
+
+# ============ ОБРАБОТЧИКИ КНОПОК ПОЛЬЗОВАТЕЛЯ ============
+
+@dp.message(F.text == "📦 НАЛИЧИЕ СТОКА")
+async def handle_stock(message: types.Message):
+    user = message.from_user
+    if user is None:
+        return
+
+    log_action(user, Action.BUTTON_STOCK)
+    await cleanup_user_messages(message.chat.id, user.id)
+
+    try:
+        await message.delete()
+    except Exception:
         pass
 
-    total_start = button_counts.get("start", 0)
-    return total_users, total_start, button_counts
+    text = (
+        "📦 <b>Актуальное наличие стока</b>\n\n"
+        "Список доступного стока всегда обновляется в таблице по кнопке ниже:"
+    )
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text="📊 ОТКРЫТЬ ТАБЛИЦУ",
+                    url="https://docs.google.com/spreadsheets/d/1UK8U5I_MNl3xjTxLG0-CJFCGBa41DHjuhK_ep7o7D5k/edit?usp=sharing",
+                )
+            ]
+        ]
+    )
+
+    msg = await message.answer(text, reply_markup=kb)
+    await remember_bot_message(user.id, msg.message_id)
+
+
+@dp.message(F.text == "👨‍💻Связь с менеджером")
+async def handle_manager(message: types.Message):
+    user = message.from_user
+    if user is None:
+        return
+
+    log_action(user, Action.BUTTON_MANAGER)
+    await cleanup_user_messages(message.chat.id, user.id)
+
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+    text = (
+        "👨‍💻 <b>Связь с оптовым менеджером</b>\n\n"
+        "Нажмите на кнопку ниже, чтобы сразу написать менеджеру в Telegram:"
+    )
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Написать менеджеру", url="https://t.me/tasty2opt")]
+        ]
+    )
+
+    msg = await message.answer(text, reply_markup=kb)
+    await remember_bot_message(user.id, msg.message_id)
+
+
+@dp.message(F.text == "📣 ИНФОРМАЦИОННЫЙ КАНАЛ")
+async def handle_channel(message: types.Message):
+    user = message.from_user
+    if user is None:
+        return
+
+    log_action(user, Action.BUTTON_CHANNEL)
+    await cleanup_user_messages(message.chat.id, user.id)
+
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+    text = (
+        "📣 <b>Информационный канал Tasty Shop</b>\n\n"
+        "Все важные объявления, новости и обновления стока публикуются здесь:"
+    )
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="TASTY SHOP🩸", url="https://t.me/+-LRYgeaxmyRhMzVk")]
+        ]
+    )
+
+    msg = await message.answer(text, reply_markup=kb)
+    await remember_bot_message(user.id, msg.message_id)
+
+
+@dp.message(F.text == "🔥 Отзывы")
+async def handle_reviews(message: types.Message):
+    user = message.from_user
+    if user is None:
+        return
+
+    log_action(user, Action.BUTTON_REVIEWS)
+    await cleanup_user_messages(message.chat.id, user.id)
+
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+    text = (
+        "🔥 <b>Отзывы клиентов</b>\n\n"
+        "Посмотреть отзывы о работе Tasty Shop вы можете по кнопке ниже:"
+    )
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="ОТКРЫТЬ ОТЗЫВЫ", url="https://t.me/+-LRYgeaxmyRhMzVk")]
+        ]
+    )
+
+    msg = await message.answer(text, reply_markup=kb)
+    await remember_bot_message(user.id, msg.message_id)
+
+
+@dp.message(F.text == "ℹ️ ИНФОРМАЦИЯ ДЛЯ ЗАКАЗА")
+async def handle_order_info(message: types.Message):
+    user = message.from_user
+    if user is None:
+        return
+
+    log_action(user, Action.BUTTON_INFO_MAIN)
+    await cleanup_user_messages(message.chat.id, user.id)
+
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+    text = (
+        "ℹ️ <b>Информация для заказа</b>\n\n"
+        "Выберите интересующий раздел ниже:"
+    )
+    kb = get_info_keyboard()
+
+    msg = await message.answer(text, reply_markup=kb)
+    await remember_bot_message(user.id, msg.message_id)
+    await remember_render(user.id, msg.message_id, text, kb)
+
+
+@dp.callback_query(F.data.startswith("info_"))
+async def process_info_callback(callback: types.CallbackQuery):
+    user = callback.from_user
+    if user is None:
+        await callback.answer()
+        return
+
+    data = callback.data or ""
+
+    if data == "info_1":
+        text = INFO_1_TEXT
+        log_action(user, Action.INFO_1)
+    elif data == "info_2":
+        text = INFO_2_TEXT
+        log_action(user, Action.INFO_2)
+    elif data == "info_3":
+        text = INFO_3_TEXT
+        log_action(user, Action.INFO_3)
+    elif data == "info_4":
+        text = INFO_4_TEXT
+        log_action(user, Action.INFO_4)
+    else:
+        text = INFO_5_TEXT
+        log_action(user, Action.INFO_5)
+
+    kb = get_info_keyboard()
+    message_id = callback.message.message_id
 
+    # тот же раздел уже на экране — не дёргаем API, просто гасим «часики»
+    if await is_rendered(user.id, message_id, text, kb):
+        metrics.inc("render_cache.hit")
+        await callback.answer()
+        return
 
-# ============ ТЕКСТЫ ДЛЯ ℹ️ ИНФОРМАЦИЯ ДЛЯ ЗАКАЗА ============
-INFO_1_TEXT = (
-    "<b>Формирование заказа</b> 🧾\n\n"
-    "Вы отправляете список нужных вкусов и позиций из актуального наличия Tasty Shop.\n\n"
-    "<b>Минимальный заказ:</b> от 20 единиц\n"
-    "<b>Максимальный заказ:</b> до 1000 единиц (больше — по согласованию)\n\n"
-    "<b>Стоимость</b> зависит от объёма.\n"
-    "Постоянным и крупным клиентам предоставляются <b>индивидуальные скидки</b>\n\n"
-    "Вы можете свободно комбинировать любые позиции и вкусы — список формируется полностью под ваши задачи."
-)
+    metrics.inc("render_cache.miss")
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+        await remember_render(user.id, message_id, text, kb)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            await remember_render(user.id, message_id, text, kb)
+        else:
+            msg = await callback.message.answer(text, reply_markup=kb)
+            await remember_bot_message(user.id, msg.message_id)
+            await remember_render(user.id, msg.message_id, text, kb)
+    except Exception:
+        msg = await callback.message.answer(text, reply_markup=kb)
+        await remember_bot_message(user.id, msg.message_id)
+        await remember_render(user.id, msg.message_id, text, kb)
 
-INFO_2_TEXT = (
-    "<b>Сбор заказа</b> 📦\n\n"
-    "<b>Порядок оформления заказа в Tasty Shop:</b>\n\n"
-    "1️⃣ <b>Составление списка.</b>\n"
-    "   Вы выбираете нужные вкусы и товары по нашей таблице и отправляете нам готовый список.\n\n"
-    "2️⃣ <b>Сборка заказа.</b>\n"
-    "   Мы формируем ваш заказ и отправляем вам <b>видеоотчёт</b> с полностью собранным заказом.\n\n"
-    "3️⃣ <b>Оплата.</b>\n"
-    "   Вы выбираете удобный способ оплаты и подтверждаете заказ.\n\n"
-    "4️⃣ <b>Доставка.</b>\n"
-    "   Сообщаете предпочитаемую службу доставки и данные для отправки."
-)
+    await callback.answer()
 
-INFO_3_TEXT = (
-    "<b>Способы оплаты</b> 💳\n\n"
-    "Мы принимаем следующие варианты оплаты:\n\n"
-    "<b>• USDT TRC-20</b>\n"
-    "<b>• Revolut</b>\n"
-    "<b>• Monese</b>\n"
-    "<b>• Zen</b>\n"
-    "<b>• Wise</b>\n"
-    "<b>• Monobank</b>\n"
-    "<b>• Наличные (на точках самовывоза)</b>\n"
-    "<b>• Евро-счёт</b>\n"
-    "<b>• PayPal</b>\n\n"
-    "📦 По Польше первый заказ можем отправить <b>наложенным платежом InPost</b>."
-)
 
-INFO_4_TEXT = (
-    "<b>Самовывоз</b> 📍\n\n"
-    "Доступны точки самовывоза в Европе:\n\n"
-    "<b>• Варшава</b>\n"
-    "<b>• Краков</b>\n"
-    "<b>• Познань</b>\n"
-    "<b>• Кельце</b>\n"
-    "<b>• Берлин</b>\n"
-    "<b>• Рига</b>\n\n"
-    "На точках самовывоза вы можете <b>проверить заказ на месте</b> и оплатить его наличными."
-)
+# ============ АДМИН: РАССЫЛКА (МЕНЮ) ============
 
-INFO_5_TEXT = (
-    "<b>Сроки и варианты доставки</b> 🚚\n\n"
-    "Мы осуществляем доставку по всей Европе. Доступные курьерские службы:\n\n"
-    "• <b>DPD</b> — ~3–5 рабочих дней\n"
-    "• <b>GLS</b> — ~3–5 рабочих дней\n"
-    "• <b>InPost</b> — ~2 рабочих дня\n\n"
-    "Сроки могут незначительно отличаться в зависимости от региона и загрузки служб доставки."
-)
+def get_broadcast_menu_kb() -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text="➕ Новая рассылка", callback_data="broadcast_menu_new")],
+        [InlineKeyboardButton(text="✏️ Изменить рассылку", callback_data="broadcast_menu_edit")],
+        [InlineKeyboardButton(text="🗑 Удалить рассылку", callback_data="broadcast_menu_delete")],
+        [InlineKeyboardButton(text="⏰ Запланированные", callback_data="broadcast_menu_scheduled")],
+    ]
+    pending = pending_retries_count()
+    if pending:
+        rows.append([InlineKeyboardButton(text=f"🔁 Повторить недоставленные ({pending})", callback_data="broadcast_retry")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def get_info_keyboard() -> InlineKeyboardMarkup:
+def get_broadcast_cancel_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="🧾 Формирование заказа", callback_data="info_1")],
-            [InlineKeyboardButton(text="📦 Сбор заказа", callback_data="info_2")],
-            [InlineKeyboardButton(text="💳 Способы оплаты", callback_data="info_3")],
-            [InlineKeyboardButton(text="📍 Самовывоз", callback_data="info_4")],
-            [InlineKeyboardButton(text="🚚 Сроки доставки", callback_data="info_5")],
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel_mode")]
         ]
     )
 
 
-# ============ КОМАНДЫ ============
-
-@dp.message(CommandStart())
-async def cmd_start(message: types.Message):
+@dp.message(F.text.contains("Рассылка"))
+async def admin_broadcast_command(message: types.Message):
     user = message.from_user
     if user is None:
         return
 
-    save_user(user)
-    log_action(user, "start")
+    if user.id not in settings.admin_ids:
+        await message.answer(
+            "🚫 <b>Эта кнопка доступна только администратору.</b>\n\n"
+            f"Твой Telegram ID: <code>{user.id}</code>\n"
+            "Добавь его в <code>ADMIN_IDS</code> в .env — бот подхватит изменение сам, перезапуск не нужен."
+        )
+        return
 
+    log_action(user, Action.ADMIN_BROADCAST_BUTTON)
+
+    await cleanup_user_messages(message.chat.id, user.id)
     try:
         await message.delete()
     except Exception:
         pass
 
-    await cleanup_user_messages(chat_id=message.chat.id, user_id=user.id)
-
-    kb = get_main_keyboard(is_admin=user.id in ADMIN_IDS)
-    photo = FSInputFile("assets/tastyshop.jpg")
-
-    caption = (
-        "<b>🔥 TASTY SHOP</b> — надёжный поставщик электронных девайсов и жидкостей по всей Европе.\n\n"
-        "Выберите нужный раздел на клавиатуре ниже 👇"
-    )
+    if settings.archive_chat_id is None:
+        msg = await message.answer(
+            "⚠️ <b>ARCHIVE_CHAT_ID не настроен.</b>\n\n"
+            "Укажи ID архива в .env:\n"
+            "<code>ARCHIVE_CHAT_ID=-100...</code>\n\n"
+            "Чтобы узнать ID — напиши /chatid в архиве."
+        )
+        await remember_bot_message(user.id, msg.message_id)
+        return
 
-    msg = await message.answer_photo(
-        photo=photo,
-        caption=caption,
-        reply_markup=kb,
+    pending = pending_retries_count()
+    text = (
+        "📨 <b>Умная рассылка</b>\n\n"
+        + (f"🔁 Ожидают повтора: <b>{pending}</b>\n\n" if pending else "")
+        + "Выберите действие ниже 👇"
     )
+    msg = await message.answer(text, reply_markup=get_broadcast_menu_kb())
+    await remember_bot_message(user.id, msg.message_id)
 
-    greeting_messages[user.id] = msg.message_id
-    remember_bot_message(user.id, msg.message_id)
 
-    # ✅ Умная рассылка новым: отправляем ВСЕ прошлые, которых ещё не получал
-    await send_missing_broadcasts_to_user(user.id)
+@dp.callback_query(F.data == "broadcast_menu_new")
+async def broadcast_menu_new(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
 
+    await state.set_state(BroadcastStates.waiting_message)
+    await state.set_data({})
 
-@dp.message(Command("myid"))
-async def cmd_myid(message: types.Message):
-    user = message.from_user
-    if user is None:
-        return
+    await cleanup_user_messages(callback.message.chat.id, admin.id)
 
-    await message.answer(
-        f"Твой Telegram ID: <code>{user.id}</code>\n\n"
-        "Добавь его в переменную окружения <code>ADMIN_IDS</code> (через запятую, если админов несколько) "
-        "и перезапусти бота."
+    text = (
+        "➕ <b>Новая рассылка</b>\n\n"
+        "Отправь <b>одно сообщение</b>, которое нужно разослать.\n"
+        "Я сохраню его в Откаты и покажу предпросмотр."
     )
+    msg = await bot.send_message(chat_id=callback.message.chat.id, text=text, reply_markup=get_broadcast_cancel_kb())
+    await remember_bot_message(admin.id, msg.message_id)
 
+    await callback.answer()
 
-@dp.message(Command("chatid"))
-async def cmd_chatid(message: types.Message):
-    await message.answer(f"chat_id: <code>{message.chat.id}</code>")
 
+@dp.callback_query(F.data == "broadcast_cancel_mode")
+async def broadcast_cancel_mode(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
 
-# ============ ОБРАБОТЧИКИ КНОПОК ПОЛЬЗОВАТЕЛЯ ============
+    # если был черновик — удалим из архива
+    draft = await state.get_data()
+    await state.clear()
+    if draft.get("archive_message_id") and settings.archive_chat_id is not None:
+        try:
+            await bot.delete_message(chat_id=settings.archive_chat_id, message_id=draft["archive_message_id"])
+        except Exception:
+            pass
 
-@dp.message(F.text == "📦 НАЛИЧИЕ СТОКА")
-async def handle_stock(message: types.Message):
+    await cleanup_user_messages(callback.message.chat.id, admin.id)
+    msg = await bot.send_message(chat_id=callback.message.chat.id, text="❌ Отменено.")
+    await remember_bot_message(admin.id, msg.message_id)
+
+    await callback.answer()
+
+
+# ============ АДМИН: ПОЛУЧЕНИЕ СООБЩЕНИЯ ДЛЯ РАССЫЛКИ ============
+@dp.message(BroadcastStates.waiting_message, flags={"throttle_cost": 0})
+async def admin_broadcast_prepare(message: types.Message, state: FSMContext):
     user = message.from_user
-    if user is None:
+    if user is None or user.id not in settings.admin_ids:
+        await state.clear()
+        return
+
+    await state.set_state(None)
+
+    if settings.archive_chat_id is None:
+        await message.answer("⚠️ ARCHIVE_CHAT_ID не настроен, рассылка невозможна.")
+        return
+
+    log_action(user, Action.ADMIN_BROADCAST_PREPARE)
+
+    # 1) сохраняем в Откаты копией (без "переслано")
+    try:
+        archive_msg = await copy_to_archive(message)
+    except Exception as e:
+        await message.answer(f"❌ Не удалось сохранить в Откаты: {e}")
         return
 
-    log_action(user, "button_stock")
+    await state.set_data({"archive_message_id": archive_msg.message_id, "ttl_days": BROADCAST_TTL_DAYS})
+
     await cleanup_user_messages(message.chat.id, user.id)
 
+    # 2) предпросмотр админа: копия из Откатов (так же, как будет у пользователей)
     try:
-        await message.delete()
+        prev_mid = await copy_from_archive_to_chat(message.chat.id, archive_msg.message_id)
+        await remember_bot_message(user.id, prev_mid)
     except Exception:
         pass
 
     text = (
-        "📦 <b>Актуальное наличие стока</b>\n\n"
-        "Список доступного стока всегда обновляется в таблице по кнопке ниже:"
+        "👀 <b>Предпросмотр</b>\n\n"
+        "Это сообщение будет разослано <b>без «Переслано...»</b>.\n"
+        "⏳ Новые пользователи получат его при /start, пока не истечёт срок (выбери ниже).\n"
+        "Продолжить?"
     )
-    kb = InlineKeyboardMarkup(
+    preview_msg = await message.answer(text, reply_markup=get_broadcast_preview_kb(BROADCAST_TTL_DAYS))
+    await remember_bot_message(user.id, preview_msg.message_id)
+
+
+# варианты срока жизни рассылки в днях (0 — бессрочно)
+BROADCAST_TTL_CHOICES = (1, 7, 30, 0)
+
+
+def get_broadcast_preview_kb(ttl_days: int) -> InlineKeyboardMarkup:
+    ttl_row = []
+    for days in sorted({*BROADCAST_TTL_CHOICES, ttl_days}, key=lambda d: d or 10**6):
+        label = f"{days} дн." if days else "∞"
+        if days == ttl_days:
+            label = f"✅ {label}"
+        ttl_row.append(InlineKeyboardButton(text=label, callback_data=f"broadcast_ttl:{days}"))
+
+    return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(
-                    text="📊 ОТКРЫТЬ ТАБЛИЦУ",
-                    url="https://docs.google.com/spreadsheets/d/1UK8U5I_MNl3xjTxLG0-CJFCGBa41DHjuhK_ep7o7D5k/edit?usp=sharing",
-                )
-            ]
+                InlineKeyboardButton(text="🚀 Разослать", callback_data="broadcast_send"),
+                InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel"),
+            ],
+            [InlineKeyboardButton(text="⏰ Запланировать", callback_data="broadcast_schedule")],
+            ttl_row,
         ]
     )
 
-    msg = await message.answer(text, reply_markup=kb)
-    remember_bot_message(user.id, msg.message_id)
 
+@dp.callback_query(F.data.startswith("broadcast_ttl:"))
+async def broadcast_ttl_pick(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+
+    draft = await state.get_data()
+    if not draft.get("archive_message_id"):
+        await callback.answer("Черновик не найден. Создай рассылку заново.", show_alert=True)
+        return
 
-@dp.message(F.text == "👨‍💻Связь с менеджером")
-async def handle_manager(message: types.Message):
-    user = message.from_user
-    if user is None:
+    try:
+        ttl_days = max(int(callback.data.split(":", 1)[1]), 0)
+    except ValueError:
+        await callback.answer()
+        return
+
+    await state.update_data(ttl_days=ttl_days)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=get_broadcast_preview_kb(ttl_days))
+    except TelegramBadRequest:
+        pass
+    await callback.answer(f"Срок: {ttl_days} дн." if ttl_days else "Срок: бессрочно")
+
+
+# ============ АДМИН: ОТПРАВИТЬ / ОТМЕНА ============
+@dp.callback_query(F.data.in_({"broadcast_send", "broadcast_cancel"}))
+async def process_broadcast_action(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+
+    draft = await state.get_data()
+    if not draft.get("archive_message_id"):
+        await callback.answer("Черновик не найден. Создай рассылку заново.", show_alert=True)
+        return
+
+    archive_mid = draft["archive_message_id"]
+    ttl_days = int(draft.get("ttl_days", BROADCAST_TTL_DAYS))
+
+    # черновик забираем сразу — повторное нажатие (или другая реплика) его уже не найдёт
+    await state.clear()
+
+    if callback.data == "broadcast_cancel":
+        log_action(admin, Action.ADMIN_BROADCAST_CANCEL)
+
+        if settings.archive_chat_id is not None:
+            try:
+                await bot.delete_message(chat_id=settings.archive_chat_id, message_id=archive_mid)
+            except Exception:
+                pass
+
+        await cleanup_user_messages(callback.message.chat.id, admin.id)
+        msg = await bot.send_message(chat_id=callback.message.chat.id, text="❌ Рассылка отменена (и удалена из Откатов).")
+        await remember_bot_message(admin.id, msg.message_id)
+
+        await callback.answer("Отменено.")
+        return
+
+    await callback.answer("Запускаю рассылку...")
+    log_action(admin, Action.ADMIN_BROADCAST_START)
+
+    await cleanup_user_messages(callback.message.chat.id, admin.id)
+
+    # рассылка идёт фоном: хендлер освобождается, и кнопка «⏹ Стоп» обрабатывается сразу
+    spawn(broadcast_and_report(archive_mid, admin, callback.message.chat.id, ttl_days))
+
+
+async def broadcast_and_report(archive_mid: int, admin: types.User, chat_id: int, ttl_days: int | None = None) -> None:
+    try:
+        progress = await run_broadcast(archive_mid, admin.id, progress_chat_id=chat_id, ttl_days=ttl_days)
+    except Exception:
+        logging.exception(f"Рассылка {archive_mid} упала")
+        return
+
+    await send_broadcast_report(chat_id, admin.id, progress)
+    log_action(
+        admin, Action.ADMIN_BROADCAST_DONE,
+        broadcast_id=progress.broadcast_id, success=progress.sent, failed=progress.failed,
+        duration=round(progress.elapsed, 1),
+    )
+
+
+async def send_broadcast_report(chat_id: int, admin_id: int, progress: BroadcastProgress) -> None:
+    title = "⏹ <b>Рассылка остановлена</b>" if progress.stopped else "✅ <b>Рассылка завершена</b>"
+    text = (
+        f"{title}\n\n"
+        f"📬 Успешно доставлено: <b>{progress.sent}</b>\n"
+        f"⚠️ Ошибок: <b>{progress.failed}</b>\n"
+        + (f"🔁 Из них повторим автоматически: <b>{progress.retrying}</b>\n" if progress.retrying else "")
+        + (f"⏭ Пропущено (уже получили): <b>{progress.skipped}</b>\n" if progress.skipped else "")
+        + (f"⏳ Не отправлено: <b>{progress.total - progress.processed}</b>\n" if progress.stopped else "")
+        + f"\n🗂 ID рассылки (для удаления): <code>{progress.broadcast_id}</code>"
+    )
+
+    kb = None
+    if progress.stopped and progress.total > progress.processed:
+        kb = InlineKeyboardMarkup(
+            inline_keyboard=[[
+                InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"broadcast_resume:{progress.broadcast_id}")
+            ]]
+        )
+    msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=kb)
+    await remember_bot_message(admin_id, msg.message_id)
+
+
+@dp.callback_query(F.data.startswith("broadcast_stop:"))
+async def broadcast_stop(callback: types.CallbackQuery):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+
+    _, bid = callback.data.split(":", 1)
+    progress = active_broadcasts.get(bid)
+    if progress is None:
+        await callback.answer("Рассылка уже завершена.", show_alert=True)
         return
 
-    log_action(user, "button_manager")
-    await cleanup_user_messages(message.chat.id, user.id)
+    progress.stopped = True
+    log_action(admin, Action.ADMIN_BROADCAST_STOP)
+    await callback.answer("Останавливаю...")
 
-    try:
-        await message.delete()
-    except Exception:
-        pass
 
-    text = (
-        "👨‍💻 <b>Связь с оптовым менеджером</b>\n\n"
-        "Нажмите на кнопку ниже, чтобы сразу написать менеджеру в Telegram:"
-    )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Написать менеджеру", url="https://t.me/tasty2opt")]
-        ]
-    )
+@dp.callback_query(F.data.startswith("broadcast_resume:"))
+async def broadcast_resume(callback: types.CallbackQuery):
+    """
+    Продолжение остановленной рассылки: только тем, кто её ещё не получил.
+    """
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
 
-    msg = await message.answer(text, reply_markup=kb)
-    remember_bot_message(user.id, msg.message_id)
+    _, bid = callback.data.split(":", 1)
+    if bid in active_broadcasts:
+        await callback.answer("Рассылка уже идёт.", show_alert=True)
+        return
+    if not bid.isdigit() or store.seq_of(bid) is None:
+        await callback.answer("Рассылка не найдена (удалена?).", show_alert=True)
+        return
+    if not await offload(pending_recipients, bid):
+        await callback.answer("Её уже получили все.", show_alert=True)
+        return
 
+    log_action(admin, Action.ADMIN_BROADCAST_START, broadcast_id=bid)
+    await callback.answer("Продолжаю...")
+    spawn(broadcast_and_report(int(bid), admin, callback.message.chat.id))
 
-@dp.message(F.text == "📣 ИНФОРМАЦИОННЫЙ КАНАЛ")
-async def handle_channel(message: types.Message):
-    user = message.from_user
-    if user is None:
+
+@dp.callback_query(F.data == "broadcast_retry")
+async def broadcast_retry(callback: types.CallbackQuery):
+    """
+    Внеочередной повтор: только по списку недоставленных, без прохода по всем пользователям.
+    """
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
-    log_action(user, "button_channel")
-    await cleanup_user_messages(message.chat.id, user.id)
+    targets = pending_retries()
+    if not targets:
+        await callback.answer("Нет недоставленных для повтора.", show_alert=True)
+        return
+
+    log_action(admin, Action.ADMIN_BROADCAST_RETRY)
+    await callback.answer(f"Повторяю {len(targets)}...")
+    spawn(retry_and_report(targets, admin.id, callback.message.chat.id))
 
+
+async def retry_and_report(targets: list[tuple[str, str, dict[str, Any]]], admin_id: int, chat_id: int) -> None:
     try:
-        await message.delete()
+        ok, fail = await retry_deliveries(targets)
     except Exception:
-        pass
+        logging.exception("Повтор недоставленных упал")
+        return
 
+    log_action_by_id(admin_id, "", Action.ADMIN_BROADCAST_RETRY_DONE, success=ok, failed=fail)
+    pending = pending_retries_count()
     text = (
-        "📣 <b>Информационный канал Tasty Shop</b>\n\n"
-        "Все важные объявления, новости и обновления стока публикуются здесь:"
-    )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="TASTY SHOP🩸", url="https://t.me/+-LRYgeaxmyRhMzVk")]
-        ]
+        "🔁 <b>Повтор завершён</b>\n\n"
+        f"📬 Доставлено: <b>{ok}</b>\n"
+        f"⚠️ Снова ошибка: <b>{fail}</b>\n"
+        f"⏳ Ещё ожидают повтора: <b>{pending}</b>"
     )
+    try:
+        msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=get_broadcast_menu_kb())
+        await remember_bot_message(admin_id, msg.message_id)
+    except Exception:
+        pass
 
-    msg = await message.answer(text, reply_markup=kb)
-    remember_bot_message(user.id, msg.message_id)
 
+# ============ АДМИН: ОТЛОЖЕННЫЕ РАССЫЛКИ ============
 
-@dp.message(F.text == "🔥 Отзывы")
-async def handle_reviews(message: types.Message):
-    user = message.from_user
-    if user is None:
-        return
+_SCHEDULE_DAY_MONTH_RE = re.compile(r"^(\d{1,2})\.(\d{1,2}) (\d{1,2}):(\d{2})$")
 
-    log_action(user, "button_reviews")
-    await cleanup_user_messages(message.chat.id, user.id)
 
-    try:
-        await message.delete()
-    except Exception:
-        pass
+def parse_schedule_time(raw: str, now: datetime) -> datetime | None:
+    """
+    Понимает «ЧЧ:ММ» (сегодня или завтра, если время уже прошло),
+    «ДД.ММ ЧЧ:ММ» (ближайшая такая дата в будущем, 29.02 — в ближайший високосный год)
+    и «ДД.ММ.ГГГГ ЧЧ:ММ». Время — серверное. Несуществующая дата — None.
+    """
+    raw = " ".join(raw.split())
 
-    text = (
-        "🔥 <b>Отзывы клиентов</b>\n\n"
-        "Посмотреть отзывы о работе Tasty Shop вы можете по кнопке ниже:"
-    )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="ОТКРЫТЬ ОТЗЫВЫ", url="https://t.me/+-LRYgeaxmyRhMzVk")]
-        ]
-    )
+    m = _SCHEDULE_DAY_MONTH_RE.match(raw)
+    if m:
+        day, month, hour, minute = map(int, m.groups())
+        # strptime без года берёт 1900 (не високосный) — поэтому год подбираем сами
+        for year in range(now.year, now.year + 9):
+            try:
+                run_at = datetime(year, month, day, hour, minute)
+            except ValueError:
+                if not 1 <= month <= 12 or not 0 <= hour <= 23 or not 0 <= minute <= 59:
+                    return None
+                continue
+            if run_at > now:
+                return run_at
+        return None
 
-    msg = await message.answer(text, reply_markup=kb)
-    remember_bot_message(user.id, msg.message_id)
+    for fmt in ("%d.%m.%Y %H:%M", "%H:%M"):
+        try:
+            parsed = datetime.strptime(raw, fmt)
+        except ValueError:
+            continue
 
+        if fmt == "%H:%M":
+            run_at = now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+            if run_at <= now:
+                run_at += timedelta(days=1)
+            return run_at
 
-@dp.message(F.text == "ℹ️ ИНФОРМАЦИЯ ДЛЯ ЗАКАЗА")
-async def handle_order_info(message: types.Message):
-    user = message.from_user
-    if user is None:
-        return
+        return parsed
+    return None
 
-    log_action(user, "button_info_main")
-    await cleanup_user_messages(message.chat.id, user.id)
 
-    try:
-        await message.delete()
-    except Exception:
-        pass
+class BroadcastScheduler:
+    """
+    Один таймер на все отложенные рассылки: heap по времени запуска.
+    Задания лежат в хранилище (schedules.json + WAL), поэтому переживают
+    перезапуск бота — просроченные запускаются сразу после старта.
+    Упавшее задание повторяется с паузой retry_delay; после RETRY_MAX_ATTEMPTS попыток
+    получает статус failed (остаётся в списке, пока админ его не отменит).
+    """
 
-    text = (
-        "ℹ️ <b>Информация для заказа</b>\n\n"
-        "Выберите интересующий раздел ниже:"
-    )
-    kb = get_info_keyboard()
+    def __init__(self):
+        self._heap: list[tuple[float, str]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
 
-    msg = await message.answer(text, reply_markup=kb)
-    remember_bot_message(user.id, msg.message_id)
+    async def load(self) -> None:
+        self._heap = []
+        for job in load_schedules():
+            if job.get("status") == "failed":
+                continue
+            if job.get("status") != "pending":
+                # упавшие на середине перезапускаем: кто уже получил — пропустится
+                job = {**job, "status": "pending"}
+                await store.submit("schedule_put", job=job)
+            heapq.heappush(self._heap, (self._run_ts(job), job["job_id"]))
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def list_jobs(self) -> list[dict[str, Any]]:
+        return sorted(load_schedules(), key=self._run_ts)
+
+    async def add(
+        self, archive_mid: int, run_at: datetime, created_by: int, chat_id: int, ttl_days: int | None = None
+    ) -> dict[str, Any]:
+        job_id = str(archive_mid)
+        job = {
+            "job_id": job_id,
+            "archive_message_id": int(archive_mid),
+            "run_at": run_at.isoformat(timespec="seconds"),
+            "created_by": created_by,
+            "chat_id": chat_id,
+            "ttl_days": ttl_days,
+            "status": "pending",
+        }
+        await store.submit("schedule_put", job=job)
+        heapq.heappush(self._heap, (self._run_ts(job), job_id))
+        self._wakeup.set()
+        return job
+
+    async def cancel(self, job_id: str) -> dict[str, Any] | None:
+        job = store.schedules.get(job_id)
+        if job is None or job.get("status") == "running":
+            return None
+        # из heap не вынимаем — при срабатывании задания просто не окажется в хранилище
+        return await store.submit("schedule_remove", job_id=job_id)
+
+    @staticmethod
+    def _run_ts(job: dict[str, Any]) -> float:
+        try:
+            return datetime.fromisoformat(job["run_at"]).timestamp()
+        except Exception:
+            return 0.0
+
+    async def _run(self) -> None:
+        while True:
+            now = datetime.now().timestamp()
+            while self._heap and self._heap[0][0] <= now:
+                _, job_id = heapq.heappop(self._heap)
+                job = store.schedules.get(job_id)
+                if job is None or job.get("status") != "pending":
+                    continue
+                spawn(self._fire(job))
 
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
 
-@dp.callback_query(F.data.startswith("info_"))
-async def process_info_callback(callback: types.CallbackQuery):
-    user = callback.from_user
-    if user is None:
-        await callback.answer()
-        return
+    async def _fire(self, job: dict[str, Any]) -> None:
+        await store.submit("schedule_put", job={**job, "status": "running"})
 
-    data = callback.data or ""
+        archive_mid = job["archive_message_id"]
+        admin_id = int(job.get("created_by", 0))
+        log_action_by_id(admin_id, "", Action.SCHEDULED_BROADCAST_START)
 
-    if data == "info_1":
-        text = INFO_1_TEXT
-        log_action(user, "info_1")
-    elif data == "info_2":
-        text = INFO_2_TEXT
-        log_action(user, "info_2")
-    elif data == "info_3":
-        text = INFO_3_TEXT
-        log_action(user, "info_3")
-    elif data == "info_4":
-        text = INFO_4_TEXT
-        log_action(user, "info_4")
-    else:
-        text = INFO_5_TEXT
-        log_action(user, "info_5")
+        try:
+            progress = await run_broadcast(
+                archive_mid, admin_id, progress_chat_id=int(job.get("chat_id", admin_id)), ttl_days=job.get("ttl_days")
+            )
+        except Exception as e:
+            logging.exception(f"Отложенная рассылка {archive_mid} упала")
+            await self._failed(job, e)
+            return
+
+        # задание снимаем только после завершения — если бот упадёт посреди рассылки,
+        # после рестарта она продолжится с тех, кто ещё не получил
+        await store.submit("schedule_remove", job_id=job["job_id"])
+        log_action_by_id(
+            admin_id, "", Action.ADMIN_BROADCAST_DONE,
+            broadcast_id=progress.broadcast_id, success=progress.sent, failed=progress.failed,
+            duration=round(progress.elapsed, 1),
+        )
 
-    try:
-        await callback.message.edit_text(text, reply_markup=get_info_keyboard())
-    except Exception:
-        msg = await callback.message.answer(text, reply_markup=get_info_keyboard())
-        remember_bot_message(user.id, msg.message_id)
+        try:
+            await send_broadcast_report(int(job.get("chat_id", admin_id)), admin_id, progress)
+        except Exception:
+            pass
 
-    await callback.answer()
+    async def _failed(self, job: dict[str, Any], error: BaseException) -> None:
+        """
+        Повтор с нарастающей паузой, а когда попытки кончились — failed и сообщение админу.
+        """
+        attempts = int(job.get("attempts", 0)) + 1
+        job = {**job, "attempts": attempts, "error": f"{type(error).__name__}: {error}"[:200]}
+        admin_id = int(job.get("created_by", 0))
+        chat_id = int(job.get("chat_id", admin_id))
+
+        if attempts < RETRY_MAX_ATTEMPTS:
+            run_at = datetime.now() + timedelta(seconds=retry_delay(attempts))
+            job.update(status="pending", run_at=run_at.isoformat(timespec="seconds"))
+            await store.submit("schedule_put", job=job)
+            heapq.heappush(self._heap, (self._run_ts(job), job["job_id"]))
+            self._wakeup.set()
+            text = (
+                f"⚠️ Отложенная рассылка <code>{job['job_id']}</code> не удалась "
+                f"(попытка {attempts} из {RETRY_MAX_ATTEMPTS}). Повтор в {run_at.strftime('%H:%M')}."
+            )
+        else:
+            job["status"] = "failed"
+            await store.submit("schedule_put", job=job)
+            log_action_by_id(admin_id, "", Action.SCHEDULED_BROADCAST_FAILED, broadcast_id=job["job_id"])
+            text = (
+                f"❌ Отложенная рассылка <code>{job['job_id']}</code> не удалась после "
+                f"{attempts} попыток: <code>{html.escape(job['error'])}</code>\n"
+                "Её можно отменить в «⏰ Запланированные»."
+            )
 
+        try:
+            msg = await bot.send_message(chat_id=chat_id, text=text)
+            await remember_bot_message(admin_id, msg.message_id)
+        except Exception:
+            logging.exception("Не удалось сообщить админу об ошибке отложенной рассылки")
 
-# ============ АДМИН: РАССЫЛКА (МЕНЮ) ============
 
-def get_broadcast_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="➕ Новая рассылка", callback_data="broadcast_menu_new")],
-            [InlineKeyboardButton(text="🗑 Удалить рассылку", callback_data="broadcast_menu_delete")],
-        ]
-    )
+broadcast_scheduler = BroadcastScheduler()
 
 
-def get_broadcast_cancel_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
+@dp.callback_query(F.data == "broadcast_schedule")
+async def broadcast_schedule_ask(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+
+    draft = await state.get_data()
+    if not draft.get("archive_message_id"):
+        await callback.answer("Черновик не найден. Создай рассылку заново.", show_alert=True)
+        return
+
+    await state.set_state(BroadcastStates.waiting_schedule_time)
+
+    text = (
+        "⏰ <b>Отложенная рассылка</b>\n\n"
+        "Отправь время запуска (по времени сервера):\n"
+        "• <code>ЧЧ:ММ</code> — сегодня (или завтра, если время прошло)\n"
+        "• <code>ДД.ММ ЧЧ:ММ</code>\n"
+        "• <code>ДД.ММ.ГГГГ ЧЧ:ММ</code>"
+    )
+    kb = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel_mode")]
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel")]
         ]
     )
+    msg = await bot.send_message(chat_id=callback.message.chat.id, text=text, reply_markup=kb)
+    await remember_bot_message(admin.id, msg.message_id)
 
+    await callback.answer()
 
-@dp.message(F.text.contains("Рассылка"))
-async def admin_broadcast_command(message: types.Message):
-    user = message.from_user
-    if user is None:
-        return
 
-    if user.id not in ADMIN_IDS:
-        await message.answer(
-            "🚫 <b>Эта кнопка доступна только администратору.</b>\n\n"
-            f"Твой Telegram ID: <code>{user.id}</code>\n"
-            "Добавь его в переменную окружения <code>ADMIN_IDS</code> и перезапусти бота."
-        )
+@dp.message(BroadcastStates.waiting_schedule_time, flags={"throttle_cost": 0})
+async def admin_broadcast_schedule_time(message: types.Message, state: FSMContext):
+    user = message.from_user
+    draft = await state.get_data()
+    if user is None or user.id not in settings.admin_ids or not draft.get("archive_message_id"):
+        await state.clear()
         return
 
-    log_action(user, "admin_broadcast_button")
-
-    await cleanup_user_messages(message.chat.id, user.id)
     try:
         await message.delete()
     except Exception:
         pass
 
-    if ARCHIVE_CHAT_ID is None:
+    now = datetime.now()
+    run_at = parse_schedule_time(message.text or "", now)
+    if run_at is None or run_at <= now:
         msg = await message.answer(
-            "⚠️ <b>ARCHIVE_CHAT_ID не настроен.</b>\n\n"
-            "Укажи ID архива в .env:\n"
-            "<code>ARCHIVE_CHAT_ID=-100...</code>\n\n"
-            "Чтобы узнать ID — напиши /chatid в архиве."
+            "⚠️ Не понял время. Пример: <code>18:30</code> или <code>25.12 10:00</code>.\n"
+            "Время должно быть в будущем."
         )
-        remember_bot_message(user.id, msg.message_id)
+        await remember_bot_message(user.id, msg.message_id)
         return
 
+    await state.clear()
+
+    job = await broadcast_scheduler.add(
+        draft["archive_message_id"], run_at, user.id, message.chat.id, ttl_days=draft.get("ttl_days")
+    )
+    log_action(user, Action.ADMIN_BROADCAST_SCHEDULE)
+
+    await cleanup_user_messages(message.chat.id, user.id)
+
     text = (
-        "📨 <b>Умная рассылка</b>\n\n"
-        "Выберите действие ниже 👇"
+        "⏰ <b>Рассылка запланирована</b>\n\n"
+        f"🕒 Запуск: <b>{run_at.strftime('%d.%m.%Y %H:%M')}</b>\n"
+        f"🗂 ID рассылки: <code>{job['job_id']}</code>\n\n"
+        "Посмотреть или отменить — «📨 Рассылка» → «⏰ Запланированные»."
     )
     msg = await message.answer(text, reply_markup=get_broadcast_menu_kb())
-    remember_bot_message(user.id, msg.message_id)
+    await remember_bot_message(user.id, msg.message_id)
 
 
-@dp.callback_query(F.data == "broadcast_menu_new")
-async def broadcast_menu_new(callback: types.CallbackQuery):
+@dp.callback_query(F.data == "broadcast_menu_scheduled")
+async def broadcast_menu_scheduled(callback: types.CallbackQuery):
     admin = callback.from_user
-    if admin is None or admin.id not in ADMIN_IDS:
+    if admin is None or admin.id not in settings.admin_ids:
         await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
-    pending_broadcast_admins.add(admin.id)
-    broadcast_drafts.pop(admin.id, None)
-
     await cleanup_user_messages(callback.message.chat.id, admin.id)
 
-    text = (
-        "➕ <b>Новая рассылка</b>\n\n"
-        "Отправь <b>одно сообщение</b>, которое нужно разослать.\n"
-        "Я сохраню его в Откаты и покажу предпросмотр."
+    jobs = broadcast_scheduler.list_jobs()
+
+    kb_rows: list[list[InlineKeyboardButton]] = []
+    lines = ["⏰ <b>Запланированные рассылки</b>", ""]
+    if not jobs:
+        lines.append("Нет запланированных рассылок.")
+
+    for job in jobs:
+        try:
+            when = datetime.fromisoformat(job["run_at"]).strftime("%d.%m.%Y %H:%M")
+        except Exception:
+            when = job.get("run_at", "?")
+        job_id = job["job_id"]
+
+        if job.get("status") == "running":
+            lines.append(f"▶️ <code>{job_id}</code> — {when} (выполняется)")
+            continue
+
+        if job.get("status") == "failed":
+            lines.append(f"⚠️ <code>{job_id}</code> — {when} (не удалась: {html.escape(str(job.get('error', '?')))})")
+        elif job.get("attempts"):
+            lines.append(f"🕒 <code>{job_id}</code> — {when} (повтор, попытка {job['attempts'] + 1})")
+        else:
+            lines.append(f"🕒 <code>{job_id}</code> — {when}")
+        kb_rows.append(
+            [InlineKeyboardButton(text=f"❌ Отменить ID {job_id} | {when}", callback_data=f"broadcast_schedule_cancel:{job_id}")]
+        )
+
+    kb_rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="broadcast_back_to_menu")])
+
+    msg = await bot.send_message(
+        chat_id=callback.message.chat.id,
+        text="\n".join(lines),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows),
     )
-    msg = await bot.send_message(chat_id=callback.message.chat.id, text=text, reply_markup=get_broadcast_cancel_kb())
-    remember_bot_message(admin.id, msg.message_id)
+    await remember_bot_message(admin.id, msg.message_id)
 
     await callback.answer()
 
 
-@dp.callback_query(F.data == "broadcast_cancel_mode")
-async def broadcast_cancel_mode(callback: types.CallbackQuery):
+@dp.callback_query(F.data.startswith("broadcast_schedule_cancel:"))
+async def broadcast_schedule_cancel(callback: types.CallbackQuery):
     admin = callback.from_user
-    if admin is None or admin.id not in ADMIN_IDS:
+    if admin is None or admin.id not in settings.admin_ids:
         await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
-    pending_broadcast_admins.discard(admin.id)
+    _, job_id = callback.data.split(":", 1)
 
-    # если был черновик — удалим из архива
-    draft = broadcast_drafts.pop(admin.id, None)
-    if draft and ARCHIVE_CHAT_ID is not None:
+    job = await broadcast_scheduler.cancel(job_id)
+    if job is None:
+        await callback.answer("Рассылка уже запущена или не найдена.", show_alert=True)
+        return
+
+    log_action(admin, Action.ADMIN_BROADCAST_SCHEDULE_CANCEL)
+
+    # черновик в Откатах больше не нужен
+    if settings.archive_chat_id is not None:
         try:
-            await bot.delete_message(chat_id=ARCHIVE_CHAT_ID, message_id=draft["archive_message_id"])
+            await bot.delete_message(chat_id=settings.archive_chat_id, message_id=job["archive_message_id"])
         except Exception:
             pass
 
     await cleanup_user_messages(callback.message.chat.id, admin.id)
-    msg = await bot.send_message(chat_id=callback.message.chat.id, text="❌ Отменено.")
-    remember_bot_message(admin.id, msg.message_id)
-
-    await callback.answer()
+    msg = await bot.send_message(
+        chat_id=callback.message.chat.id,
+        text=f"❌ Отложенная рассылка <code>{job_id}</code> отменена (и удалена из Откатов).",
+        reply_markup=get_broadcast_menu_kb(),
+    )
+    await remember_bot_message(admin.id, msg.message_id)
 
+    await callback.answer("Отменено.")
 
-# ============ АДМИН: ПОЛУЧЕНИЕ СООБЩЕНИЯ ДЛЯ РАССЫЛКИ ============
-@dp.message()
-async def admin_broadcast_prepare(message: types.Message):
-    user = message.from_user
-    if user is None:
-        raise SkipHandler
 
-    if user.id not in ADMIN_IDS or user.id not in pending_broadcast_admins:
-        raise SkipHandler
+# ============ АДМИН: СПИСОК РАССЫЛОК ============
+# Общий постраничный список для удаления ("d") и изменения ("e").
+# callback_data: bcl:<режим>:<автор или 0>:<b — старее seq | a — новее seq>:<seq>, seq 0 — самые новые.
+# Страница — срез индекса хранилища (store.page), без загрузки и сортировки всего архива.
 
-    if ARCHIVE_CHAT_ID is None:
-        pending_broadcast_admins.discard(user.id)
-        await message.answer("⚠️ ARCHIVE_CHAT_ID не настроен, рассылка невозможна.")
-        return
+BROWSER_MODES = {
+    "d": ("🗑", "Удаление рассылки", "Выбери рассылку — бот покажет предпросмотр (сверху) и попросит подтверждение (снизу).", "broadcast_delete_pick"),
+    "e": ("✏️", "Изменение рассылки", "Выбери рассылку — бот покажет текущую версию и попросит прислать исправленный текст.", "broadcast_edit_pick"),
+}
 
-    pending_broadcast_admins.discard(user.id)
-    log_action(user, "admin_broadcast_prepare")
 
-    # 1) сохраняем в Откаты копией (без "переслано")
+def _short_dt(iso: str) -> str:
     try:
-        archive_msg = await copy_to_archive(message)
-    except Exception as e:
-        await message.answer(f"❌ Не удалось сохранить в Откаты: {e}")
-        return
+        return datetime.fromisoformat(iso).strftime("%d.%m.%y %H:%M")
+    except ValueError:
+        return iso
+
+
+def render_broadcast_browser(
+    mode: str, author: int | None, direction: str, seq: int, note: str = ""
+) -> tuple[str, InlineKeyboardMarkup]:
+    store.ensure_loaded()
+    icon, title, hint, pick = BROWSER_MODES[mode]
+    before = seq if direction == "b" and seq else None
+    after = seq if direction == "a" else None
+    page, has_newer, has_older = store.page(before, after, author, BROADCAST_PAGE_SIZE)
+    a = author or 0
+
+    lines = [f"{icon} <b>{title}</b>", ""]
+    if author is not None:
+        lines.append(f"👤 Автор: <code>{author}</code>")
+    if note:
+        lines.append(note)
+    if page:
+        lines.append(hint)
+    elif not store.broadcasts:
+        lines.append("Архив пуст.")
+    else:
+        lines.append("Ничего не найдено.")
+
+    kb_rows: list[list[InlineKeyboardButton]] = []
+    for b in page:
+        mid = b.get("archive_message_id")
+        if not isinstance(mid, int):
+            continue
+        count = store.delivery_counts.get(str(mid), 0)
+        label = f"{icon} {_short_dt(str(b.get('created_at', '')))} · ID {mid} · 👥 {count}"
+        if b.get("expired"):
+            label += " · ⌛"
+        kb_rows.append([InlineKeyboardButton(text=label, callback_data=f"{pick}:{mid}")])
+
+    nav: list[InlineKeyboardButton] = []
+    if has_newer and page:
+        nav.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"bcl:{mode}:{a}:a:{page[0]['seq']}"))
+    if has_older and page:
+        nav.append(InlineKeyboardButton(text="Старее ▶️", callback_data=f"bcl:{mode}:{a}:b:{page[-1]['seq']}"))
+    if nav:
+        kb_rows.append(nav)
+
+    filters = [InlineKeyboardButton(text="📅 К дате", callback_data=f"bcl_date:{mode}:{a}")]
+    if author is None:
+        filters.append(InlineKeyboardButton(text="👤 Автор", callback_data=f"bcl_author:{mode}"))
+    else:
+        filters.append(InlineKeyboardButton(text="👥 Все авторы", callback_data=f"bcl:{mode}:0:b:0"))
+    if store.broadcasts:
+        kb_rows.append(filters)
 
-    broadcast_drafts[user.id] = {"archive_message_id": archive_msg.message_id}
+    kb_rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="broadcast_back_to_menu")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=kb_rows)
 
-    await cleanup_user_messages(message.chat.id, user.id)
 
-    # 2) предпросмотр админа: копия из Откатов (так же, как будет у пользователей)
-    try:
-        prev_mid = await copy_from_archive_to_chat(message.chat.id, archive_msg.message_id)
-        remember_bot_message(user.id, prev_mid)
-    except Exception:
-        pass
+def parse_browse_date(raw: str, now: datetime) -> str | None:
+    """
+    «ДД.ММ.ГГГГ», «ДД.ММ» (текущий год) или «ГГГГ-ММ-ДД» -> "YYYY-MM-DD".
+    """
+    raw = raw.strip()
+    for fmt in ("%d.%m.%Y", "%d.%m", "%Y-%m-%d"):
+        try:
+            parsed = datetime.strptime(raw, fmt)
+        except ValueError:
+            continue
+        if fmt == "%d.%m":
+            parsed = parsed.replace(year=now.year)
+        return parsed.strftime("%Y-%m-%d")
+    return None
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🚀 Разослать", callback_data="broadcast_send"),
-                InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel"),
-            ]
-        ]
-    )
 
-    text = (
-        "👀 <b>Предпросмотр</b>\n\n"
-        "Это сообщение будет разослано <b>без «Переслано...»</b>.\n"
-        "Продолжить?"
-    )
-    preview_msg = await message.answer(text, reply_markup=kb)
-    remember_bot_message(user.id, preview_msg.message_id)
+@dp.callback_query(F.data.startswith("bcl:"))
+async def broadcast_browser_page(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+
+    try:
+        _, mode, author, direction, seq = callback.data.split(":")
+        author_id, cursor = int(author) or None, int(seq)
+    except ValueError:
+        await callback.answer()
+        return
+    if mode not in BROWSER_MODES:
+        await callback.answer()
+        return
+
+    if await state.get_state() == BroadcastStates.waiting_browse_date.state:
+        await state.clear()
+
+    text, kb = render_broadcast_browser(mode, author_id, direction, cursor)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
 
-# ============ АДМИН: ОТПРАВИТЬ / ОТМЕНА ============
-@dp.callback_query(F.data.in_({"broadcast_send", "broadcast_cancel"}))
-async def process_broadcast_action(callback: types.CallbackQuery):
+@dp.callback_query(F.data.startswith("bcl_author:"))
+async def broadcast_browser_authors(callback: types.CallbackQuery):
     admin = callback.from_user
-    if admin is None or admin.id not in ADMIN_IDS:
+    if admin is None or admin.id not in settings.admin_ids:
         await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
-    draft = broadcast_drafts.get(admin.id)
-    if not draft:
-        await callback.answer("Черновик не найден. Создай рассылку заново.", show_alert=True)
+    _, mode = callback.data.split(":", 1)
+    if mode not in BROWSER_MODES:
+        await callback.answer()
         return
 
-    archive_mid = draft["archive_message_id"]
-    broadcast_id = str(archive_mid)
-
-    if callback.data == "broadcast_cancel":
-        broadcast_drafts.pop(admin.id, None)
-        log_action(admin, "admin_broadcast_cancel")
+    store.ensure_loaded()
+    kb_rows = [
+        [InlineKeyboardButton(text=f"👤 {author} · {len(seqs)}", callback_data=f"bcl:{mode}:{author}:b:0")]
+        for author, seqs in sorted(store._author_seqs.items(), key=lambda kv: -len(kv[1]))
+    ]
+    kb_rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"bcl:{mode}:0:b:0")])
 
-        if ARCHIVE_CHAT_ID is not None:
-            try:
-                await bot.delete_message(chat_id=ARCHIVE_CHAT_ID, message_id=archive_mid)
-            except Exception:
-                pass
+    icon, title, _, _ = BROWSER_MODES[mode]
+    text = f"{icon} <b>{title}</b>\n\nЧьи рассылки показать? (рядом — сколько их в архиве)"
+    try:
+        await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
-        await cleanup_user_messages(callback.message.chat.id, admin.id)
-        msg = await bot.send_message(chat_id=callback.message.chat.id, text="❌ Рассылка отменена (и удалена из Откатов).")
-        remember_bot_message(admin.id, msg.message_id)
 
-        await callback.answer("Отменено.")
+@dp.callback_query(F.data.startswith("bcl_date:"))
+async def broadcast_browser_date_ask(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
-    await callback.answer("Запускаю рассылку...")
-    log_action(admin, "admin_broadcast_start")
+    try:
+        _, mode, author = callback.data.split(":")
+        author_id = int(author)
+    except ValueError:
+        await callback.answer()
+        return
+    if mode not in BROWSER_MODES:
+        await callback.answer()
+        return
 
-    # добавляем рассылку в список (архив) — чтобы новым юзерам приходила
-    broadcasts = load_broadcasts()
-    if not any(str(b.get("archive_message_id")) == broadcast_id for b in broadcasts):
-        broadcasts.append(
-            {
-                "archive_message_id": int(archive_mid),
-                "created_at": datetime.now().isoformat(timespec="seconds"),
-                "created_by": admin.id,
-            }
-        )
-        save_broadcasts(broadcasts)
+    await state.set_state(BroadcastStates.waiting_browse_date)
+    await state.set_data({"browse_mode": mode, "browse_author": author_id})
 
-    user_ids = get_user_ids()
+    icon, title, _, _ = BROWSER_MODES[mode]
+    text = (
+        f"{icon} <b>{title}</b>\n\n"
+        "📅 Отправь дату — покажу рассылки за этот день и раньше:\n"
+        "• <code>ДД.ММ</code>\n"
+        "• <code>ДД.ММ.ГГГГ</code>"
+    )
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data=f"bcl:{mode}:{author_id}:b:0")]]
+    )
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
-    success = 0
-    failed = 0
-    ops = 0
 
-    for uid in user_ids:
-        # не шлём повторно тем, кто уже получал
-        if was_delivered(uid, broadcast_id):
-            continue
-        try:
-            new_mid = await copy_from_archive_to_chat(uid, archive_mid)
-            mark_delivered(uid, broadcast_id, new_mid)
-            success += 1
-        except Exception:
-            failed += 1
+@dp.message(BroadcastStates.waiting_browse_date, flags={"throttle_cost": 0})
+async def broadcast_browser_date(message: types.Message, state: FSMContext):
+    user = message.from_user
+    data = await state.get_data()
+    if user is None or user.id not in settings.admin_ids or data.get("browse_mode") not in BROWSER_MODES:
+        await state.clear()
+        return
 
-        ops += 1
-        if ops % 25 == 0:
-            await asyncio.sleep(1)
+    try:
+        await message.delete()
+    except Exception:
+        pass
 
-    broadcast_drafts.pop(admin.id, None)
+    day = parse_browse_date(message.text or "", datetime.now())
+    if day is None:
+        msg = await message.answer("⚠️ Не понял дату. Пример: <code>25.12</code> или <code>25.12.2025</code>.")
+        await remember_bot_message(user.id, msg.message_id)
+        return
 
-    await cleanup_user_messages(callback.message.chat.id, admin.id)
+    await state.clear()
+    await cleanup_user_messages(message.chat.id, user.id)
 
-    text = (
-        "✅ <b>Рассылка завершена</b>\n\n"
-        f"📬 Успешно доставлено: <b>{success}</b>\n"
-        f"⚠️ Ошибок: <b>{failed}</b>\n\n"
-        f"🗂 ID рассылки (для удаления): <code>{broadcast_id}</code>"
+    store.ensure_loaded()
+    text, kb = render_broadcast_browser(
+        data["browse_mode"],
+        data.get("browse_author") or None,
+        "b",
+        store.seq_cursor_for_day(day),
+        note=f"📅 По {datetime.strptime(day, '%Y-%m-%d').strftime('%d.%m.%Y')} включительно",
     )
-
-    msg = await bot.send_message(chat_id=callback.message.chat.id, text=text)
-    remember_bot_message(admin.id, msg.message_id)
-    log_action(admin, f"admin_broadcast_done_success_{success}_failed_{failed}")
+    msg = await message.answer(text, reply_markup=kb)
+    await remember_bot_message(user.id, msg.message_id)
 
 
 # ============ АДМИН: УДАЛЕНИЕ РАССЫЛКИ ============
@@ -1053,49 +4489,15 @@ async def process_broadcast_action(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "broadcast_menu_delete")
 async def broadcast_menu_delete(callback: types.CallbackQuery):
     admin = callback.from_user
-    if admin is None or admin.id not in ADMIN_IDS:
+    if admin is None or admin.id not in settings.admin_ids:
         await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
-    broadcasts = load_broadcasts()
     await cleanup_user_messages(callback.message.chat.id, admin.id)
 
-    if not broadcasts:
-        msg = await bot.send_message(
-            chat_id=callback.message.chat.id,
-            text="🗑 <b>Удаление рассылки</b>\n\nАрхив пуст.",
-            reply_markup=get_broadcast_menu_kb()
-        )
-        remember_bot_message(admin.id, msg.message_id)
-        await callback.answer()
-        return
-
-    # показываем последние 10
-    broadcasts_sorted = sorted(
-        broadcasts,
-        key=lambda b: (b.get("created_at", ""), int(b.get("archive_message_id", 0))),
-        reverse=True,
-    )[:10]
-
-    kb_rows: list[list[InlineKeyboardButton]] = []
-    for b in broadcasts_sorted:
-        mid = b.get("archive_message_id")
-        created = b.get("created_at", "")
-        if not isinstance(mid, int):
-            continue
-        label = f"🗑 ID {mid} | {created}"
-        kb_rows.append([InlineKeyboardButton(text=label, callback_data=f"broadcast_delete_pick:{mid}")])
-
-    kb_rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="broadcast_back_to_menu")])
-    kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
-
-    text = (
-        "🗑 <b>Удаление рассылки</b>\n\n"
-        "Выбери рассылку — бот покажет предпросмотр (сверху) и попросит подтверждение (снизу)."
-    )
-
+    text, kb = render_broadcast_browser("d", None, "b", 0)
     msg = await bot.send_message(chat_id=callback.message.chat.id, text=text, reply_markup=kb)
-    remember_bot_message(admin.id, msg.message_id)
+    await remember_bot_message(admin.id, msg.message_id)
 
     await callback.answer()
 
@@ -1103,7 +4505,7 @@ async def broadcast_menu_delete(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "broadcast_back_to_menu")
 async def broadcast_back_to_menu(callback: types.CallbackQuery):
     admin = callback.from_user
-    if admin is None or admin.id not in ADMIN_IDS:
+    if admin is None or admin.id not in settings.admin_ids:
         await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
@@ -1114,7 +4516,7 @@ async def broadcast_back_to_menu(callback: types.CallbackQuery):
         text="📨 <b>Умная рассылка</b>",
         reply_markup=get_broadcast_menu_kb()
     )
-    remember_bot_message(admin.id, msg.message_id)
+    await remember_bot_message(admin.id, msg.message_id)
 
     await callback.answer()
 
@@ -1122,11 +4524,11 @@ async def broadcast_back_to_menu(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("broadcast_delete_pick:"))
 async def broadcast_delete_pick(callback: types.CallbackQuery):
     admin = callback.from_user
-    if admin is None or admin.id not in ADMIN_IDS:
+    if admin is None or admin.id not in settings.admin_ids:
         await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
-    if ARCHIVE_CHAT_ID is None:
+    if settings.archive_chat_id is None:
         await callback.answer("ARCHIVE_CHAT_ID не настроен.", show_alert=True)
         return
 
@@ -1136,7 +4538,7 @@ async def broadcast_delete_pick(callback: types.CallbackQuery):
     # предпросмотр сверху: копия из откатов (без "переслано")
     try:
         prev_mid = await copy_from_archive_to_chat(callback.message.chat.id, int(bid))
-        remember_bot_message(admin.id, prev_mid)
+        await remember_bot_message(admin.id, prev_mid)
     except Exception:
         pass
 
@@ -1159,7 +4561,7 @@ async def broadcast_delete_pick(callback: types.CallbackQuery):
     )
 
     msg = await bot.send_message(chat_id=callback.message.chat.id, text=text, reply_markup=kb)
-    remember_bot_message(admin.id, msg.message_id)
+    await remember_bot_message(admin.id, msg.message_id)
 
     await callback.answer()
 
@@ -1167,7 +4569,7 @@ async def broadcast_delete_pick(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("broadcast_delete_confirm:"))
 async def broadcast_delete_confirm(callback: types.CallbackQuery):
     admin = callback.from_user
-    if admin is None or admin.id not in ADMIN_IDS:
+    if admin is None or admin.id not in settings.admin_ids:
         await callback.answer("Недостаточно прав.", show_alert=True)
         return
 
@@ -1191,26 +4593,139 @@ async def broadcast_delete_confirm(callback: types.CallbackQuery):
         text=text,
         reply_markup=get_broadcast_menu_kb()
     )
-    remember_bot_message(admin.id, msg.message_id)
+    await remember_bot_message(admin.id, msg.message_id)
+
+
+# ============ АДМИН: ИЗМЕНЕНИЕ РАССЫЛКИ ============
+
+@dp.callback_query(F.data == "broadcast_menu_edit")
+async def broadcast_menu_edit(callback: types.CallbackQuery):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+
+    await cleanup_user_messages(callback.message.chat.id, admin.id)
+
+    text, kb = render_broadcast_browser("e", None, "b", 0)
+    msg = await bot.send_message(chat_id=callback.message.chat.id, text=text, reply_markup=kb)
+    await remember_bot_message(admin.id, msg.message_id)
+
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("broadcast_edit_pick:"))
+async def broadcast_edit_pick(callback: types.CallbackQuery, state: FSMContext):
+    admin = callback.from_user
+    if admin is None or admin.id not in settings.admin_ids:
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+
+    if settings.archive_chat_id is None:
+        await callback.answer("ARCHIVE_CHAT_ID не настроен.", show_alert=True)
+        return
+
+    _, bid = callback.data.split(":", 1)
+    await cleanup_user_messages(callback.message.chat.id, admin.id)
+
+    # текущая версия сверху: копия из откатов
+    try:
+        prev_mid = await copy_from_archive_to_chat(callback.message.chat.id, int(bid))
+        await remember_bot_message(admin.id, prev_mid)
+    except Exception:
+        pass
+
+    await state.set_state(BroadcastStates.waiting_edit)
+    await state.set_data({"edit_broadcast_id": bid})
+
+    text = (
+        f"✏️ <b>Изменение рассылки</b> <code>{bid}</code>\n\n"
+        "Отправь исправленный текст (или подпись, если это медиа) одним сообщением.\n"
+        "Он заменит текст у всех, кто получил рассылку, и в Откатах — без новых уведомлений."
+    )
+    msg = await bot.send_message(chat_id=callback.message.chat.id, text=text, reply_markup=get_broadcast_cancel_kb())
+    await remember_bot_message(admin.id, msg.message_id)
+
+    await callback.answer()
+
+
+@dp.message(BroadcastStates.waiting_edit, flags={"throttle_cost": 0})
+async def admin_broadcast_edit_text(message: types.Message, state: FSMContext):
+    user = message.from_user
+    data = await state.get_data()
+    await state.clear()
+    bid = data.get("edit_broadcast_id")
+    if user is None or user.id not in settings.admin_ids or not bid or settings.archive_chat_id is None:
+        return
+
+    new_text = message.html_text if (message.text or message.caption) else ""
+    if not new_text:
+        msg = await message.answer("⚠️ Нужен текст. Начни изменение заново.", reply_markup=get_broadcast_menu_kb())
+        await remember_bot_message(user.id, msg.message_id)
+        return
+
+    log_action(user, Action.ADMIN_BROADCAST_EDIT)
+
+    try:
+        await message.delete()
+    except Exception:
+        pass
+    await cleanup_user_messages(message.chat.id, user.id)
+
+    # 1) архив: заодно узнаём, текст это или подпись
+    try:
+        kind = await edit_archive_message(int(bid), new_text)
+    except Exception as e:
+        msg = await message.answer(f"❌ Не удалось изменить сообщение в Откатах: {e}", reply_markup=get_broadcast_menu_kb())
+        await remember_bot_message(user.id, msg.message_id)
+        return
+
+    msg = await message.answer(f"✏️ Меняю рассылку <code>{bid}</code> у получателей...")
+    await remember_bot_message(user.id, msg.message_id)
+
+    # 2) получатели — фоном, отчёт придёт отдельным сообщением
+    spawn(edit_and_report(bid, new_text, kind, user, message.chat.id))
+
+
+async def edit_and_report(broadcast_id: str, text: str, kind: str, admin: types.User, chat_id: int) -> None:
+    started = time.monotonic()
+    try:
+        ok, fail = await edit_broadcast_everywhere(broadcast_id, text, kind)
+    except Exception:
+        logging.exception(f"Изменение рассылки {broadcast_id} упало")
+        return
+
+    log_action(
+        admin, Action.ADMIN_BROADCAST_EDIT_DONE,
+        broadcast_id=broadcast_id, success=ok, failed=fail, duration=round(time.monotonic() - started, 1),
+    )
+    text = (
+        "✏️ <b>Изменение завершено</b>\n\n"
+        f"✅ Изменено у пользователей: <b>{ok}</b>\n"
+        f"⚠️ Ошибок: <b>{fail}</b>\n\n"
+        f"🗂 ID рассылки: <code>{broadcast_id}</code>"
+    )
+    msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=get_broadcast_menu_kb())
+    await remember_bot_message(admin.id, msg.message_id)
 
 
 # ============ АДМИН: СТАТИСТИКА ============
 
-@dp.message(F.text.contains("Статистика"))
+@dp.message(F.text.contains("Статистика"), flags={"throttle_cost": 3})
 async def admin_stats(message: types.Message):
     user = message.from_user
     if user is None:
         return
 
-    if user.id not in ADMIN_IDS:
+    if user.id not in settings.admin_ids:
         await message.answer(
             "🚫 <b>Раздел «Статистика» доступен только администратору.</b>\n\n"
             f"Твой Telegram ID: <code>{user.id}</code>\n"
-            "Добавь его в переменную окружения <code>ADMIN_IDS</code> и перезапусти бота."
+            "Добавь его в <code>ADMIN_IDS</code> в .env — бот подхватит изменение сам, перезапуск не нужен."
         )
         return
 
-    log_action(user, "admin_stats_button")
+    log_action(user, Action.ADMIN_STATS_BUTTON)
 
     await cleanup_user_messages(message.chat.id, user.id)
 
@@ -1219,7 +4734,8 @@ async def admin_stats(message: types.Message):
     except Exception:
         pass
 
-    total_users, total_start, button_counts = load_stats_summary()
+    total_users, total_start, button_counts, outcomes = await offload(load_stats_summary)
+    unique_totals, unique_by_action = await offload(load_uniques_summary)
 
     text_lines = [
         "📊 <b>Статистика бота</b>",
@@ -1235,17 +4751,34 @@ async def admin_stats(message: types.Message):
     display_counts: dict[str, int] = {}
 
     for key, val in button_counts.items():
-        if key.startswith("admin_broadcast_done_success_"):
-            label = "👑 Админ: рассылка завершена"
-        else:
-            label = ACTION_LABELS.get(key) or f"🔧 Служебное событие: {key}"
+        label = ACTION_LABELS.get(key) or f"🔧 Служебное событие: {key}"
         display_counts[label] = display_counts.get(label, 0) + val
 
     for label, val in sorted(display_counts.items(), key=lambda x: x[0]):
         text_lines.append(f"• {label}: <b>{val}</b>")
 
+    text_lines += [
+        "",
+        "👤 <b>Уникальные пользователи (≈):</b>",
+        f"• Сегодня: <b>{unique_totals[1]}</b>",
+        f"• За 7 дней: <b>{unique_totals[7]}</b>",
+        f"• За 30 дней: <b>{unique_totals[30]}</b>",
+        "",
+        "🔘 <b>Уникальные по кнопкам за 30 дней (≈):</b>",
+    ]
+    for action, n in unique_by_action.items():
+        text_lines.append(f"• {ACTION_LABELS[action]}: <b>{n}</b>")
+
+    if outcomes:
+        text_lines += ["", "📬 <b>Итоги рассылок:</b>"]
+        for key, agg in sorted(outcomes.items()):
+            text_lines.append(
+                f"• {ACTION_LABELS[key]}: доставлено <b>{agg['success']}</b>, ошибок <b>{agg['failed']}</b>"
+                f" за {agg['runs']} запуск(ов), {agg['duration'] / 60:.1f} мин"
+            )
+
     msg = await message.answer("\n".join(text_lines))
-    remember_bot_message(user.id, msg.message_id)
+    await remember_bot_message(user.id, msg.message_id)
 
     # users.txt документ
     try:
@@ -1255,20 +4788,475 @@ async def admin_stats(message: types.Message):
                 document=doc,
                 caption="📄 Список всех пользователей (users.txt)",
             )
-            remember_bot_message(user.id, doc_msg.message_id)
+            await remember_bot_message(user.id, doc_msg.message_id)
         else:
             info_msg = await message.answer("Файл <code>users.txt</code> пока пуст.")
-            remember_bot_message(user.id, info_msg.message_id)
+            await remember_bot_message(user.id, info_msg.message_id)
     except Exception as e:
         logging.error(f"Не удалось отправить users.txt: {e}")
         err_msg = await message.answer("Ошибка при отправке файла <code>users.txt</code>.")
-        remember_bot_message(user.id, err_msg.message_id)
+        await remember_bot_message(user.id, err_msg.message_id)
+
+
+@dp.message(Command("metrics"))
+async def admin_metrics(message: types.Message):
+    user = message.from_user
+    if user is None or user.id not in settings.admin_ids:
+        return
+
+    snap = metrics.snapshot()
+    lines = ["📈 <b>Метрики</b>", ""]
+    if not snap:
+        lines.append("Пока пусто.")
+    for name, val in sorted(snap.items()):
+        lines.append(f"• <code>{name}</code>: <b>{val}</b>")
+
+    msg = await message.answer("\n".join(lines))
+    await remember_bot_message(user.id, msg.message_id)
+
+
+# ============ ПАМЯТЬ ============
+# /mem показывает RSS процесса и контейнера, примерный размер основных структур
+# и, если включён tracemalloc, рост аллокаций по строкам кода с прошлого /mem.
+# Полный список и сырой снимок пишутся в data/mem/ — их можно разобрать потом
+# (tracemalloc.Snapshot.load), не подключаясь к живому процессу.
+
+if MEM_TRACE:
+    tracemalloc.start(MEM_TRACE_FRAMES)
+
+_mem_baseline: tracemalloc.Snapshot | None = None
+
+
+def _read_proc_status() -> dict[str, int]:
+    """
+    VmRSS / VmHWM из /proc/self/status, байты.
+    """
+    result: dict[str, int] = {}
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    result[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return result
+
+
+def _read_cgroup_memory() -> tuple[int, int | None] | None:
+    """
+    (использовано, лимит) контейнера из cgroup v2 или v1; None — не в контейнере.
+    """
+    for used_path, limit_path in (
+        ("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.max"),
+        ("/sys/fs/cgroup/memory/memory.usage_in_bytes", "/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+    ):
+        try:
+            with open(used_path, "r") as f:
+                used = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        limit: int | None = None
+        try:
+            with open(limit_path, "r") as f:
+                raw = f.read().strip()
+            # «max» или огромное число в v1 — лимита нет
+            limit = int(raw) if raw.isdigit() and int(raw) < 2**60 else None
+        except OSError:
+            pass
+        return used, limit
+    return None
+
+
+# в примитивы asyncio не спускаемся: через _loop / _waiters они ссылаются на цикл событий
+# и весь граф объектов процесса — считаем только их собственный размер
+_SIZE_OPAQUE = (
+    asyncio.AbstractEventLoop, asyncio.Future, asyncio.Handle,
+    asyncio.Lock, asyncio.Event, asyncio.Condition, asyncio.Semaphore, asyncio.Queue,
+    ModuleType, type, FunctionType, MethodType,
+)
+MEM_SIZE_DEPTH = 6
+
+
+def approx_size(obj: Any, sample: int = MEM_SAMPLE, _seen: set[int] | None = None, _depth: int = 0) -> int:
+    """
+    Примерный размер в байтах: sys.getsizeof контейнера + средний размер элемента
+    по первым sample элементам × их число (рекурсивно, не глубже MEM_SIZE_DEPTH).
+    Каждый объект считается один раз; примитивы asyncio, модули и функции — без содержимого.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if _depth >= MEM_SIZE_DEPTH or isinstance(obj, _SIZE_OPAQUE):
+        return size
+    depth = _depth + 1
+    if isinstance(obj, dict):
+        items = list(itertools.islice(obj.items(), sample))
+        if items:
+            per_item = sum(
+                approx_size(k, sample, _seen, depth) + approx_size(v, sample, _seen, depth) for k, v in items
+            ) / len(items)
+            size += int(per_item * len(obj))
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        items = list(itertools.islice(obj, sample))
+        if items:
+            size += int(sum(approx_size(x, sample, _seen, depth) for x in items) / len(items) * len(obj))
+    elif isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        pass
+    elif hasattr(obj, "__dict__"):
+        size += approx_size(vars(obj), sample, _seen, depth)
+    elif hasattr(obj, "__slots__"):
+        size += sum(approx_size(getattr(obj, name, None), sample, _seen, depth) for name in obj.__slots__)
+    return size
+
+
+def memory_structures() -> dict[str, Any]:
+    """
+    Крупные структуры в памяти бота — то, что растёт вместе с числом пользователей и рассылок.
+    """
+    fsm = getattr(dp.storage, "storage", None)  # MemoryStorage
+    if fsm is None and isinstance(getattr(dp.storage, "kv", None), LocalKV):
+        fsm = dp.storage.kv._data
+    structures: dict[str, Any] = {
+        "store.broadcasts": store.broadcasts,
+        "store.deliveries": store.deliveries,
+        "store.cursors": store.cursors,
+        "store.delivery_counts": store.delivery_counts,
+        "store.retries": store.retries,
+        "store.unreachable": store.unreachable,
+        "store.schedules": store.schedules,
+        "uniques.days": uniques.days,
+        "throttle.buckets": throttling._buckets,
+        "api.chat_buckets": api_rate_scheduler._chats,
+        # замки полос — только число полос, их содержимое не меряем
+        "updates.lanes": list(update_executor._lanes),
+        "metrics.timings": metrics._timings,
+        "broadcasts.active": active_broadcasts,
+        "tasks.background": background_tasks,
+    }
+    if fsm is not None:
+        structures["fsm.memory"] = fsm
+    return structures
+
+
+def memory_summary() -> dict[str, Any]:
+    proc = _read_proc_status()
+    summary: dict[str, Any] = {"rss_mb": round(proc.get("VmRSS", 0) / 2**20, 1)}
+    if "VmHWM" in proc:
+        summary["rss_peak_mb"] = round(proc["VmHWM"] / 2**20, 1)
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        summary["traced_mb"] = round(current / 2**20, 1)
+        summary["traced_peak_mb"] = round(peak / 2**20, 1)
+    return summary
+
+
+def _format_mb(size: float, signed: bool = False) -> str:
+    return f"{size / 2**20:+.2f} МБ" if signed else f"{size / 2**20:.2f} МБ"
+
+
+def take_memory_diff(top: int) -> tuple[list[str], str]:
+    """
+    Снимок tracemalloc, сравнение с прошлым (или пустым) и запись в data/mem/.
+    Возвращает (строки топа для ответа, путь к текстовому отчёту). Вызывать через offload.
+    """
+    global _mem_baseline
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            # исходники, которые подтягивает сам отчёт (traceback.format)
+            tracemalloc.Filter(False, "*linecache.py"),
+        )
+    )
+    if _mem_baseline is not None:
+        stats = snapshot.compare_to(_mem_baseline, "lineno")
+        lines = [
+            f"{_format_mb(st.size_diff, signed=True)} ({st.count_diff:+d}) {st.traceback[0].filename.rsplit(os.sep, 1)[-1]}:{st.traceback[0].lineno}"
+            for st in stats[:top]
+        ]
+    else:
+        stats = snapshot.statistics("lineno")
+        lines = [
+            f"{_format_mb(st.size)} ({st.count}) {st.traceback[0].filename.rsplit(os.sep, 1)[-1]}:{st.traceback[0].lineno}"
+            for st in stats[:top]
+        ]
+    _mem_baseline = snapshot
+
+    os.makedirs(MEM_DUMP_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    report_path = os.path.join(MEM_DUMP_DIR, f"mem-{stamp}.txt")
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write(f"{stamp} {memory_summary()}\n\n")
+        for st in stats[:1000]:
+            f.write(f"{st}\n")
+            for frame in st.traceback.format()[1:]:
+                f.write(f"    {frame}\n")
+    snapshot.dump(os.path.join(MEM_DUMP_DIR, f"mem-{stamp}.tracemalloc"))
+
+    # старые снимки удаляем, оставляя MEM_KEEP_DUMPS последних пар
+    dumps = sorted(name for name in os.listdir(MEM_DUMP_DIR) if name.startswith("mem-"))
+    stamps = sorted({name.split(".", 1)[0] for name in dumps})
+    for old in stamps[:-MEM_KEEP_DUMPS] if MEM_KEEP_DUMPS > 0 else ():
+        for name in dumps:
+            if name.startswith(old + "."):
+                try:
+                    os.remove(os.path.join(MEM_DUMP_DIR, name))
+                except OSError:
+                    pass
+    return lines, report_path
+
+
+metrics.gauge("mem", memory_summary)
+metrics.gauge(
+    "mem.items",
+    lambda: {name: len(obj) for name, obj in memory_structures().items() if hasattr(obj, "__len__")},
+)
+
+
+@dp.message(Command("mem"))
+async def admin_mem(message: types.Message):
+    global _mem_baseline
+    user = message.from_user
+    if user is None or user.id not in settings.admin_ids:
+        return
+
+    arg = (message.text or "").split(maxsplit=1)[1:]
+    arg = arg[0].strip().lower() if arg else ""
+    if arg == "start":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEM_TRACE_FRAMES)
+        _mem_baseline = None
+        msg = await message.answer("🧠 tracemalloc включён. Следующий /mem покажет, где растёт память.")
+        await remember_bot_message(user.id, msg.message_id)
+        return
+    if arg == "stop":
+        tracemalloc.stop()
+        _mem_baseline = None
+        msg = await message.answer("🧠 tracemalloc выключен.")
+        await remember_bot_message(user.id, msg.message_id)
+        return
+
+    summary = memory_summary()
+    lines = ["🧠 <b>Память</b>", "", f"• RSS: <b>{summary['rss_mb']} МБ</b>"]
+    if "rss_peak_mb" in summary:
+        lines[-1] += f" (пик {summary['rss_peak_mb']} МБ)"
+    cgroup = _read_cgroup_memory()
+    if cgroup is not None:
+        used, limit = cgroup
+        lines.append(f"• Контейнер: <b>{used / 2**20:.1f} МБ</b>" + (f" из {limit / 2**20:.0f} МБ" if limit else ""))
+    lines.append(f"• Объектов Python: {len(gc.get_objects())}")
+
+    lines += ["", "<b>Структуры (≈):</b>"]
+    sizes = sorted(
+        ((name, len(obj) if hasattr(obj, "__len__") else 0, approx_size(obj)) for name, obj in memory_structures().items()),
+        key=lambda item: -item[2],
+    )
+    for name, count, size in sizes:
+        lines.append(f"• <code>{name}</code>: {count} шт., {_format_mb(size)}")
+
+    lines.append("")
+    if tracemalloc.is_tracing():
+        first = _mem_baseline is None
+        top, report_path = await offload(take_memory_diff, MEM_TOP)
+        lines.append(
+            f"<b>tracemalloc</b>: {summary['traced_mb']} МБ (пик {summary['traced_peak_mb']} МБ)"
+        )
+        lines.append("Больше всего занято:" if first else "Рост с прошлого /mem:")
+        lines += [f"<code>{html.escape(line)}</code>" for line in top]
+        lines.append(f"\nПолный отчёт и снимок: <code>{html.escape(report_path)}</code>")
+    else:
+        lines.append("tracemalloc выключен — <code>/mem start</code>, чтобы искать, где растёт память.")
+
+    msg = await message.answer("\n".join(lines))
+    await remember_bot_message(user.id, msg.message_id)
+
+
+# ============ ПЕРЕЗАГРУЗКА НАСТРОЕК ============
+
+async def reload_settings(source: str) -> tuple[list[str], list[str]]:
+    """
+    Перечитывает .env и окружение, проверяет и применяет. Возвращает (изменения, ошибки);
+    при любой ошибке настройки остаются прежними.
+    """
+    new, errors = parse_settings(read_config_env())
+    if not errors and new.archive_chat_id is not None and new.archive_chat_id != settings.archive_chat_id:
+        # новый архив должен быть доступен боту — иначе сломаются все рассылки
+        try:
+            await bot.get_chat_member_count(chat_id=new.archive_chat_id)
+        except Exception as e:
+            errors.append(f"Бот не видит чат ARCHIVE_CHAT_ID={new.archive_chat_id}: {e}")
+
+    if errors:
+        metrics.inc("config.rejected")
+        logging.error("Настройки не применены (%s): %s", source, "; ".join(errors))
+        return [], errors
+
+    changes = apply_settings(new, source)
+    if changes:
+        metrics.inc("config.reloads")
+    return changes, []
+
+
+def _env_file_stamp() -> tuple[int, int] | None:
+    try:
+        st = os.stat(ENV_FILE)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+async def config_watcher() -> None:
+    if not ENV_FILE:
+        return
+    stamp = _env_file_stamp()
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        current = _env_file_stamp()
+        if current == stamp:
+            continue
+        stamp = current
+
+        changes, errors = await reload_settings("изменён .env")
+        if not errors:
+            continue
+        text = "⚠️ <b>Изменения .env не применены:</b>\n\n" + "\n".join(f"• {html.escape(e)}" for e in errors)
+        for admin_id in settings.admin_ids:
+            try:
+                await bot.send_message(chat_id=admin_id, text=text)
+            except Exception:
+                pass
+
+
+@dp.message(Command("reload"))
+async def admin_reload(message: types.Message):
+    user = message.from_user
+    if user is None or user.id not in settings.admin_ids:
+        return
+
+    changes, errors = await reload_settings(f"/reload от {user.id}")
+    if errors:
+        text = "⚠️ <b>Настройки не применены:</b>\n\n" + "\n".join(f"• {html.escape(e)}" for e in errors)
+    elif changes:
+        text = (
+            "✅ <b>Настройки обновлены:</b>\n\n"
+            + "\n".join(f"• <code>{html.escape(c)}</code>" for c in changes)
+            + "\n\nНовым админам — /start, чтобы появились кнопки."
+        )
+    else:
+        text = "Настройки не изменились."
+
+    msg = await message.answer(text)
+    await remember_bot_message(user.id, msg.message_id)
+
+
+# ============ ПРОГРЕВ ПРИ СТАРТЕ ============
+# До polling: все файлы читаются параллельно и проверяются, строятся индексы хранилища,
+# поднимаются планировщик и file_id картинок. Первые апдейты после деплоя уже ничего не грузят.
+# Повреждённый файл — отказ от старта (StoreCorruptedError), а не тихий сброс к пустому.
+
+startup_timings: dict[str, float] = {}
+
+
+@contextlib.contextmanager
+def _startup_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+
+def check_fsm_storage() -> None:
+    kv = getattr(dp.storage, "kv", None)
+    if isinstance(kv, SQLiteKV):
+        result = kv.quick_check()
+        if result != "ok":
+            raise StoreCorruptedError(f"{FSM_SQLITE_FILE}: {result}")
+
+
+async def warm_up() -> None:
+    started = time.perf_counter()
+
+    with _startup_phase("files"):
+        ensure_files()
+
+    with _startup_phase("load"):
+        paths = list(STORE_DEFAULTS)
+        loaded = await asyncio.gather(
+            *(asyncio.to_thread(_load_json, path, STORE_DEFAULTS[path], True) for path in paths),
+            asyncio.to_thread(uniques.ensure_loaded),
+            asyncio.to_thread(check_fsm_storage),
+        )
+        files = dict(zip(paths, loaded))
+        for path, data in files.items():
+            validate_store_file(path, data)
+
+    with _startup_phase("index"):
+        store.ensure_loaded(files)
+
+    with _startup_phase("scheduler"):
+        await broadcast_scheduler.load()
+
+    with _startup_phase("bot_api"):
+        await bot.me()
+
+    with _startup_phase("media"):
+        await warm_media_cache()
+
+    startup_timings["total"] = time.perf_counter() - started
+    logging.info(
+        "Прогрев за %.0f мс: %s (рассылок %d, получателей %d, отложенных %d)",
+        startup_timings["total"] * 1000,
+        ", ".join(f"{name} {sec * 1000:.0f} мс" for name, sec in startup_timings.items() if name != "total"),
+        len(store.broadcasts),
+        len(store.deliveries),
+        len(store.schedules),
+    )
+
+
+metrics.gauge("startup.ms", lambda: {name: round(sec * 1000, 1) for name, sec in startup_timings.items()})
 
 
 # ============ ЗАПУСК БОТА ============
 async def main():
+    try:
+        await warm_up()
+    except (StoreCorruptedError, StoreLockedError) as e:
+        if isinstance(e, StoreLockedError):
+            logging.critical(f"Бот не запущен: {e}. Бот работает одним экземпляром на каталог data/ — останови второй экземпляр и запусти снова.")
+        else:
+            logging.critical(
+                f"Данные повреждены, бот не запущен: {e}. "
+                "Восстанови файл из бэкапа (или удали его, если данные не нужны) и запусти снова."
+            )
+        await bot.session.close()
+        if bulk_bot is not bot:
+            await bulk_bot.session.close()
+        raise SystemExit(1)
+
     print("Bot started...")
-    await dp.start_polling(bot)
+    store.start()
+    broadcast_scheduler.start()
+    spawn(broadcast_pruner())
+    spawn(retry_worker())
+    spawn(uniques_flusher())
+    spawn(loop_lag_monitor())
+    spawn(config_watcher())
+    try:
+        # каждый апдейт — отдельная задача (порядок и лимит задаёт UpdateExecutor),
+        # но не больше UPDATE_MAX_PENDING в работе — дальше polling ждёт
+        await dp.start_polling(bot, handle_as_tasks=True, tasks_concurrency_limit=UPDATE_MAX_PENDING)
+    finally:
+        await store.close()
+        uniques.flush()
+        offload_executor.shutdown(wait=False, cancel_futures=True)
+        if bulk_bot is not bot:
+            await bulk_bot.session.close()
 
 
 if __name__ == "__main__":
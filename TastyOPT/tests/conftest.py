@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+# botmain читает окружение при импорте: токен-заглушка, без .env, данные — в tmp каталоге теста
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["ENV_FILE"] = ""
+os.environ.setdefault("ADMIN_IDS", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import botmain  # noqa: E402
+
+
+def release(st: botmain.DataStore) -> None:
+    """
+    Отпускает блокировку WAL, чтобы в том же процессе открыть data/ ещё одним DataStore
+    (как после перезапуска бота).
+    """
+    if st._lock_file is not None:
+        st._lock_file.close()
+        st._lock_file = None
+
+
+def open_store() -> botmain.DataStore:
+    st = botmain.DataStore(botmain.WAL_FILE, 500, 5000, 300)
+    st.ensure_loaded()
+    return st
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """
+    Пустое хранилище в tmp каталоге, подставленное вместо botmain.store.
+    """
+    monkeypatch.chdir(tmp_path)
+    st = open_store()
+    monkeypatch.setattr(botmain, "store", st)
+    yield st
+    release(st)
+
+
+def broadcast(mid: int, created_at: str = "2026-01-01T10:00:00", expires_at: str | None = None) -> dict:
+    return {"archive_message_id": mid, "created_at": created_at, "created_by": 1, "expires_at": expires_at}
@@ -0,0 +1,103 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import botmain
+from conftest import broadcast
+
+
+def _add(st: botmain.DataStore, *mids: int, **kwargs) -> None:
+    async def run():
+        for mid in mids:
+            await st.submit("add_broadcast", record=broadcast(mid, **kwargs))
+
+    asyncio.run(run())
+
+
+def test_normalize_cursor_folds_contiguous_extra(store):
+    _add(store, 1, 2, 3, 4, 5)
+    cur = {"upto": 0, "extra": [1, 2, 4]}
+    store.normalize_cursor(cur)
+    assert cur == {"upto": 2, "extra": [4]}
+
+
+def test_normalize_cursor_skips_removed_seqs(store):
+    _add(store, 1, 2, 3, 4, 5)
+    asyncio.run(store.submit("remove_broadcast", broadcast_id="3"))
+    cur = {"upto": 2, "extra": [4]}
+    store.normalize_cursor(cur)
+    assert cur == {"upto": 4, "extra": []}
+
+
+def test_normalize_cursor_drops_extra_below_upto(store):
+    _add(store, 1, 2, 3)
+    cur = {"upto": 3, "extra": [2, 3]}
+    store.normalize_cursor(cur)
+    assert cur == {"upto": 3, "extra": []}
+
+
+def test_missing_for_returns_gaps_in_log_order(store):
+    _add(store, 10, 20, 30, 40)
+    asyncio.run(store.submit("mark_delivered", user_id="7", items={"10": 1, "30": 3}))
+    assert [b["archive_message_id"] for b in store.missing_for("7")] == [20, 40]
+    # пользователь без курсора не получил ничего
+    assert [b["archive_message_id"] for b in store.missing_for("8")] == [10, 20, 30, 40]
+
+
+def test_was_delivered_follows_cursor(store):
+    _add(store, 10, 20)
+    asyncio.run(botmain.mark_delivered(7, "20", 2))
+    assert botmain.was_delivered(7, "20")
+    assert not botmain.was_delivered(7, "10")
+    assert not botmain.was_delivered(8, "20")
+
+
+def test_plan_catchup_skips_expired(store):
+    past = (datetime.now() - timedelta(days=1)).isoformat(timespec="seconds")
+    future = (datetime.now() + timedelta(days=1)).isoformat(timespec="seconds")
+    _add(store, 10, expires_at=past)
+    _add(store, 20, expires_at=future)
+    _add(store, 30)
+
+    to_send, skipped = botmain.plan_catchup(7)
+    assert to_send == [20, 30]
+    assert skipped == [store.seq_of("10")]
+
+
+def test_plan_catchup_keeps_only_latest(store, monkeypatch):
+    monkeypatch.setattr(botmain, "CATCHUP_MAX", 2)
+    _add(store, 10, 20, 30, 40)
+    asyncio.run(store.submit("mark_delivered", user_id="7", items={"30": 3}))
+
+    to_send, skipped = botmain.plan_catchup(7)
+    assert to_send == [20, 40]
+    assert skipped == [store.seq_of("10")]
+
+    # после skip_catchup пропущенное больше не предлагается
+    asyncio.run(botmain.skip_catchup(7, skipped))
+    assert botmain.plan_catchup(7) == ([20, 40], [])
+
+
+def test_run_broadcast_skips_recipients_changed_while_running(store, monkeypatch):
+    """
+    Получатель 2 успел получить рассылку догоняющей доставкой, а 3 — заблокировал бота,
+    пока шла рассылка: ни тому, ни другому копия уйти не должна.
+    """
+    copied: list[int] = []
+
+    async def fake_copy(chat_id, archive_message_id, via=None):
+        copied.append(chat_id)
+        if chat_id == 1:
+            await botmain.mark_delivered(2, str(archive_message_id), 9002)
+            await botmain.store.submit("mark_unreachable", user_id="3", err="blocked", at="2026-01-01T00:00:00")
+        return 9000 + chat_id
+
+    monkeypatch.setattr(botmain, "pending_recipients", lambda broadcast_id: [1, 2, 3, 4])
+    monkeypatch.setattr(botmain, "copy_from_archive_to_chat", fake_copy)
+
+    progress = asyncio.run(botmain.run_broadcast(555, created_by=1))
+
+    assert copied == [1, 4]
+    assert (progress.sent, progress.skipped, progress.failed) == (2, 2, 0)
+    assert progress.processed == progress.total == 4
+    assert store.deliveries["2"] == {"555": 9002}
+    assert "555" not in botmain.active_broadcasts
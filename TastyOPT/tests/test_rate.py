@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from botmain import ApiPriority, ApiRateScheduler
+
+
+def _scheduler(**kwargs) -> ApiRateScheduler:
+    params = dict(global_rate=20, bulk_rate=20, chat_rate=100, chat_burst=100, group_rate=100, service_rate=20)
+    params.update(kwargs)
+    return ApiRateScheduler(**params)
+
+
+def test_waiters_are_served_by_priority_then_fifo():
+    async def run():
+        s = _scheduler()
+        s._global.tokens = 0  # бюджет кончился — дальше всё идёт через очередь
+        order: list[str] = []
+
+        async def take(label: str, priority: ApiPriority, chat_id: int):
+            await s.acquire(priority, chat_id)
+            order.append(label)
+
+        tasks = [
+            asyncio.create_task(take("bulk-1", ApiPriority.BULK, 1)),
+            asyncio.create_task(take("catchup", ApiPriority.CATCHUP, 2)),
+            asyncio.create_task(take("bulk-2", ApiPriority.BULK, 3)),
+            asyncio.create_task(take("interactive", ApiPriority.INTERACTIVE, 4)),
+            asyncio.create_task(take("cleanup", ApiPriority.CLEANUP, 5)),
+        ]
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "cleanup", "catchup", "bulk-1", "bulk-2"]
+
+
+def test_busy_chat_does_not_block_other_chats():
+    async def run():
+        s = _scheduler(chat_rate=1, chat_burst=1)
+        await s.acquire(ApiPriority.BULK, 1)
+        started = time.monotonic()
+        # второй запрос в чат 1 ждёт ~1 с, а чат 2 за ним в очереди не стоит
+        slow = asyncio.create_task(s.acquire(ApiPriority.BULK, 1))
+        await asyncio.sleep(0)
+        await s.acquire(ApiPriority.BULK, 2)
+        other = time.monotonic() - started
+        await slow
+        return other, time.monotonic() - started
+
+    other, same = asyncio.run(run())
+    assert other < 0.2
+    assert 0.8 < same < 1.5
+
+
+def test_chat_429_freezes_only_that_chat():
+    async def run():
+        s = _scheduler()
+        s.penalize(1.0, send=True, chat_id=1)
+        started = time.monotonic()
+        await s.acquire(ApiPriority.INTERACTIVE, 2)
+        other = time.monotonic() - started
+        await s.acquire(ApiPriority.INTERACTIVE, 1)
+        return other, time.monotonic() - started
+
+    other, same = asyncio.run(run())
+    assert other < 0.1
+    assert same >= 0.9
+
+
+def test_service_requests_use_own_budget():
+    async def run():
+        s = _scheduler()
+        s.penalize(5.0, send=True)
+        started = time.monotonic()
+        for _ in range(10):
+            await s.acquire(ApiPriority.CLEANUP, send=False)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 0.1
@@ -0,0 +1,77 @@
+import math
+
+import pytest
+
+import botmain
+from botmain import Action, HyperLogLog, parse_stats_line
+
+
+def test_parse_json_line():
+    event = parse_stats_line('{"ts": "2026-01-01T10:00:00", "uid": 7, "un": "bob", "a": 1}\n')
+    assert event == {"ts": "2026-01-01T10:00:00", "uid": 7, "un": "bob", "a": Action.START}
+
+
+def test_parse_json_line_keeps_extra_fields():
+    event = parse_stats_line('{"ts": "t", "uid": 1, "un": "", "a": 25, "success": 10, "failed": 2}')
+    assert event["a"] is Action.ADMIN_BROADCAST_DONE
+    assert (event["success"], event["failed"]) == (10, 2)
+
+
+def test_parse_legacy_line():
+    event = parse_stats_line("2025-05-01 10:00:00;7;bob;start")
+    assert event == {"ts": "2025-05-01 10:00:00", "uid": 7, "un": "bob", "a": Action.START}
+
+
+def test_parse_legacy_done_with_totals_in_name():
+    event = parse_stats_line("2025-05-01 10:00:00;1;admin;admin_broadcast_done_success_12_failed_3")
+    assert event["a"] is Action.ADMIN_BROADCAST_DONE
+    assert (event["success"], event["failed"]) == (12, 3)
+
+
+def test_parse_legacy_unknown_action_keeps_raw():
+    event = parse_stats_line("2025-05-01 10:00:00;7;bob;some_old_button")
+    assert event["a"] is None
+    assert event["raw"] == "some_old_button"
+
+
+def test_parse_legacy_empty_username():
+    event = parse_stats_line("2025-05-01 10:00:00;7;;start")
+    assert event["un"] == "" and event["a"] is Action.START
+
+
+@pytest.mark.parametrize(
+    "line",
+    ["", "   \n", "{broken json", '{"ts": "t", "uid": 1, "a": 999}', '{"ts": "t", "uid": 1}', "2025-05-01;7;start"],
+)
+def test_parse_rejects_bad_lines(line):
+    assert parse_stats_line(line) is None
+
+
+@pytest.mark.parametrize("n", [50, 1000, 20000, 200000])
+def test_hll_error_within_bounds(n):
+    hll = HyperLogLog()
+    for i in range(n):
+        hll.add(i)
+    # стандартная ошибка 1.04/sqrt(m); берём 4 сигмы — хеш детерминирован, тест не «мигает»
+    bound = 4 * 1.04 / math.sqrt(hll.m)
+    assert abs(hll.count() - n) / n <= bound
+
+
+def test_hll_ignores_duplicates_and_merges():
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(3000):
+        a.add(i)
+        a.add(i)
+    for i in range(2000, 5000):
+        b.add(i)
+    assert abs(a.count() - 3000) / 3000 <= 0.1
+    merged = HyperLogLog(registers=a.registers).merge(b)
+    assert abs(merged.count() - 5000) / 5000 <= 0.1
+
+
+def test_hll_roundtrip():
+    hll = HyperLogLog()
+    for i in range(500):
+        hll.add(f"user{i}")
+    assert HyperLogLog.loads(hll.dumps()).registers == hll.registers
+    assert botmain.HyperLogLog().count() == 0
@@ -0,0 +1,125 @@
+import asyncio
+import os
+
+import pytest
+
+import botmain
+from conftest import broadcast, open_store, release
+
+
+async def _fill(st: botmain.DataStore) -> None:
+    for mid in (101, 102, 103):
+        await st.submit("add_broadcast", record=broadcast(mid))
+    await st.submit("mark_delivered", user_id="7", items={"101": 5001, "103": 5003})
+    await st.submit("retry_put", broadcast_id="102", user_id="7", entry={"err": "network", "attempts": 1, "next_at": 0})
+
+
+def _state(st: botmain.DataStore) -> tuple:
+    return (
+        [(b["seq"], b["archive_message_id"]) for b in st.broadcasts],
+        st.deliveries,
+        st.cursors,
+        st.retries,
+        st.next_seq,
+    )
+
+
+def test_wal_replay_restores_state(store):
+    asyncio.run(_fill(store))
+    assert os.path.getsize(botmain.WAL_FILE) > 0
+    expected = _state(store)
+    release(store)
+
+    reopened = open_store()
+    try:
+        assert _state(reopened) == expected
+        assert reopened.cursors["7"] == {"upto": 1, "extra": [3]}
+    finally:
+        release(reopened)
+
+
+def test_compaction_writes_snapshot_and_empties_wal(store):
+    asyncio.run(_fill(store))
+    expected = _state(store)
+    store.compact()
+    assert os.path.getsize(botmain.WAL_FILE) == 0
+    assert os.path.exists(botmain.BROADCASTS_FILE)
+    release(store)
+
+    reopened = open_store()
+    try:
+        assert _state(reopened) == expected
+    finally:
+        release(reopened)
+
+
+def test_replay_after_compaction_applies_only_new_ops(store):
+    async def run():
+        await _fill(store)
+        store.compact()
+        await store.submit("remove_broadcast", broadcast_id="101")
+
+    asyncio.run(run())
+    release(store)
+
+    reopened = open_store()
+    try:
+        assert [b["archive_message_id"] for b in reopened.broadcasts] == [102, 103]
+        assert reopened.deliveries["7"] == {"103": 5003}
+        # seq не переиспользуются: следующая рассылка всё равно получит 4
+        assert reopened.next_seq == 4
+    finally:
+        release(reopened)
+
+
+def test_torn_last_record_is_dropped_and_truncated(store):
+    asyncio.run(_fill(store))
+    release(store)
+    size = os.path.getsize(botmain.WAL_FILE)
+    with open(botmain.WAL_FILE, "ab") as f:
+        f.write(b'{"op": "add_broadcast", "args": {"rec')
+
+    reopened = open_store()
+    try:
+        assert len(reopened.broadcasts) == 3
+        assert os.path.getsize(botmain.WAL_FILE) == size
+    finally:
+        release(reopened)
+
+
+def test_corrupt_record_in_the_middle_refuses_to_load(store):
+    asyncio.run(_fill(store))
+    release(store)
+    with open(botmain.WAL_FILE, "rb") as f:
+        lines = f.read().split(b"\n")
+    lines.insert(1, b"{not json")
+    with open(botmain.WAL_FILE, "wb") as f:
+        f.write(b"\n".join(lines))
+
+    with pytest.raises(botmain.StoreCorruptedError, match=":2:"):
+        open_store()
+
+
+def test_unknown_op_refuses_to_load(store):
+    release(store)
+    with open(botmain.WAL_FILE, "w", encoding="utf-8") as f:
+        f.write('{"op": "no_such_op", "args": {}}\n')
+
+    with pytest.raises(botmain.StoreCorruptedError, match="no_such_op"):
+        open_store()
+
+
+def test_second_store_on_same_data_is_locked(store):
+    with pytest.raises(botmain.StoreLockedError):
+        open_store()
+
+
+def test_bad_op_arguments_fail_only_that_call(store):
+    async def run():
+        with pytest.raises(TypeError):
+            await store.submit("mark_delivered", user_id="7")
+        await store.submit("add_broadcast", record=broadcast(101))
+
+    asyncio.run(run())
+    with open(botmain.WAL_FILE, "rb") as f:
+        assert f.read().count(b"\n") == 1
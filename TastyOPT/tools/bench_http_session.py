@@ -0,0 +1,84 @@
+# tools/bench_http_session.py
+"""
+Бенчмарк HTTP-сессии бота против локального фейкового Bot API.
+
+Гоняет одинаковую нагрузку (concurrent copyMessage) через сессии с разными
+настройками пула и печатает время, RPS и сколько TCP-соединений было открыто.
+
+    python tools/bench_http_session.py --requests 2000 --concurrency 200 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_api import FakeBotAPI  # noqa: E402
+
+
+async def run_case(botmain, api: FakeBotAPI, name: str, session, requests: int, concurrency: int) -> None:
+    from aiogram import Bot
+
+    b = Bot(token=botmain.API_TOKEN, session=session)
+    api.reset()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with sem:
+            await b.copy_message(chat_id=1000 + i % 500, from_chat_id=-100, message_id=1)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    await session.close()
+
+    print(f"{name:<34} {elapsed:8.2f}s {requests / elapsed:9.0f} req/s {len(api.connections):8d} conns")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка фейкового API, сек")
+    parser.add_argument("--pools", default="10,50,100,200", help="размеры пула через запятую")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+
+    # botmain читает настройки при импорте — подменяем токен и API, данные пишем во временную папку
+    os.environ["BOT_TOKEN"] = "123456:BENCHMARK"
+    os.environ["BOT_API_URL"] = api.url
+    os.chdir(tempfile.mkdtemp(prefix="tasty-bench-"))
+    import botmain
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    print(f"requests={args.requests} concurrency={args.concurrency} latency={args.latency * 1000:.0f}ms")
+    print(f"{'session':<34} {'time':>9} {'rps':>13} {'conns':>13}")
+
+    # худший случай: без keep-alive
+    no_keepalive = botmain.TunedAiohttpSession(
+        {"limit": 100, "force_close": True}, api=TelegramAPIServer.from_base(api.url)
+    )
+    await run_case(botmain, api, "no keep-alive (limit=100)", no_keepalive, args.requests, args.concurrency)
+
+    await run_case(
+        botmain, api, "aiogram default (limit=100)",
+        AiohttpSession(api=TelegramAPIServer.from_base(api.url)), args.requests, args.concurrency,
+    )
+
+    for pool in (int(p) for p in args.pools.split(",") if p.strip()):
+        session = botmain.make_bot_session(pool, botmain.HTTP_TIMEOUT)
+        await run_case(botmain, api, f"make_bot_session(pool={pool})", session, args.requests, args.concurrency)
+
+    await botmain.bot.session.close()
+    await api.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
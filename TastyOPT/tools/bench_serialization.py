@@ -0,0 +1,89 @@
+# tools/bench_serialization.py
+"""
+Бенчмарк сериализаторов хранилища на deliveries.json разного размера.
+
+Для каждого доступного бэкенда (json, orjson, msgpack) в компактном и «красивом»
+режиме пишет снапшот через _save_json, читает через _load_json + _read_deliveries_file
+и печатает время записи/чтения и размер файла.
+
+    python tools/bench_serialization.py --sizes 10000,100000,1000000 --per-user 10
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_deliveries(total: int, per_user: int) -> dict[str, dict[str, int]]:
+    rnd = random.Random(42)
+    deliveries: dict[str, dict[str, int]] = {}
+    users = max(total // per_user, 1)
+    for i in range(users):
+        uid = str(rnd.randrange(10**8, 8 * 10**9))
+        deliveries[uid] = {str(1000 + b): rnd.randrange(1, 10**6) for b in range(per_user)}
+    return deliveries
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="число доставок через запятую")
+    parser.add_argument("--per-user", type=int, default=10, help="доставок на пользователя")
+    parser.add_argument("--repeat", type=int, default=3, help="лучший из N прогонов")
+    args = parser.parse_args()
+
+    # botmain читает настройки при импорте — данные пишем во временную папку
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.chdir(tempfile.mkdtemp(prefix="tasty-bench-"))
+    import botmain
+
+    backends = [botmain.JsonSerializer()]
+    if botmain.orjson is not None:
+        backends.append(botmain.OrjsonSerializer())
+    else:
+        print("orjson не установлен — пропускаю")
+    if botmain.msgpack is not None:
+        backends.append(botmain.MsgpackSerializer())
+    else:
+        print("msgpack не установлен — пропускаю")
+
+    path = botmain.DELIVERIES_FILE
+    default_serializer, default_compact = botmain.serializer, botmain.STORE_COMPACT
+
+    for size in (int(x) for x in args.sizes.split(",")):
+        data = {"deliveries": make_deliveries(size, args.per_user)}
+        print(f"\n=== {size} доставок ({len(data['deliveries'])} пользователей) ===")
+        print(f"{'бэкенд':<18} {'запись, s':>10} {'чтение, s':>10} {'размер, МБ':>11}")
+
+        for backend in backends:
+            modes = (True,) if backend.name == "msgpack" else (False, True)
+            for compact in modes:
+                botmain.serializer = backend
+                botmain.STORE_COMPACT = compact
+
+                save = best_of(lambda: botmain._save_json(path, data), args.repeat)
+                load = best_of(
+                    lambda: botmain._read_deliveries_file(botmain._load_json(path, {"deliveries": {}})), args.repeat
+                )
+                size_mb = os.path.getsize(path) / 1024 / 1024
+
+                label = backend.name + ("" if backend.name == "msgpack" else (" compact" if compact else " indent"))
+                print(f"{label:<18} {save:10.3f} {load:10.3f} {size_mb:11.2f}")
+
+    botmain.serializer, botmain.STORE_COMPACT = default_serializer, default_compact
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# tools/bench_start.py
+"""
+Бенчмарк /start: время до приветствия и полное время хендлера.
+
+Каждому синтетическому пользователю заранее «оставляем» несколько старых
+сообщений бота (их удалит cleanup) и несколько рассылок для догоняющей доставки,
+затем подаём /start через настоящий диспетчер против фейкового Bot API.
+Время до приветствия считается по моменту, когда фейковый API ответил на sendPhoto
+в чат пользователя, — так замер одинаково работает для любой версии хендлера.
+
+    python tools/bench_start.py --users 200 --concurrency 50 --latency 0.03
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_api import FakeBotAPI  # noqa: E402
+from replay import UpdateFactory, percentile  # noqa: E402
+
+FIRST_USER_ID = 5_000_000_000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько /start обрабатывается одновременно")
+    parser.add_argument("--latency", type=float, default=0.03, help="задержка фейкового API, сек")
+    parser.add_argument("--history", type=int, default=5, help="старых сообщений бота у каждого пользователя")
+    parser.add_argument("--broadcasts", type=int, default=3, help="рассылок для догоняющей доставки")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+
+    # botmain читает настройки при импорте — подменяем токен, API и архив, данные пишем во временную папку
+    os.environ["BOT_TOKEN"] = "123456:BENCHMARK"
+    os.environ["BOT_API_URL"] = api.url
+    os.environ["ARCHIVE_CHAT_ID"] = "-1001000000001"
+    os.environ["ADMIN_IDS"] = ""
+    os.environ["ENV_FILE"] = ""  # настоящий .env бота не читаем
+    os.environ["THROTTLE_BURST"] = "1000000"
+    workdir = tempfile.mkdtemp(prefix="tasty-bench-")
+    shutil.copytree(os.path.join(BOT_DIR, "assets"), os.path.join(workdir, "assets"))
+    os.chdir(workdir)
+    import botmain
+
+    botmain.store.start()
+    for i in range(args.broadcasts):
+        await botmain.add_broadcast(
+            {"archive_message_id": 10 + i, "created_at": "2030-01-01T00:00:00", "created_by": 1, "expires_at": None}
+        )
+
+    user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+    for uid in user_ids:
+        await botmain.set_tracked_messages(
+            uid, {"greeting_id": 1, "bot_messages": list(range(1, args.history + 2))}
+        )
+
+    bot = botmain.bot
+    factory = UpdateFactory(bot)
+    sem = asyncio.Semaphore(args.concurrency)
+    fed_at: dict[int, float] = {}
+    handler_times: list[float] = []
+
+    async def one(uid: int) -> None:
+        update = factory.message(uid, "", "/start")
+        async with sem:
+            fed_at[uid] = time.perf_counter()
+            await botmain.dp.feed_update(bot, update)
+            handler_times.append(time.perf_counter() - fed_at[uid])
+
+    api.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(uid) for uid in user_ids))
+    while botmain.background_tasks:
+        await asyncio.gather(*list(botmain.background_tasks), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    greeted: dict[int, float] = {}
+    for at, method, chat_id in api.timeline:
+        if method == "sendPhoto" and chat_id is not None:
+            uid = int(chat_id)
+            greeted.setdefault(uid, at)
+    to_greeting = [greeted[uid] - fed_at[uid] for uid in user_ids if uid in greeted]
+
+    await botmain.store.close()
+    await bot.session.close()
+    await api.stop()
+
+    print(f"\n/start x{args.users} (одновременно {args.concurrency}), задержка API {args.latency * 1000:.0f} мс")
+    print(f"всего {elapsed:.2f}s, вызовов API {sum(api.calls.values())}: {dict(api.calls.most_common())}")
+    for title, values in (("до приветствия", to_greeting), ("весь хендлер", handler_times)):
+        print(
+            f"{title:<16} p50 {percentile(values, 50) * 1000:7.1f} мс   p95 {percentile(values, 95) * 1000:7.1f} мс"
+            f"   max {max(values, default=0) * 1000:7.1f} мс   (n={len(values)})"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+# tools/fake_api.py
+"""
+Локальный фейковый Bot API для бенчмарков и прогонов без Telegram.
+
+Отвечает на любые методы правдоподобными результатами, умеет добавлять задержку
+и считает вызовы по методам и открытые TCP-соединения. В timeline пишется
+(время ответа, метод, chat_id) каждого вызова — для замеров «когда пользователь увидел».
+
+    api = FakeBotAPI(latency=0.02)
+    await api.start()
+    ...  # BOT_API_URL=api.url
+    await api.stop()
+"""
+import asyncio
+import itertools
+import time
+from collections import Counter
+from typing import Any
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.connections: set[int] = set()
+        self.timeline: list[tuple[float, str, Any]] = []
+        # method -> (error_code, description): следующий вызов метода вернёт ошибку
+        self.errors: dict[str, tuple[int, str]] = {}
+        self._ids = itertools.count(100_000)
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.connections.clear()
+        self.timeline.clear()
+
+    async def start(self) -> None:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if self.port == 0:
+            self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        method_key = method.lower()
+        self.calls[method] += 1
+        if request.transport is not None:
+            self.connections.add(id(request.transport))
+
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        error = self.errors.pop(method_key, None)
+        if error is not None:
+            code, description = error
+            payload: dict[str, Any] = {"ok": False, "error_code": code, "description": description}
+            if code == 429:
+                payload["parameters"] = {"retry_after": 1}
+            # aiogram выбирает класс исключения по HTTP-статусу, как у настоящего API
+            return web.json_response(payload, status=code)
+
+        self.timeline.append((time.perf_counter(), method, form.get("chat_id")))
+        return web.json_response({"ok": True, "result": self._result(method_key, form)})
+
+    def _message(self, form: Any) -> dict[str, Any]:
+        try:
+            chat_id = int(form.get("chat_id", 1))
+        except (TypeError, ValueError):
+            chat_id = 1
+        msg: dict[str, Any] = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        }
+        if "text" in form:
+            msg["text"] = form["text"]
+        if "caption" in form:
+            msg["caption"] = form["caption"]
+        if "photo" in form:
+            msg["photo"] = [{"file_id": f"fake-photo-{msg['message_id']}", "file_unique_id": "fake-photo", "width": 800, "height": 800}]
+        return msg
+
+    def _result(self, method: str, form: Any) -> Any:
+        if method == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method == "getupdates":
+            return []
+        if method == "getchatmembercount":
+            return 2
+        if method == "copymessage":
+            return {"message_id": next(self._ids)}
+        if method in ("copymessages", "forwardmessages"):
+            raw = str(form.get("message_ids", "[]")).strip("[]")
+            count = len([p for p in raw.split(",") if p.strip()])
+            return [{"message_id": next(self._ids)} for _ in range(count)]
+        if method.startswith("send") or method.startswith("edit"):
+            return self._message(form)
+        return True
@@ -0,0 +1,220 @@
+# tools/import_users.py
+"""
+Массовый импорт пользователей в users.txt (списки из других ботов, старые выгрузки).
+
+Входные файлы читаются построчно, id проверяются, дубликаты отсекаются по множеству
+уже известных id (users.txt читается один раз), новые строки дописываются в users.txt
+крупными кусками в формате бота: "user_id | Full_name | @username | first_seen_at".
+Бот можно не останавливать: он сам перечитывает users.txt при каждом /start.
+
+    python tools/import_users.py old_export.csv --id-col 0 --name-col 1 --username-col 2
+    python tools/import_users.py ids.txt other_bot/users.txt --dry-run
+    cat ids.txt | python tools/import_users.py -
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Iterator, TextIO
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS_FILE = os.path.join(BOT_DIR, "data", "users.txt")
+STANDARD_HEADER = "user_id | Full_name | @username | first_seen_at"
+
+# id пользователей Telegram — положительные и укладываются в 52 бита; отрицательные — это чаты
+MAX_USER_ID = 2**52
+# сколько строк копить перед одной записью в файл
+WRITE_CHUNK = 50_000
+DELIMITERS = ("|", ";", "\t", ",")
+
+
+def read_existing_ids(path: str) -> tuple[set[int], bool]:
+    """
+    Множество id из users.txt и есть ли у файла заголовок (без него save_user перезапишет файл).
+    """
+    ids: set[int] = set()
+    has_header = False
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for idx, line in enumerate(f):
+                if idx == 0 and line.startswith("user_id |"):
+                    has_header = True
+                    continue
+                uid = line.split("|", 1)[0].strip()
+                if uid.isdigit():
+                    ids.add(int(uid))
+    except FileNotFoundError:
+        pass
+    return ids, has_header
+
+
+def detect_delimiter(line: str) -> str | None:
+    for d in DELIMITERS:
+        if d in line:
+            return d
+    return None
+
+
+def clean_field(value: str) -> str:
+    # разделитель users.txt внутри имени сломал бы строку
+    return value.strip().strip('"').replace("|", "/").replace("\n", " ")
+
+
+def iter_rows(stream: TextIO, args: argparse.Namespace) -> Iterator[tuple[str, str, str, str]]:
+    """
+    (сырой id, имя, @username, first_seen) по строкам входа; пустые строки и # пропускаются.
+    Первая строка с нечисловым id считается заголовком.
+    """
+    delimiter = args.delimiter
+    id_col, name_col, username_col = args.id_col, args.name_col, args.username_col
+    # колонки правее нужных не режем — split с maxsplit заметно быстрее на миллионах строк
+    maxsplit = max(c for c in (id_col, name_col, username_col) if c is not None) + 1
+    first = True
+    for line in stream:
+        if delimiter is None:
+            if not line.strip():
+                continue
+            delimiter = detect_delimiter(line) or ","
+        parts = line.split(delimiter) if delimiter == "|" else line.split(delimiter, maxsplit)
+        raw_id = parts[id_col].strip() if id_col < len(parts) else ""
+
+        if not raw_id.isdigit():
+            # медленный путь — только для «странных» строк
+            raw_id = raw_id.strip('"')
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            if first and raw_id and not raw_id.lstrip("-").isdigit():
+                first = False
+                continue
+        first = False
+
+        name = username = first_seen = ""
+        if name_col is not None and name_col < len(parts):
+            name = clean_field(parts[name_col])
+        if username_col is not None and username_col < len(parts):
+            username = clean_field(parts[username_col]).lstrip("@")
+            username = f"@{username}" if username else ""
+        if delimiter == "|" and len(parts) >= 4:
+            # строка в формате самого бота — переносим как есть
+            name = name or clean_field(parts[1])
+            username = username or clean_field(parts[2])
+            first_seen = clean_field(parts[3])
+        yield raw_id, name, username, first_seen
+
+
+def validate_id(raw: str) -> tuple[int | None, str]:
+    if not raw:
+        return None, "пустой id"
+    if raw.startswith("-"):
+        return None, "отрицательный (это чат, а не пользователь)"
+    if not raw.isdigit():
+        return None, "не число"
+    uid = int(raw)
+    if uid <= 0 or uid >= MAX_USER_ID:
+        return None, "вне диапазона id Telegram"
+    return uid, ""
+
+
+def ensure_header(path: str) -> None:
+    """
+    Создаёт users.txt с заголовком или дописывает заголовок в начало существующего файла.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(STANDARD_HEADER + "\n")
+        return
+    tmp = path + ".tmp"
+    with open(path, "r", encoding="utf-8") as src, open(tmp, "w", encoding="utf-8") as dst:
+        dst.write(STANDARD_HEADER + "\n")
+        for line in src:
+            dst.write(line)
+    os.replace(tmp, path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="CSV/TXT файлы (- — stdin)")
+    parser.add_argument("--users", default=USERS_FILE, help="куда импортировать (по умолчанию data/users.txt бота)")
+    parser.add_argument("--delimiter", default=None, help="разделитель колонок (по умолчанию — по первой строке)")
+    parser.add_argument("--id-col", type=int, default=0, help="номер колонки с id (с 0)")
+    parser.add_argument("--name-col", type=int, default=None, help="номер колонки с именем")
+    parser.add_argument("--username-col", type=int, default=None, help="номер колонки с username")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, users.txt не менять")
+    parser.add_argument("--show-invalid", type=int, default=5, help="сколько примеров неверных строк показать")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    existing, has_header = read_existing_ids(args.users)
+    loaded = time.perf_counter() - started
+
+    first_seen_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = already = 0
+    known_before = len(existing)
+    invalid: Counter[str] = Counter()
+    examples: list[str] = []
+    pending: list[str] = []
+
+    out = None
+    if not args.dry_run:
+        if not has_header:
+            ensure_header(args.users)
+        # дописываем целыми строками одним write на кусок — бот может писать в файл параллельно
+        out = open(args.users, "ab", buffering=0)
+        if out.tell() > 0:
+            with open(args.users, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    out.write(b"\n")
+
+    def flush() -> None:
+        if out is not None and pending:
+            out.write("".join(pending).encode("utf-8"))
+        pending.clear()
+
+    try:
+        for path in args.inputs:
+            stream = sys.stdin if path == "-" else open(path, "r", encoding="utf-8", errors="replace")
+            try:
+                for raw_id, name, username, first_seen in iter_rows(stream, args):
+                    rows += 1
+                    uid = int(raw_id) if raw_id.isdigit() else -1
+                    if not 0 < uid < MAX_USER_ID:
+                        _, reason = validate_id(raw_id)
+                        invalid[reason] += 1
+                        if len(examples) < args.show_invalid:
+                            examples.append(f"{path}: {raw_id!r} — {reason}")
+                        continue
+                    if uid in existing:
+                        already += 1
+                        continue
+                    existing.add(uid)
+                    pending.append(f"{uid} | {name} | {username} | {first_seen or first_seen_now}\n")
+                    if len(pending) >= WRITE_CHUNK:
+                        flush()
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+        flush()
+    finally:
+        if out is not None:
+            out.close()
+
+    elapsed = time.perf_counter() - started
+    added = len(existing) - known_before
+    print(f"users.txt: {args.users} ({known_before} id, прочитан за {loaded:.2f}s)")
+    print(f"строк на входе:      {rows}")
+    print(f"неверных id:         {sum(invalid.values())}")
+    for reason, count in invalid.most_common():
+        print(f"  {reason}: {count}")
+    for line in examples:
+        print(f"  пример: {line}")
+    print(f"уже были / повторы:  {already}")
+    print(f"{'будет добавлено:' if args.dry_run else 'добавлено:':<20} {added}")
+    print(f"время {elapsed:.2f}s, {rows / max(elapsed, 1e-9):,.0f} строк/с" + (" (dry-run, файл не менялся)" if args.dry_run else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+# tools/replay.py
+"""
+Прогон записанного трафика из stats.txt через настоящий диспетчер бота
+против локального фейкового Bot API.
+
+Каждое событие лога превращается в синтетический апдейт (кнопка -> сообщение
+с её текстом, info_* -> callback, рассылка -> цепочка колбэков и сообщений)
+и подаётся в dp.feed_update с исходными интервалами, ускоренными в --speed раз.
+В конце печатает задержку хендлеров по действиям и счётчики вызовов API.
+
+    python tools/replay.py data/stats.txt --speed 60 --users 10 --latency 0.03
+    python tools/replay.py data/stats.txt --speed 0 --limit 5000   # без пауз, максимум нагрузки
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Any
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_api import FakeBotAPI  # noqa: E402
+
+# сдвиг id для синтетических копий пользователя (--users N)
+USER_ID_STRIDE = 10**11
+ARCHIVE_CHAT_ID = -1001000000001
+
+# кнопки главного меню: действие -> текст
+BUTTON_TEXTS = {
+    "BUTTON_STOCK": "📦 НАЛИЧИЕ СТОКА",
+    "BUTTON_REVIEWS": "🔥 Отзывы",
+    "BUTTON_INFO_MAIN": "ℹ️ ИНФОРМАЦИЯ ДЛЯ ЗАКАЗА",
+    "BUTTON_CHANNEL": "📣 ИНФОРМАЦИОННЫЙ КАНАЛ",
+    "BUTTON_MANAGER": "👨‍💻Связь с менеджером",
+    "ADMIN_BROADCAST_BUTTON": "📨 Рассылка",
+    "ADMIN_STATS_BUTTON": "📊 Статистика",
+}
+
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_id = 0
+        self._message_id = 0
+
+    def _next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    @staticmethod
+    def _user(uid: int, username: str) -> dict[str, Any]:
+        user: dict[str, Any] = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+        if username:
+            user["username"] = username
+        return user
+
+    def message(self, uid: int, username: str, text: str):
+        from aiogram.types import Update
+
+        return Update.model_validate(
+            {
+                "update_id": self._next_update_id(),
+                "message": {
+                    "message_id": self._next_message_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "from": self._user(uid, username),
+                    "text": text,
+                },
+            },
+            context={"bot": self.bot},
+        )
+
+    def callback(self, uid: int, username: str, data: str):
+        from aiogram.types import Update
+
+        return Update.model_validate(
+            {
+                "update_id": self._next_update_id(),
+                "callback_query": {
+                    "id": str(self._next_update_id()),
+                    "from": self._user(uid, username),
+                    "chat_instance": "replay",
+                    "data": data,
+                    "message": {
+                        "message_id": self._next_message_id(),
+                        "date": int(time.time()),
+                        "chat": {"id": uid, "type": "private"},
+                        "from": {"id": self.bot.id, "is_bot": True, "first_name": "bot"},
+                        "text": "…",
+                    },
+                },
+            },
+            context={"bot": self.bot},
+        )
+
+    def for_event(self, action_name: str, uid: int, username: str) -> list:
+        """
+        Апдейты, которые в реальности привели к событию. Пустой список — событие
+        является результатом (итоги рассылки и т.п.), а не вводом пользователя.
+        """
+        if action_name == "START":
+            return [self.message(uid, username, "/start")]
+        if action_name in BUTTON_TEXTS:
+            return [self.message(uid, username, BUTTON_TEXTS[action_name])]
+        if action_name.startswith("INFO_"):
+            return [self.callback(uid, username, action_name.lower())]
+        if action_name == "ADMIN_BROADCAST_PREPARE":
+            return [
+                self.callback(uid, username, "broadcast_menu_new"),
+                self.message(uid, username, f"Replay broadcast {self._update_id}"),
+            ]
+        if action_name == "ADMIN_BROADCAST_START":
+            return [self.callback(uid, username, "broadcast_send")]
+        if action_name == "ADMIN_BROADCAST_CANCEL":
+            return [self.callback(uid, username, "broadcast_cancel")]
+        if action_name == "ADMIN_BROADCAST_SCHEDULE":
+            run_at = (datetime.now() + timedelta(hours=1)).strftime("%H:%M")
+            return [self.callback(uid, username, "broadcast_schedule"), self.message(uid, username, run_at)]
+        if action_name == "ADMIN_BROADCAST_RETRY":
+            return [self.callback(uid, username, "broadcast_retry")]
+        if action_name == "ADMIN_BROADCAST_EDIT":
+            return [self.callback(uid, username, "broadcast_menu_edit")]
+        return []
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("stats", help="путь к stats.txt")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение времени (0 — без пауз)")
+    parser.add_argument("--users", type=int, default=1, help="размножить каждого пользователя в N синтетических")
+    parser.add_argument("--limit", type=int, default=0, help="не больше N событий из лога")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка фейкового API, сек")
+    parser.add_argument("--data", help="скопировать эту папку data/ как стартовое состояние (архив, доставки)")
+    parser.add_argument("--no-throttle", action="store_true", help="отключить антиспам (иначе часть апдейтов отсечётся)")
+    args = parser.parse_args()
+
+    stats_path = os.path.abspath(args.stats)
+    data_src = os.path.abspath(args.data) if args.data else None
+
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+
+    # botmain читает настройки при импорте — подменяем токен, API и архив, данные пишем во временную папку
+    os.environ["BOT_TOKEN"] = "123456:REPLAY"
+    os.environ["BOT_API_URL"] = api.url
+    os.environ["ARCHIVE_CHAT_ID"] = str(ARCHIVE_CHAT_ID)
+    os.environ["ADMIN_IDS"] = ""
+    os.environ["ENV_FILE"] = ""  # настоящий .env бота не читаем
+    if args.no_throttle:
+        os.environ["THROTTLE_BURST"] = "1000000"
+    workdir = tempfile.mkdtemp(prefix="tasty-replay-")
+    shutil.copytree(os.path.join(BOT_DIR, "assets"), os.path.join(workdir, "assets"))
+    if data_src:
+        shutil.copytree(data_src, os.path.join(workdir, "data"))
+        # статистику прогон пишет свою
+        open(os.path.join(workdir, "data", "stats.txt"), "w").close()
+    os.chdir(workdir)
+    import botmain
+
+    # события из лога
+    events: list[dict[str, Any]] = []
+    with open(stats_path, "r", encoding="utf-8") as f:
+        for line in f:
+            event = botmain.parse_stats_line(line)
+            if event is None or event["a"] is None or not isinstance(event["uid"], int):
+                continue
+            try:
+                event["at"] = datetime.fromisoformat(event["ts"]).timestamp()
+            except ValueError:
+                continue
+            events.append(event)
+            if args.limit and len(events) >= args.limit:
+                break
+    events.sort(key=lambda e: e["at"])
+    if not events:
+        print("В логе нет событий для прогона.")
+        await api.stop()
+        return
+
+    # кто делал админские действия — тот админ и в прогоне (вместе со своими копиями)
+    admin_ids = {
+        e["uid"] + k * USER_ID_STRIDE for e in events if e["a"].name.startswith("ADMIN_") for k in range(args.users)
+    }
+    botmain.apply_settings(
+        botmain.Settings(botmain.settings.admin_ids | admin_ids, botmain.settings.archive_chat_id), "replay"
+    )
+
+    bot = botmain.bot
+    factory = UpdateFactory(bot)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    skipped: Counter[str] = Counter()
+    errors: Counter[str] = Counter()
+
+    botmain.store.start()
+    api.reset()
+
+    async def play(action_name: str, updates: list) -> None:
+        # цепочку одного события подаём по порядку, как её прислал бы Telegram
+        for update in updates:
+            t0 = time.perf_counter()
+            try:
+                await botmain.dp.feed_update(bot, update)
+            except Exception as e:
+                errors[f"{action_name}: {type(e).__name__}"] += 1
+            latencies[action_name].append(time.perf_counter() - t0)
+
+    log_start = events[0]["at"]
+    started = time.perf_counter()
+    tasks: list[asyncio.Task] = []
+    for e in events:
+        if args.speed > 0:
+            delay = (e["at"] - log_start) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        name = e["a"].name
+        for k in range(args.users):
+            updates = factory.for_event(name, e["uid"] + k * USER_ID_STRIDE, e.get("un", ""))
+            if not updates:
+                skipped[name] += 1
+                continue
+            tasks.append(asyncio.create_task(play(name, updates)))
+
+    await asyncio.gather(*tasks)
+    fed = time.perf_counter() - started
+    # рассылки и прочие фоновые задачи бота
+    while botmain.background_tasks:
+        await asyncio.gather(*list(botmain.background_tasks), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    await botmain.store.close()
+    await bot.session.close()
+    if botmain.bulk_bot is not bot:
+        await botmain.bulk_bot.session.close()
+    await api.stop()
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"\nСобытий в логе: {len(events)}, синтетических пользователей на одного: {args.users}")
+    print(f"Апдейтов подано: {total} за {fed:.2f}s ({total / max(fed, 1e-9):.0f}/s), с фоновыми задачами {elapsed:.2f}s")
+    print(f"Данные прогона: {workdir}\n")
+
+    print(f"{'действие':<34} {'n':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'max, мс':>9}")
+    for name, values in sorted(latencies.items(), key=lambda kv: -len(kv[1])):
+        print(
+            f"{name:<34} {len(values):7d} {percentile(values, 50) * 1000:9.1f} {percentile(values, 95) * 1000:9.1f}"
+            f" {percentile(values, 99) * 1000:9.1f} {max(values) * 1000:9.1f}"
+        )
+
+    print("\nВызовы Bot API:")
+    for method, count in api.calls.most_common():
+        print(f"  {method:<28} {count:8d}")
+    print(f"  {'всего':<28} {sum(api.calls.values()):8d}")
+
+    snapshot = botmain.metrics.snapshot()
+    throttled = {k: v for k, v in snapshot.items() if k.startswith("throttled")}
+    if throttled:
+        print("\nОтсечено антиспамом:", throttled)
+    if skipped:
+        print("Не воспроизводятся (результаты, а не ввод):", dict(skipped))
+    if errors:
+        print("Ошибки хендлеров:", dict(errors))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())